@@ -0,0 +1,472 @@
+"""
+   This module contains a cache of downloaded raw files
+   described by a manifest (size, checksum, fetch time and
+   HTTP validators of each file), with integrity checks,
+   conditional revalidation and size bounded eviction,
+   and a second tier caching data parsed from raw files
+"""
+from datetime import datetime
+from functools import lru_cache
+import atexit
+import glob
+import hashlib
+import json
+import numpy as np
+import os
+import pandas as pd
+import tempfile
+import threading
+import time
+
+from obsdata.save_data import RECORD_COLUMNS, RecordTable
+
+
+MANIFEST = "obsdata-manifest.json"
+MAX_AGE = 24 * 3600  # seconds before a file is revalidated
+PARSED_DIR = "parsed"  # sub directory of parsed data next to raw files
+# e.g. 500M or 20G, bounds the size of each cache directory
+MAX_SIZE_VARIABLE = "OBSDATA_CACHE_MAX_SIZE"
+SIZE_UNITS = {"K": 1e3, "M": 1e6, "G": 1e9, "T": 1e12}
+
+
+def get_checksum(filename):
+    """returns the sha256 checksum of a file"""
+    checksum = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def get_key(source, dataset, site, year):
+    """returns the cache key of a raw file"""
+    return "/".join([str(source), str(dataset), str(site), str(year)])
+
+
+def parse_size(size):
+    """returns a number of bytes of a size such as 500M or 20G"""
+    size = size.strip().upper()
+    if size and size[-1] in SIZE_UNITS:
+        return int(float(size[:-1]) * SIZE_UNITS[size[-1]])
+    return int(size)
+
+
+def get_max_size():
+    """returns the size bound of cache directories set by the
+       environment variable OBSDATA_CACHE_MAX_SIZE, or None"""
+    size = os.environ.get(MAX_SIZE_VARIABLE)
+    if not size:
+        return None
+    return parse_size(size)
+
+
+class RawFileCache:
+    """A cache of raw files stored in a directory.
+
+       Each entry of the manifest is keyed by source/dataset/site/year
+       and describes the file name, size, sha256 checksum, fetch
+       time, last access and the ETag/Last-Modified validators.
+       The size of the cache includes the data parsed from the raw
+       files, which are evicted together with their raw file.
+       Files not found in the manifest are never evicted, nor are
+       files pinned by the current run (see fetch and release).
+       The checksum of a file is only computed again if its size
+       or modification time differ from the manifest.
+    """
+
+    def __init__(self, directory, max_size=None, max_age=MAX_AGE):
+        self.directory = directory
+        self.max_size = max_size
+        self.max_age = max_age
+        self.manifest_file = os.path.join(directory, MANIFEST)
+        self._lock = threading.RLock()
+        self.manifest = self._read_manifest()
+        self.pinned = set()
+
+    def _read_manifest(self):
+        try:
+            with open(self.manifest_file) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _write_manifest(self):
+        os.makedirs(self.directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+                "w", dir=self.directory, suffix=".part",
+                delete=False) as f:
+            json.dump(self.manifest, f, indent=1, sort_keys=True)
+        os.replace(f.name, self.manifest_file)
+
+    def get_path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def is_valid(self, key):
+        """returns true if the file of an entry exists and
+           its size and checksum agree with the manifest, the
+           checksum is trusted if the modification time agrees"""
+        with self._lock:
+            entry = self.manifest.get(key)
+        if entry is None:
+            return False
+        path = self.get_path(entry["filename"])
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return False
+        if not stat.st_size == entry["size"]:
+            return False
+        if stat.st_mtime_ns == entry.get("mtime_ns"):
+            return True
+        if not get_checksum(path) == entry["sha256"]:
+            return False
+        with self._lock:
+            if key in self.manifest:
+                self.manifest[key]["mtime_ns"] = stat.st_mtime_ns
+                self._write_manifest()
+        return True
+
+    def is_verified(self, key):
+        """returns true if the file of an entry was downloaded, or
+           revalidated, by the cache (and not only found on disk)"""
+        with self._lock:
+            entry = self.manifest.get(key)
+        return entry is not None and entry["validated"] > 0
+
+    def is_fresh(self, key):
+        """returns true if an entry was fetched or revalidated
+           less than max_age seconds ago"""
+        with self._lock:
+            entry = self.manifest.get(key)
+        return (
+            entry is not None and
+            time.time() - entry["validated"] < self.max_age
+        )
+
+    def get_validators(self, key):
+        """returns headers for a conditional request of an entry"""
+        with self._lock:
+            entry = self.manifest.get(key, {})
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def add(self, key, filename, headers=None, verified=True):
+        """adds (or updates) the entry of a file stored in the
+           cache directory, headers are the response headers,
+           verified is false for files not known to be complete"""
+        headers = headers or {}
+        path = self.get_path(filename)
+        stat = os.stat(path)
+        checksum = get_checksum(path)
+        now = time.time()
+        with self._lock:
+            self.manifest[key] = {
+                "filename": filename,
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "sha256": checksum,
+                "fetched": datetime.utcnow().isoformat(timespec="seconds"),
+                "validated": now if verified else 0,
+                "accessed": now,
+                "etag": headers.get("ETag"),
+                "last_modified": headers.get("Last-Modified"),
+            }
+            self.evict(keep=key)
+            self._write_manifest()
+
+    def touch(self, key, validated=False):
+        """marks an entry as used (and as revalidated)"""
+        with self._lock:
+            now = time.time()
+            self.manifest[key]["accessed"] = now
+            if validated:
+                self.manifest[key]["validated"] = now
+            self._write_manifest()
+
+    def pin(self, key):
+        """keeps an entry from being evicted until release"""
+        with self._lock:
+            self.pinned.add(key)
+
+    def release(self):
+        """unpins all entries and evicts entries beyond max_size,
+           e.g. at the end of a run"""
+        with self._lock:
+            self.pinned.clear()
+            self.evict()
+
+    def get_parsed_files(self, filename):
+        """returns the files of data parsed from a raw file"""
+        return glob.glob(os.path.join(
+            self.directory, PARSED_DIR, glob.escape(filename) + ".*"))
+
+    def get_parsed_size(self, filename=None):
+        """returns the size of the data parsed from a raw file,
+           or from all raw files if filename is None"""
+        if filename is None:
+            files = glob.glob(os.path.join(self.directory, PARSED_DIR, "*"))
+        else:
+            files = self.get_parsed_files(filename)
+        size = 0
+        for parsed_file in files:
+            try:
+                size += os.path.getsize(parsed_file)
+            except FileNotFoundError:
+                pass
+        return size
+
+    def remove(self, key):
+        """removes an entry, its file and data parsed from it"""
+        with self._lock:
+            entry = self.manifest.pop(key, None)
+            if entry is not None:
+                for path in (
+                        [self.get_path(entry["filename"])] +
+                        self.get_parsed_files(entry["filename"])):
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                self._write_manifest()
+
+    def get_size(self):
+        """returns the size of the raw files and parsed data"""
+        with self._lock:
+            return sum(
+                entry["size"] for entry in self.manifest.values()
+            ) + self.get_parsed_size()
+
+    def evict(self, keep=None):
+        """removes least recently used entries until the total
+           size is within max_size, the entry keep and pinned
+           entries are never removed"""
+        if self.max_size is None:
+            return
+        with self._lock:
+            size = self.get_size()
+            keys = sorted(
+                self.manifest, key=lambda key: self.manifest[key]["accessed"])
+            for key in keys:
+                if size <= self.max_size:
+                    break
+                if key == keep or key in self.pinned:
+                    continue
+                size -= self.manifest[key]["size"] + self.get_parsed_size(
+                    self.manifest[key]["filename"])
+                self.remove(key)
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(directory, max_size=None):
+    """returns the shared cache of a directory, bounded to max_size
+       bytes, by default as set by OBSDATA_CACHE_MAX_SIZE"""
+    directory = os.path.abspath(directory)
+    if max_size is None:
+        max_size = get_max_size()
+    with _caches_lock:
+        if directory not in _caches:
+            _caches[directory] = RawFileCache(directory, max_size=max_size)
+        elif max_size is not None:
+            _caches[directory].max_size = max_size
+        return _caches[directory]
+
+
+def release_caches():
+    """releases the entries pinned by the current run of all
+       shared caches, which are evicted if beyond their size"""
+    with _caches_lock:
+        caches = list(_caches.values())
+    for raw_file_cache in caches:
+        raw_file_cache.release()
+
+
+# files fetched by a run are evicted after the run, not during it
+atexit.register(release_caches)
+
+
+def fetch(cache, key, filename, get, save, revalidate=True):
+    """returns the path of a cached file, the file is downloaded
+       (or revalidated) when needed.
+
+       get is called with conditional request headers and returns a
+       response (or None if the file is not available), save is
+       called with the response and the path and returns false if
+       the response does not hold a valid file.
+       Files without validators, or if revalidate is false, are
+       kept until they fail the integrity check. Files found on disk
+       but not in the manifest (e.g. stored before the cache had a
+       manifest) may be truncated or error pages, so they are
+       downloaded again once before they are trusted.
+       The entry is pinned, it is not evicted during the current
+       run. Returns None if the file is not available.
+    """
+    cache.pin(key)
+    path = cache.get_path(filename)
+    if key not in cache.manifest and os.path.isfile(path):
+        cache.add(key, filename, verified=False)
+    validators = {}
+    if cache.is_valid(key):
+        if cache.is_verified(key):
+            validators = cache.get_validators(key)
+            if not revalidate or not validators or cache.is_fresh(key):
+                cache.touch(key)
+                return path
+    elif key in cache.manifest:
+        print("{} is corrupt, downloading again".format(path))
+        # never left behind, even if the download fails
+        cache.remove(key)
+    r = get(validators)
+    if r is not None and r.status_code == 304:
+        cache.touch(key, validated=True)
+        return path
+    if r is None or not save(r, path):
+        if key in cache.manifest and not cache.is_verified(key):
+            cache.remove(key)
+        return None
+    cache.add(key, filename, r.headers)
+    return path
+
+
+@lru_cache(maxsize=None)
+def _get_raw_file_checksum(filename, mtime_ns, size):
+    return get_checksum(filename)
+
+
+def get_raw_file_checksum(filename):
+    """returns the sha256 checksum of a raw file, computed
+       once as long as the file is not modified"""
+    stat = os.stat(filename)
+    return _get_raw_file_checksum(
+        os.path.abspath(filename), stat.st_mtime_ns, stat.st_size)
+
+
+def get_parsed_filename(raw_file, name, version, suffix):
+    """returns the filename of data parsed from a raw file,
+       the filename changes with the checksum of the raw file
+       and the version of the parser"""
+    return os.path.join(
+        os.path.dirname(os.path.abspath(raw_file)),
+        PARSED_DIR,
+        "{}.{}.v{}.{}{}".format(
+            os.path.basename(raw_file),
+            name.replace(os.sep, "_"),
+            version,
+            get_raw_file_checksum(raw_file)[:16],
+            suffix,
+        )
+    )
+
+
+def load_parsed(raw_file, name, version, parse, read, write, suffix):
+    """returns data parsed from a raw file.
+
+       The data are read from the parsed cache if available, else
+       parse() is called and its result is written to the cache,
+       replacing data parsed from an older raw file or by an older
+       parser. name identifies the data within the raw file.
+    """
+    filename = get_parsed_filename(raw_file, name, version, suffix)
+    try:
+        return read(filename)
+    except (OSError, ValueError, KeyError):
+        pass
+    data = parse()
+    directory = os.path.dirname(filename)
+    os.makedirs(directory, exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+            dir=directory, suffix=".part", delete=False) as f:
+        try:
+            write(data, f)
+        except BaseException:
+            f.close()
+            os.remove(f.name)
+            raise
+    os.replace(f.name, filename)
+    pattern = "{}.{}.v*{}".format(
+        glob.escape(os.path.basename(raw_file)),
+        glob.escape(name.replace(os.sep, "_")),
+        suffix
+    )
+    for stale_file in glob.glob(os.path.join(directory, pattern)):
+        if stale_file != filename:
+            os.remove(stale_file)
+    # parsed data count towards the size of the cache
+    get_cache(os.path.dirname(os.path.abspath(raw_file))).evict()
+    return data
+
+
+def load_dataframe(raw_file, name, version, parse):
+    """returns a dataframe parsed from a raw file, the dataframe
+       is cached as parquet"""
+    return load_parsed(
+        raw_file, name, version, parse,
+        read=pd.read_parquet,
+        write=lambda data, f: data.to_parquet(f),
+        suffix=".parquet",
+    )
+
+
+def write_records(data, f):
+    """writes a tuple (RecordTable, attributes) as npz, where
+       attributes is a dict of scalars or arrays"""
+    records, attributes = data
+    arrays = {
+        "records_" + column: getattr(records, column)
+        for column in RECORD_COLUMNS if column != "status_flag"
+    }
+    arrays["records_status_flag_codes"] = records.status_flag.codes
+    arrays["records_status_flag_categories"] = np.asarray(
+        records.status_flag.categories.tolist())
+    arrays["records_missing_end_datetime"] = np.asarray(
+        records.missing_end_datetime)
+    for key, value in attributes.items():
+        value = np.asarray(value)
+        if value.dtype == object:
+            value = value.astype(str)
+        arrays["attributes_" + key] = value
+    np.savez(f, **arrays)
+
+
+def read_records(filename):
+    """reads a tuple (RecordTable, attributes) written by
+       write_records"""
+    with np.load(filename, allow_pickle=False) as arrays:
+        columns = {
+            column: arrays["records_" + column]
+            for column in RECORD_COLUMNS if column != "status_flag"
+        }
+        records = RecordTable(
+            status_flag=pd.Categorical.from_codes(
+                arrays["records_status_flag_codes"],
+                arrays["records_status_flag_categories"]
+            ),
+            missing_end_datetime=arrays[
+                "records_missing_end_datetime"].item(),
+            **columns
+        )
+        attributes = {
+            key[len("attributes_"):]: (
+                arrays[key].item() if arrays[key].ndim == 0
+                else arrays[key]
+            )
+            for key in arrays.files if key.startswith("attributes_")
+        }
+    return records, attributes
+
+
+def load_records(raw_file, name, version, parse):
+    """returns a tuple (RecordTable, attributes) parsed from a raw
+       file, the records are cached as npz"""
+    return load_parsed(
+        raw_file, name, version, parse,
+        read=read_records,
+        write=write_records,
+        suffix=".npz",
+    )
@@ -1,110 +1,216 @@
+from collections import namedtuple
 from datetime import datetime
+from functools import lru_cache
+import io
+import itertools
 import numpy as np
 import os
+import re
 import pandas as pd
 import requests  # type: ignore
+from urllib.parse import urlparse
 
-from obsdata.save_data import ObsData, Record
-from obsdata.capmon_config import DATASETS
-
-
-def get_table_row_start(table_name, rows):
-    for index, row in enumerate(rows):
-        if row.startswith(b"*TABLE NAME //"):
-            table_name_x = row.split(
-                b",")[1].split(
-                    b"//")[0].split(
-                        b"\r")[0].decode("utf-8").strip()
-            if table_name == table_name_x:
-                return index
-    return -1
-
-
-def get_table_rows_data(rows, row_start):
-    start = end = -1
-    for index in range(row_start, len(rows)):
-        if rows[index].startswith(b"*TABLE DATA BEGINS"):
-            start = index
-        if rows[index].startswith(b"*TABLE DATA ENDS"):
-            end = index
-            break
-    return (start, end)
-
-
-def get_data_from_row(rows, row_start, row_end, row_id):
-    for index in range(row_start, row_end):
-        if row_id in rows[index].split(b",")[0]:
-            column_names = rows[index].split(b",")[1:]
-            return [
-                header.split(
-                    b"//")[0].decode(
-                        "utf-8").split(
-                            "\r")[0].replace(
-                                '"', "").strip() for header in column_names]
-    return -1
-
-
-def get_table_data(rows, row_start, row_end, headers):
-    data = {}
-    for header in headers:
-        data[header] = []
-    for row in rows[row_start + 1: row_end]:
-        for index, header in enumerate(headers):
-            try:
-                data[header].append(
-                    row.split(
-                        b',')[1:][index].split(
-                            b"//")[0].replace(
-                                b"\xc9", b"E").decode(
-                                    "utf-8").strip().replace('"', ""))
-            except IndexError:
-                data[header].append(np.nan)
-    return pd.DataFrame(data, columns=data.keys())
+from obsdata import cache
+from obsdata.download import (
+    DownloadTask, download_all, print_stats, save_response
+)
+from obsdata.save_data import ObsData, RecordTable
+from obsdata.capmon_config import (
+    DATASETS, get_all_site_codes, get_site_info
+)
 
 
-def get_data_from_csvfile(csv_file, table_name):
+# increase when the parsed data of a csv file change
+PARSER_VERSION = 1
+# data rows of a table parsed at once
+TABLE_BLOCK_ROWS = 100000
+
+
+CapmonTable = namedtuple(
+    "CapmonTable",
+    [
+        "name",
+        "data_start",
+        "data_end",
+        "headers",
+        "chemical_formulas",
+        "units",
+    ]
+)
+
+
+def get_cells(row):
+    """returns the cleaned cells of a row, the first cell
+       (comment or row id) is skipped"""
+    return [
+        cell.split(
+            b"//")[0].replace(
+                b"\xc9", b"E").decode(
+                    "utf-8").split(
+                        "\r")[0].strip().replace('"', "")
+        for cell in row.split(b",")[1:]
+    ]
+
+
+def index_tables(csv_file):
+    """indexes all tables of a csv file in a single pass and
+       returns a dict of CapmonTable, the data block of a table
+       is given as byte offsets [data_start, data_end)"""
+    tables = {}
+    metadata = {}
+    position = 0
     with open(csv_file, "rb") as the_file:
-        rows = the_file.readlines()
-        row_start_table = get_table_row_start(table_name, rows)
-        start, end = get_table_rows_data(rows, row_start_table)
-        headers = get_data_from_row(
-            rows, row_start_table, end, b"TABLE COLUMN NAME--SHORT FORM")
-        return get_table_data(rows, start, end, headers)
+        for row in the_file:
+            if row.startswith(b"*TABLE NAME //"):
+                metadata = {
+                    "name": row.split(
+                        b",")[1].split(
+                            b"//")[0].split(
+                                b"\r")[0].decode("utf-8").strip(),
+                    "headers": [],
+                    "chemical_formulas": [],
+                    "units": [],
+                }
+            elif row.startswith(b"*TABLE COLUMN NAME--SHORT FORM"):
+                metadata["headers"] = get_cells(row)
+            elif row.startswith(b"*TABLE COLUMN NAME--CHEMICAL FORMULA"):
+                metadata["chemical_formulas"] = get_cells(row)
+            elif row.startswith(b"*TABLE COLUMN UNITS"):
+                metadata["units"] = get_cells(row)
+            elif row.startswith(b"*TABLE DATA BEGINS"):
+                metadata["data_start"] = position + len(row)
+            elif row.startswith(b"*TABLE DATA ENDS") and metadata:
+                tables[metadata["name"]] = CapmonTable(
+                    data_end=position, **metadata)
+                metadata = {}
+            position += len(row)
+    return tables
 
 
-def get_header(csv_file, table_name, parameter):
+@lru_cache(maxsize=32)
+def _get_table_index(csv_file, mtime, size):
+    return index_tables(csv_file)
+
+
+def get_table_index(csv_file):
+    """returns the table index of a csv file, the index is cached
+       as long as the file is not modified"""
+    stat = os.stat(csv_file)
+    return _get_table_index(
+        os.path.abspath(csv_file), stat.st_mtime_ns, stat.st_size)
+
+
+def get_table(csv_file, table_name):
+    return get_table_index(csv_file)[table_name]
+
+
+def iter_table_rows(csv_file, table):
+    """yields the data rows of a table one at a time"""
     with open(csv_file, "rb") as the_file:
-        rows = the_file.readlines()
-        row_start_table = get_table_row_start(table_name, rows)
-        start, end = get_table_rows_data(rows, row_start_table)
-        headers = get_data_from_row(
-            rows, row_start_table, end, b"TABLE COLUMN NAME--SHORT FORM")
-        chemical_formula = get_data_from_row(
-            rows, row_start_table, end, b"TABLE COLUMN NAME--CHEMICAL FORMULA")
-        return headers[chemical_formula.index(parameter)]
+        the_file.seek(table.data_start)
+        position = table.data_start
+        while position < table.data_end:
+            row = the_file.readline()
+            if not row:
+                break
+            position += len(row)
+            yield row
+
+
+def iter_table_blocks(csv_file, table, nr_of_rows=TABLE_BLOCK_ROWS):
+    """yields the data rows of a table joined in blocks of
+       at most nr_of_rows rows"""
+    rows = iter_table_rows(csv_file, table)
+    while True:
+        block = b"".join(itertools.islice(rows, nr_of_rows))
+        if not block:
+            return
+        yield block
+
+
+def read_table_block(block, table):
+    """parses a block of data rows of a table with the pandas
+       c-parser, columns having a chemical formula get their dtype
+       inferred (values become numbers), all other columns are
+       kept as strings"""
+    if b"//" in block:
+        block = re.sub(rb"//[^,\n]*", b"", block)
+    block = block.replace(b"\xc9", b"E").replace(b'"', b"")
+    if any(
+            pattern in block for pattern in (b" ,", b" \r", b" \n", b"\t")):
+        block = re.sub(rb"[ \t]+(?=[,\r\n])", b"", block)
+    string_columns = [
+        header for index, header in enumerate(table.headers)
+        if not table.chemical_formulas[index:index + 1] or
+        not table.chemical_formulas[index]
+    ]
+    data = pd.read_csv(
+        io.BytesIO(block),
+        header=None,
+        names=["comment"] + table.headers,
+        usecols=table.headers,
+        dtype={header: str for header in string_columns},
+        keep_default_na=False,
+        na_values={
+            header: [""] for header in table.headers
+            if header not in string_columns
+        },
+        skipinitialspace=True,
+        encoding="utf-8",
+    )
+    return data
+
+
+def read_table(csv_file, table, nr_of_rows=TABLE_BLOCK_ROWS):
+    """parses the data rows of a table, the rows are read lazily
+       and parsed in blocks of nr_of_rows, so that the raw data of
+       a file is never held in memory at once"""
+    list_of_data = [
+        read_table_block(block, table)
+        for block in iter_table_blocks(csv_file, table, nr_of_rows)
+    ]
+    if not list_of_data:
+        return pd.DataFrame(columns=table.headers)
+    if len(list_of_data) == 1:
+        return list_of_data[0]
+    return pd.concat(list_of_data, ignore_index=True)
+
+
+def get_data_from_csvfile(csv_file, table_name):
+    return read_table(csv_file, get_table(csv_file, table_name))
+
+
+def get_header(csv_file, table_name, parameter):
+    table = get_table(csv_file, table_name)
+    return table.headers[table.chemical_formulas.index(parameter)]
 
 
 def get_units(csv_file, table_name, parameter):
-    with open(csv_file, "rb") as the_file:
-        rows = the_file.readlines()
-        row_start_table = get_table_row_start(table_name, rows)
-        start, end = get_table_rows_data(rows, row_start_table)
-        units = get_data_from_row(
-            rows, row_start_table, end, b"TABLE COLUMN UNITS")
-        chemical_formula = get_data_from_row(
-            rows, row_start_table, end, b"TABLE COLUMN NAME--CHEMICAL FORMULA")
-        return units[chemical_formula.index(parameter)]
+    table = get_table(csv_file, table_name)
+    return table.units[table.chemical_formulas.index(parameter)]
+
+
+STATUS_FLAGS = [
+    "V0",  # 'Valid value'
+    "V1",  # 'Valid value - below detection limit'
+    "V2",  # noqa 'Valid value - extreme or unusual value assessed and considered valid'
+    "V7",  # noqa 'Valid value - below detection limit and reported as the detection limit or lowest measureable value'
+    "M1",  # 'Missing value - no value available'
+    "M2",  # 'Missing value - invalidated by Principal Investigator'
+]
 
 
 def status_flag_to_number(status_flag):
-    return [
-        "V0",  # 'Valid value'
-        "V1",  # 'Valid value - below detection limit'
-        "V2",  # noqa 'Valid value - extreme or unusual value assessed and considered valid'
-        "V7",  # noqa 'Valid value - below detection limit and reported as the detection limit or lowest measureable value'
-        "M1",  # 'Missing value - no value available'
-        "M2",  # 'Missing value - invalidated by Principal Investigator'
-    ].index(status_flag)
+    return STATUS_FLAGS.index(status_flag)
+
+
+def status_flags_to_numbers(status_flags):
+    """vectorized version of status_flag_to_number"""
+    numbers = pd.Categorical(status_flags, categories=STATUS_FLAGS).codes
+    if (numbers == -1).any():
+        raise ValueError("{} is not a valid status flag".format(
+            np.asarray(status_flags)[numbers == -1][0]))
+    return numbers
 
 
 def get_datetime(date, time):
@@ -113,6 +219,12 @@ def get_datetime(date, time):
     )
 
 
+def get_datetimes(dates, times):
+    """vectorized version of get_datetime"""
+    return pd.to_datetime(
+        dates + " " + times, format="%Y-%m-%d %H:%M:%S").values
+
+
 def get_records(
         data,
         site_info,
@@ -121,26 +233,18 @@ def get_records(
         units, dataset,
         parameter,
         time_interval):
-    records = []
-    for _, row in data.iterrows():
-        start_datetime = get_datetime(
-            row["DateStartUTC"], row["TimeStartUTC"]
-        )
-        end_datetime = get_datetime(
-            row["DateEndUTC"], row["TimeEndUTC"]
-        )
-        records.append(
-            Record(
-                start_datetime=start_datetime,
-                end_datetime=end_datetime,
-                value=float(row[target_parameter]),
-                uncertainty=-999,
-                status=status_flag_to_number(
-                    row[status_parameter]),
-                status_flag=row[status_parameter],
-                nr_of_samples=-999,
-            )
-        )
+    status_flags = data[status_parameter].values
+    records = RecordTable(
+        start_datetime=get_datetimes(
+            data["DateStartUTC"], data["TimeStartUTC"]),
+        end_datetime=get_datetimes(
+            data["DateEndUTC"], data["TimeEndUTC"]),
+        value=pd.to_numeric(data[target_parameter]).values,
+        uncertainty=np.full(len(data), -999),
+        status=status_flags_to_numbers(status_flags),
+        status_flag=status_flags,
+        nr_of_samples=np.full(len(data), -999),
+    )
     return ObsData(
         data_version="?",
         station_name=site_info.site,
@@ -170,8 +274,18 @@ def get_records(
     )
 
 
+def get_csvfile_name(dataset, year, outdir):
+    """returns the local filename of a csv file"""
+    index = [ds["name"] for ds in DATASETS].index(dataset)
+    return os.path.join(
+        outdir,
+        DATASETS[index]["file_pattern"].format(year=year)
+    )
+
+
 def download_csvfile(dataset, year, outdir):
-    """downloads a csv file and store it locally if not already exists
+    """downloads a csv file and store it locally if not already exists,
+       or revalidates a stored file that has not been checked recently
     """
     index = [ds["name"] for ds in DATASETS].index(dataset)
 
@@ -180,50 +294,96 @@ def download_csvfile(dataset, year, outdir):
         DATASETS[index]["file_pattern"].format(year=year)
     )
 
-    csv_file = os.path.join(
-        outdir,
-        DATASETS[index]["file_pattern"].format(year=year)
-    )
+    csv_file = get_csvfile_name(dataset, year, outdir)
+
+    os.makedirs(outdir, exist_ok=True)
 
-    if os.path.isfile(csv_file):
+    def get(headers):
+        return requests.get(url_download_csv, headers=headers, stream=True)
+
+    def save(r, filename):
+        if not r.status_code == 200:
+            print("{} not available".format(url_download_csv))
+            return False
+        print_stats(save_response(r, filename))
         return True
-    r = requests.get(url_download_csv)
-    if not r.status_code == 200:
-        print("{} not available".format(url_download_csv))
-        return False
 
-    with open(csv_file, 'wb') as f:
-        for chunk in r.iter_content():
-            f.write(chunk)
-    return True
+    return cache.fetch(
+        cache.get_cache(outdir),
+        cache.get_key("capmon", dataset, "all", year),
+        os.path.basename(csv_file),
+        get,
+        save,
+    ) is not None
 
 
-def merge_data_many_years(
-        dataset, parameter, site_info, year_start, year_end, outdir):
-    """merge data from many years for a given site and returns
-       an instance of obsdata"""
+def download_csvfiles(dataset, year_start, year_end, outdir):
+    """downloads the csv files of many years concurrently,
+       files already stored locally are revalidated"""
     index = [ds["name"] for ds in DATASETS].index(dataset)
-    counter = 0
-    for year in range(year_start, year_end + 1):
-        csv_file = os.path.join(
-            outdir,
-            DATASETS[index]["file_pattern"].format(year=year)
+    tasks = [
+        DownloadTask(
+            name=os.path.basename(get_csvfile_name(dataset, year, outdir)),
+            host=urlparse(DATASETS[index]["baseurl"]).netloc,
+            function=download_csvfile,
+            args=(dataset, year, outdir),
         )
+        for year in range(year_start, year_end + 1)
+    ]
+    return download_all(tasks)
+
+
+def read_data_from_csvfile(csv_file, dataset):
+    """returns the data table of a csv file, the parsed
+       table is cached next to the csv file"""
+    return cache.load_dataframe(
+        csv_file,
+        dataset,
+        PARSER_VERSION,
+        lambda: get_data_from_csvfile(csv_file, dataset)
+    )
+
+
+def read_data_many_years(
+        dataset, parameter, year_start, year_end, outdir, site_code=None):
+    """reads the data table of each yearly file once and returns
+       a tuple (data, header of parameter, units), or -1 if
+       no file is available. If site_code is given each yearly
+       table is filtered on the site before the years are merged"""
+    list_of_data = []
+    for year in range(year_start, year_end + 1):
+        csv_file = get_csvfile_name(dataset, year, outdir)
         if not os.path.isfile(csv_file):
+            print("{} is not available, skipped".format(csv_file))
             continue
-        data_i = get_data_from_csvfile(csv_file, dataset)
-        data_site = data_i.loc[data_i.SiteID == site_info.code]
-        if counter == 0:
-            data = data_site
+        if not list_of_data:
             units = get_units(csv_file, dataset, parameter)
             header_of_parameter = get_header(
                 csv_file, dataset, parameter
             )
-        else:
-            data = data.append(data_site, ignore_index=True)
-        counter += 1
-    if counter == 0:
+        data = read_data_from_csvfile(csv_file, dataset)
+        if site_code is not None:
+            data = data.loc[data.SiteID == site_code]
+        list_of_data.append(data)
+    if not list_of_data:
         return -1
+    return (
+        pd.concat(list_of_data, ignore_index=True),
+        header_of_parameter,
+        units
+    )
+
+
+def merge_data_many_years(
+        dataset, parameter, site_info, year_start, year_end, outdir):
+    """merge data from many years for a given site and returns
+       an instance of obsdata"""
+    data_many_years = read_data_many_years(
+        dataset, parameter, year_start, year_end, outdir, site_info.code)
+    if data_many_years == -1:
+        return -1
+    data, header_of_parameter, units = data_many_years
+    index = [ds["name"] for ds in DATASETS].index(dataset)
     return get_records(
         data,
         site_info,
@@ -236,6 +396,36 @@ def merge_data_many_years(
     )
 
 
+def merge_data_all_sites(
+        dataset, parameter, year_start, year_end, outdir):
+    """merge data from many years for all sites, each yearly file
+       is parsed once and the rows are grouped by site, returns a
+       list of obsdata instances (one per site in the site file
+       having data)"""
+    data_many_years = read_data_many_years(
+        dataset, parameter, year_start, year_end, outdir)
+    if data_many_years == -1:
+        return []
+    data, header_of_parameter, units = data_many_years
+    index = [ds["name"] for ds in DATASETS].index(dataset)
+    site_codes = set(get_all_site_codes(dataset))
+    list_of_data = []
+    for site_code, data_site in data.groupby("SiteID", sort=False):
+        if site_code not in site_codes:
+            continue
+        list_of_data.append(get_records(
+            data_site,
+            get_site_info(dataset, site_code),
+            header_of_parameter,
+            "{}_Flag".format(header_of_parameter),
+            units,
+            dataset,
+            parameter,
+            DATASETS[index]["time_interval"]
+        ))
+    return list_of_data
+
+
 def create_sites_file(dataset, year_start,  year_end, datadir):
     """creates a csv site file that contains a row for each
        site, this function assumes that product files are
@@ -0,0 +1,243 @@
+"""
+   This module contains helpers that stream a
+   download to disk (or to a parser), and a scheduler that runs
+   many downloads (e.g. site x year x dataset)
+   concurrently over a bounded thread pool
+"""
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+import io
+import os
+import tempfile
+import threading
+import time
+import requests  # type: ignore
+
+
+CHUNK_SIZE = 1024 * 1024
+MAX_WORKERS = 8
+MAX_PER_HOST = 4
+RETRIES = 3
+BACKOFF = 1.0
+
+
+DownloadStats = namedtuple(
+    "DownloadStats",
+    [
+        "filename",
+        "nr_of_bytes",
+        "seconds",
+    ]
+)
+
+
+def get_throughput(stats):
+    """returns the throughput of a download in MB/s"""
+    return stats.nr_of_bytes / 1e6 / max(stats.seconds, 1e-9)
+
+
+def save_response(
+        response,
+        filename,
+        translation=None,
+        delete=b"",
+        chunk_size=CHUNK_SIZE):
+    """streams the body of a response into a file and returns
+       an instance of DownloadStats.
+
+       Bytes are cleaned in a single bytes.translate pass per chunk,
+       where translation is a table from bytes.maketrans (or None)
+       and delete contains bytes to remove. The data is written to
+       a temporary file that is renamed when complete, so that an
+       interrupted download never leaves a truncated file behind.
+    """
+    return save_chunks(
+        response.iter_content(chunk_size=chunk_size),
+        filename,
+        translation=translation,
+        delete=delete,
+    )
+
+
+def save_chunks(chunks, filename, translation=None, delete=b""):
+    """as save_response, but for an iterable of chunks of bytes,
+       e.g. of a response of which the first chunk is already read"""
+    time_start = time.perf_counter()
+    nr_of_bytes = 0
+    directory = os.path.dirname(os.path.abspath(filename))
+    with tempfile.NamedTemporaryFile(
+            dir=directory,
+            prefix=os.path.basename(filename) + ".",
+            suffix=".part",
+            delete=False) as f:
+        try:
+            for chunk in chunks:
+                if translation is not None or delete:
+                    chunk = chunk.translate(translation, delete)
+                f.write(chunk)
+                nr_of_bytes += len(chunk)
+        except BaseException:
+            f.close()
+            os.remove(f.name)
+            raise
+    os.replace(f.name, filename)
+    return DownloadStats(
+        filename, nr_of_bytes, time.perf_counter() - time_start)
+
+
+class ResponseStream(io.RawIOBase):
+    """A readable binary stream over the chunks of a response.
+
+       If tee is given (a binary file), each chunk is also written
+       to it as it is read, so that a response can be parsed and
+       saved while downloaded, without holding it in memory.
+    """
+
+    def __init__(self, chunks, tee=None):
+        self.chunks = iter(chunks)
+        self.tee = tee
+        self.chunk = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.chunk:
+            try:
+                self.chunk = next(self.chunks)
+            except StopIteration:
+                return 0
+            if self.tee is not None:
+                self.tee.write(self.chunk)
+        size = min(len(buffer), len(self.chunk))
+        buffer[:size] = self.chunk[:size]
+        self.chunk = self.chunk[size:]
+        return size
+
+    def drain(self):
+        """reads the chunks not read yet, e.g. to complete the tee"""
+        self.chunk = b""
+        for chunk in self.chunks:
+            if self.tee is not None:
+                self.tee.write(chunk)
+
+
+@contextmanager
+def open_response(response, filename=None, chunk_size=CHUNK_SIZE):
+    """returns a text stream over the body of a (streamed) response.
+
+       If filename is given the raw bytes are also saved there while
+       read, the rest of the body not read from the stream is saved
+       on exit. As for save_response, the file is written to a
+       temporary file that is renamed when complete.
+    """
+    tee = None
+    if filename:
+        tee = open(filename + ".part", "wb")
+    raw = ResponseStream(response.iter_content(chunk_size=chunk_size), tee)
+    try:
+        yield io.TextIOWrapper(
+            io.BufferedReader(raw), encoding=response.encoding or "utf-8")
+        if tee is not None:
+            raw.drain()
+            tee.close()
+            os.replace(filename + ".part", filename)
+    finally:
+        response.close()
+        if tee is not None and not tee.closed:
+            tee.close()
+            os.remove(filename + ".part")
+
+
+def print_stats(stats):
+    print("saved {} ({:.2f} MB in {:.1f} s, {:.2f} MB/s)".format(
+        stats.filename,
+        stats.nr_of_bytes / 1e6,
+        stats.seconds,
+        get_throughput(stats)
+    ))
+
+
+DownloadTask = namedtuple(
+    "DownloadTask",
+    [
+        "name",  # used for progress reporting
+        "host",  # tasks of the same host share a concurrency limit
+        "function",  # function that downloads the file
+        "args",  # arguments of the function
+    ]
+)
+
+
+DownloadResult = namedtuple(
+    "DownloadResult",
+    [
+        "task",
+        "result",  # returned value of the function, None on error
+        "error",  # exception of the last attempt, None on success
+        "attempts",
+    ]
+)
+
+
+def run_task(task, host_limit, retries, backoff):
+    """runs a task, retries with exponential backoff on
+       network errors, and returns a DownloadResult"""
+    error = None
+    for attempt in range(1, retries + 2):
+        with host_limit:
+            try:
+                return DownloadResult(
+                    task, task.function(*task.args), None, attempt)
+            except requests.RequestException as exception:
+                error = exception
+            except SystemExit as exception:
+                # e.g. invalid credentials, a retry will not help
+                return DownloadResult(task, None, exception, attempt)
+        if attempt <= retries:
+            time.sleep(backoff * 2 ** (attempt - 1))
+    return DownloadResult(task, None, error, retries + 1)
+
+
+def download_all(
+        tasks,
+        max_workers=MAX_WORKERS,
+        max_per_host=MAX_PER_HOST,
+        retries=RETRIES,
+        backoff=BACKOFF,
+        progress=True):
+    """runs download tasks over a bounded thread pool and returns
+       a list of DownloadResult in the order of the tasks.
+
+       At most max_per_host tasks of the same host run at the same
+       time, and tasks failing with a network error are retried
+    """
+    results = [None] * len(tasks)
+    host_limits = {
+        task.host: threading.BoundedSemaphore(max_per_host)
+        for task in tasks
+    }
+    counter = 0
+
+    def report(result):
+        if not progress:
+            return
+        if result.error is None:
+            status = "done"
+        else:
+            status = "failed ({})".format(result.error)
+        print("[{}/{}] {} {}".format(
+            counter, len(tasks), result.task.name, status))
+
+    futures = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for index, task in enumerate(tasks):
+            future = executor.submit(
+                run_task, task, host_limits[task.host], retries, backoff)
+            futures[future] = index
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+            counter += 1
+            report(results[futures[future]])
+    return results
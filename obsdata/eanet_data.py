@@ -4,33 +4,42 @@
    public dry monthly EANET dataset
 """
 from bs4 import BeautifulSoup
-from datetime import datetime
+from functools import lru_cache
 import numpy as np
 import os
 import pandas as pd
 import requests  # type: ignore
 
-from obsdata.save_data import ObsData, Record
+from obsdata import cache
+from obsdata.download import (
+    DownloadTask, download_all, print_stats, save_response
+)
+from obsdata.save_data import ObsData, RecordTable
+from obsdata.eanet_config import get_all_site_codes, get_site_info
+
+
+# increase when the parsed data of a sheet change
+PARSER_VERSION = 1
 
 
 class EanetSheetExtractor:
 
     def __init__(self, sheet):
         self.sheet = sheet
+        self._sites = None
+        self._numbers = None
 
     def locate_variable(self, variable):
         '''returns the position where the variable can be
            found in the sheet
         '''
-        row = -1
-        column = -1
-        for col_index, col in enumerate(self.sheet.columns):
-            for row_index, value in enumerate(self.sheet[col]):
-                if value == variable:
-                    row = row_index
-                    column = col_index
-                    break
-        return (row, column)
+        positions = np.argwhere(self.sheet.eq(variable).to_numpy())
+        if len(positions) == 0:
+            return (-1, -1)
+        # first row of the last column holding the variable
+        column = positions[:, 1].max()
+        row = positions[positions[:, 1] == column, 0].min()
+        return (int(row), int(column))
 
     def get_unit(self):
         '''returns the units of the measurements'''
@@ -48,63 +57,96 @@ class EanetSheetExtractor:
 
     def get_sites(self):
         '''returns a dictionary where each item describes where
-           data from a site can be found in the sheet
+           data from a site can be found in the sheet, the sites
+           are located once per sheet
         '''
+        if self._sites is not None:
+            return self._sites
         (row_site, column_site) = self.locate_variable("Site")
         stations = {}
         counter = 0
-        for index, value in enumerate(
-                self.sheet[self.sheet.columns[column_site]]):
-            if index > row_site and pd.notnull(value):
-                if value.startswith('(') or value.endswith(')'):
-                    # if comments below site name
-                    continue
-                stations[counter] = {
-                    "site": value.strip().replace('1', '').split(
-                        '*')[0].strip(),
-                    "row_start": index,
-                    "row_end": index + 3,
-                    "column": column_site,
-                }
-                counter += 1
+        column = self.sheet.iloc[row_site + 1:, column_site]
+        for index in np.flatnonzero(column.notnull()):
+            value = column.iloc[index]
+            if value.startswith('(') or value.endswith(')'):
+                # if comments below site name
+                continue
+            row = row_site + 1 + int(index)
+            stations[counter] = {
+                "site": value.strip().replace('1', '').split(
+                    '*')[0].strip(),
+                "row_start": row,
+                "row_end": row + 3,
+                "column": column_site,
+            }
+            counter += 1
+        self._sites = stations
         return stations
 
+    def get_numbers(self):
+        '''returns the cells of the sheet as a float array, where
+           cells not holding a number are -999 and empty cells NaN,
+           the array is created once per sheet'''
+        if self._numbers is None:
+            numbers = self.sheet.apply(pd.to_numeric, errors="coerce")
+            self._numbers = numbers.mask(
+                numbers.isnull() & self.sheet.notnull(), -999
+            ).to_numpy(dtype="f8")
+        return self._numbers
+
     def get_records(self, site):
         '''returns the records of a given site
            (monthly average data)'''
-        headers = []
-        records_no_date = []
-        for row in range(site["row_start"], site["row_end"] + 1):
-            headers.append(self.sheet.loc[row][site["column"] + 1])
-            start_index = site["column"] + 2
-            record = []
-            # loop over 12 months
-            for d in self.sheet.loc[row][start_index: start_index + 12]:
-                try:
-                    record.append(float(d))
-                except ValueError:
-                    record.append(-999)
-            records_no_date.append(record)
-        records_no_date = np.array(records_no_date).transpose().tolist()
-        # add date to records
-        headers = ["date"] + headers
-        year = self.get_year()
-        records = []
-        for index, record in enumerate(records_no_date):
-            if record[2] != -999 and record[3] != -999:
-                uncertainty = (record[2] - record[3]) / 2
-            else:
-                uncertainty = -999
-            records.append(Record(
-                start_datetime=datetime(year, index + 1, 1),
-                end_datetime=-999,
-                value=record[0],
-                uncertainty=uncertainty,
-                status=-999,
-                status_flag=-999,
-                nr_of_samples=-999,
-            ))
-        return (headers, records)
+        rows = slice(site["row_start"], site["row_end"] + 1)
+        start_index = site["column"] + 2
+        headers = ["date"] + self.sheet.iloc[
+            rows, site["column"] + 1].tolist()
+        # one row per quantity, 12 months
+        blocks = self.get_numbers()[
+            np.newaxis, rows, start_index: start_index + 12]
+        return (headers, self._create_records(blocks))
+
+    def get_all_records(self):
+        '''returns a tuple (sites, records) with the records of all
+           sites of the sheet, where sites holds the site of each record
+        '''
+        sites = list(self.get_sites().values())
+        if not sites:
+            return (np.array([], dtype=str), RecordTable.empty())
+        start_index = sites[0]["column"] + 2
+        rows = np.array([
+            np.arange(site["row_start"], site["row_end"] + 1)
+            for site in sites
+        ])
+        blocks = self.get_numbers()[rows, start_index: start_index + 12]
+        return (
+            np.repeat(
+                np.array([site["site"] for site in sites], dtype=str),
+                blocks.shape[2]
+            ),
+            self._create_records(blocks)
+        )
+
+    def _create_records(self, blocks):
+        '''returns the records of blocks of numbers, one block
+           per site with rows mean, %, max-d and min-d by month'''
+        nr_of_sites, _, nr_of_months = blocks.shape
+        nr_of_records = nr_of_sites * nr_of_months
+        month = np.datetime64("{:04d}-01".format(self.get_year()), "M")
+        upper = blocks[:, 2].ravel()
+        lower = blocks[:, 3].ravel()
+        return RecordTable(
+            start_datetime=np.tile(
+                np.arange(month, month + nr_of_months), nr_of_sites),
+            end_datetime=np.full(nr_of_records, np.datetime64("NaT")),
+            value=blocks[:, 0].ravel(),
+            uncertainty=np.where(
+                (upper != -999) & (lower != -999), (upper - lower) / 2, -999),
+            status=np.full(nr_of_records, -999),
+            status_flag=pd.Categorical.from_codes(
+                np.zeros(nr_of_records, dtype=int), [-999]),
+            nr_of_samples=np.full(nr_of_records, -999),
+        )
 
 
 def get_all_sites(list_of_sheets):
@@ -120,7 +162,7 @@ def get_all_sites(list_of_sheets):
 
 def merge_data(list_of_sheets, eanet_site, dataset, parameter):
     '''merge data from many years and returns an instance of EanetData'''
-    records = []
+    list_of_records = []
     for sheet in list_of_sheets:
         sheet_extractor = EanetSheetExtractor(sheet)
         sites = sheet_extractor.get_sites()
@@ -129,8 +171,113 @@ def merge_data(list_of_sheets, eanet_site, dataset, parameter):
                 continue
             _, current_records = sheet_extractor.get_records(
                 sites[site])
-            for record in current_records:
-                records.append(record)
+            list_of_records.append(current_records)
+    records = RecordTable.concatenate(list_of_records)
+    return create_obsdata(
+        eanet_site, dataset, parameter, sheet_extractor.get_unit(), records)
+
+
+@lru_cache(maxsize=32)
+def _load_workbook(xlsfile, mtime, size):
+    return pd.read_excel(xlsfile, sheet_name=None)
+
+
+def load_workbook(xlsfile):
+    '''returns a dictionary with all sheets of a xls file, the file is
+       opened once and the sheets are kept in memory as long as the
+       file is not modified'''
+    stat = os.stat(xlsfile)
+    return _load_workbook(
+        os.path.abspath(xlsfile), stat.st_mtime_ns, stat.st_size)
+
+
+def get_sheet(xlsfile, parameter):
+    '''returns the sheet of a parameter'''
+    workbook = load_workbook(xlsfile)
+    if parameter not in workbook:
+        raise ValueError(
+            "Worksheet named '{}' not found".format(parameter))
+    return workbook[parameter]
+
+
+def parse_sheet(xlsfile, parameter):
+    '''returns a tuple (records, attributes) with the records of
+       all sites of a sheet, where attributes holds the unit and
+       the site of each record'''
+    sheet_extractor = EanetSheetExtractor(get_sheet(xlsfile, parameter))
+    sites, records = sheet_extractor.get_all_records()
+    return (
+        records,
+        {
+            "unit": sheet_extractor.get_unit(),
+            "sites": sites,
+        }
+    )
+
+
+def read_sheet(xlsfile, parameter):
+    '''returns a tuple (records, attributes) of a sheet (see
+       parse_sheet), the parsed sheet is cached next to the xls file'''
+    return cache.load_records(
+        xlsfile,
+        parameter,
+        PARSER_VERSION,
+        lambda: parse_sheet(xlsfile, parameter)
+    )
+
+
+def get_all_sites_from_files(xlsfiles, parameter):
+    '''returns an array of the name all sites of a parameter'''
+    return np.unique(np.concatenate([
+        read_sheet(xlsfile, parameter)[1]["sites"] for xlsfile in xlsfiles
+    ]))
+
+
+def merge_data_from_files(xlsfiles, eanet_site, dataset, parameter):
+    '''merge data of a parameter from the xls files of many years
+       and returns an instance of EanetData'''
+    list_of_records = []
+    unit = "?"
+    for xlsfile in xlsfiles:
+        records, attributes = read_sheet(xlsfile, parameter)
+        list_of_records.append(
+            records[attributes["sites"] == eanet_site.site])
+        unit = attributes["unit"]
+    records = RecordTable.concatenate(list_of_records)
+    return create_obsdata(eanet_site, dataset, parameter, unit, records)
+
+
+def merge_data_all_sites(xlsfiles, dataset, parameter):
+    '''merge data of a parameter from the xls files of many years
+       for all sites in one pass, returns a list of EanetData (one
+       per site having meta data)'''
+    list_of_records = []
+    list_of_sites = []
+    unit = "?"
+    for xlsfile in xlsfiles:
+        records, attributes = read_sheet(xlsfile, parameter)
+        list_of_records.append(records)
+        list_of_sites.append(attributes["sites"])
+        unit = attributes["unit"]
+    if not list_of_records:
+        return []
+    records = RecordTable.concatenate(list_of_records)
+    sites = np.concatenate(list_of_sites)
+    # for these sites we have needed meta data
+    eanet_sites = {}
+    for site_code in get_all_site_codes():
+        eanet_site = get_site_info(site_code)
+        eanet_sites.setdefault(eanet_site.site, eanet_site)
+    return [
+        create_obsdata(
+            eanet_sites[site], dataset, parameter, unit,
+            records[sites == site])
+        for site in np.unique(sites) if site in eanet_sites
+    ]
+
+
+def create_obsdata(eanet_site, dataset, parameter, unit, records):
+    '''returns an instance of ObsData'''
     return ObsData(
         data_version="?",
         station_name=eanet_site.site.replace('ñ', 'n'),
@@ -150,7 +297,7 @@ def merge_data(list_of_sheets, eanet_site, dataset, parameter):
         parameter=parameter,
         parameter_code=parameter,
         time_interval="monthly",
-        measurement_unit=sheet_extractor.get_unit(),
+        measurement_unit=unit,
         measurement_method="?",
         sampling_type="continuous",
         time_zone="UTC",
@@ -161,7 +308,8 @@ def merge_data(list_of_sheets, eanet_site, dataset, parameter):
 
 
 def get_datafile_url(year, dataset):
-    '''returns an url from where the excel file can be downloaded'''
+    '''returns an url from where the excel file can be downloaded,
+       or None if the file is not available'''
     available_datasets = [
         "Dry Monthly",
         "Inland Annual",
@@ -172,11 +320,11 @@ def get_datafile_url(year, dataset):
     ]
     if dataset not in available_datasets:
         print("dataset is not available")
-        exit(0)
+        return None
     available_years = range(2000, 2018)
     if year not in available_years:
         print("year is not available")
-        exit(0)
+        return None
 
     url_base = "https://monitoring.eanet.asia"
     r = requests.get(url_base + "/document/public")
@@ -199,31 +347,70 @@ def get_datafile_url(year, dataset):
 
 
 def retrieve_file(url, datadir, dataset, year):
-    '''download file (if not already exists) and returns full filename'''
+    '''download file (if not already exists or changed)
+       and returns full filename'''
+    return fetch_xlsfile(
+        lambda: url, datadir, dataset, year)
+
+
+def download_xlsfile(datadir, dataset, year):
+    '''looks up the url of a datafile, downloads the file
+       and returns full filename'''
+    return fetch_xlsfile(
+        lambda: get_datafile_url(year, dataset), datadir, dataset, year)
+
+
+def fetch_xlsfile(get_url, datadir, dataset, year):
+    '''returns the filename of a cached datafile, the file is
+       downloaded, or revalidated, when needed. get_url is only
+       called when a request is made'''
     xlsfile = get_xls_filename(datadir, dataset, year)
 
-    if not os.path.exists(datadir):
-        os.makedirs(datadir)
+    os.makedirs(datadir, exist_ok=True)
 
-    if not os.path.isfile(xlsfile):
-        r = requests.get(url, stream=True)
-        with open(xlsfile, 'wb') as f:
-            for chunk in r.iter_content():
-                f.write(chunk)
-    return xlsfile
+    def get(headers):
+        url = get_url()
+        if url is None:
+            return None
+        return requests.get(url, headers=headers, stream=True)
+
+    def save(r, filename):
+        if not r.status_code == 200:
+            print("{} not available".format(r.url))
+            return False
+        print_stats(save_response(r, filename))
+        return True
+
+    return cache.fetch(
+        cache.get_cache(datadir),
+        cache.get_key("eanet", dataset, "all", year),
+        os.path.basename(xlsfile),
+        get,
+        save,
+    )
 
 
 def get_xlsfiles(datadir, dataset, start_year, end_year):
     '''returns a list of filenames of the dataset,
-       download datafiles in not locally available
+       datafiles not locally available are downloaded
+       concurrently, years without a datafile are skipped
     '''
+    results = download_all([
+        DownloadTask(
+            name=os.path.basename(get_xls_filename(datadir, dataset, year)),
+            host="monitoring.eanet.asia",
+            function=download_xlsfile,
+            args=(datadir, dataset, year),
+        )
+        for year in range(start_year, end_year + 1)
+    ])
     xlsfiles = []
-    for year in range(start_year, end_year + 1):
-        xlsfile = get_xls_filename(datadir, dataset, year)
-        if not os.path.isfile(xlsfile):
-            url = get_datafile_url(year, dataset)
-            retrieve_file(url, datadir, dataset, year)
-        xlsfiles.append(xlsfile)
+    for result in results:
+        if result.error is None and result.result is not None:
+            xlsfiles.append(result.result)
+        else:
+            print("{} {} is not available, skipped".format(
+                dataset, result.task.args[2]))
     return xlsfiles
 
 
@@ -3,17 +3,24 @@
    that downloads and imports data from the
    non-public EANET dataset
 """
-from datetime import datetime, timedelta
+import itertools
 import json
 import numpy as np
 import os
 import pandas as pd
-import requests  # type: ignore
 
-from obsdata.save_data import ObsData, Record
+from obsdata import cache, sessions
+from obsdata.download import (
+    CHUNK_SIZE, DownloadTask, download_all, print_stats, save_chunks
+)
+from obsdata.save_data import ObsData, RecordTable
 from obsdata.eanet_config import get_site_info
 
 
+# increase when the parsed data of a csv file change
+PARSER_VERSION = 1
+
+
 class InputError(Exception):
     pass
 
@@ -31,10 +38,23 @@ class EanetWetDataExtractor:
     def __init__(self, csvfile, parameter):
         self.parameter = parameter
         self.csvfile = csvfile
+        # the file is read once, the layout of the tables is
+        # derived from the raw cells and cached
+        self.raw = pd.read_csv(csvfile, header=None, dtype=str)
+        self.table_locations = self._locate_tables()
+        self.datasets = {}
+        self.set_parameter(parameter)
+
+    def set_parameter(self, parameter):
+        """changes the target parameter, without reading the file again"""
+        self.parameter = parameter
         if self.parameter_in_dataset():
             self.df = self.get_dataset()
         else:
-            self.df = pd.read_csv(self.csvfile)
+            if -1 not in self.datasets:
+                self.datasets[-1] = self._get_dataframe(
+                    0, 0, len(self.raw.columns))
+            self.df = self.datasets[-1]
 
     def parameter_in_dataset(self):
         '''returns true if the csvfile contains
@@ -49,11 +69,7 @@ class EanetWetDataExtractor:
         table_locations = self._get_table_locations()
         products = []
         for table in table_locations:
-            columns = self._get_columns_in_table(
-                table_locations[table]["start"],
-                table_locations[table]["end"]
-            )
-            for column in columns:
+            for column in table_locations[table]["products"]:
                 products.append(column)
         return products
 
@@ -63,138 +79,155 @@ class EanetWetDataExtractor:
         """
         table_locations = self._get_table_locations()
         index = self._get_first_table_with_target(table_locations)
-        usecols = range(
-            table_locations[index]["start"],
-            table_locations[index]["end"]
-        )
-        row_number = self._get_row_number_of_headers(
-            table_locations[index]["start"]
-        )
-        return pd.read_csv(self.csvfile, skiprows=row_number, usecols=usecols)
+        if index not in self.datasets:
+            self.datasets[index] = self._get_dataframe(
+                table_locations[index]["header_row"],
+                table_locations[index]["start"],
+                table_locations[index]["end"]
+            )
+        return self.datasets[index]
 
     def _get_table_locations(self):
+        """returns the cached table locations"""
+        return self.table_locations
+
+    def _locate_tables(self):
         '''these csv files are non standard and typically
            contain six different tables, (i.e. one row of
            the csv file can contain data from six different
            tables), this function returns a dictionary
-           describing the index of start and end column
+           describing the index of start and end column,
+           the row of the headers and the products
            of each table
         '''
         # it is assumed that table names are found
         # on the second row of the csv file
-        df = pd.read_csv(self.csvfile, skiprows=1)
-        columns = [
-            column for column in df.columns if not column.startswith("Unnamed")]
+        names = self.raw.iloc[1]
+        starts = [
+            column for column in range(len(names))
+            if pd.notnull(names[column])]
         table_locations = {}
-        for index, column in enumerate(columns):
+        for index, start in enumerate(starts):
             table_locations[index] = {
-                "name": column,
-                "start": df.columns.tolist().index(column)
+                "name": names[start],
+                "start": start,
+                "end": (
+                    starts[index + 1] - 1 if index < len(starts) - 1
+                    else len(names)
+                ),
             }
-            if index < len(columns) - 1:
-                table_locations[index]["end"] = (
-                    df.columns.tolist().index(columns[index + 1]) - 1
-                )
-            else:
-                table_locations[index]["end"] = len(df.columns)
+            table_locations[index]["header_row"] = (
+                self._get_row_number_of_headers(start))
+            table_locations[index]["products"] = self._get_columns_in_table(
+                start, table_locations[index]["end"])
         return table_locations
 
     def _get_row_number_of_headers(self, start_column):
         """return the row number where headers are found"""
-        df = pd.read_csv(
-            self.csvfile,
-            usecols=[start_column]
-        )
         index = 0
-        for index, row in enumerate(df[df.columns[0]]):
+        for index, row in enumerate(self.raw[start_column][1:]):
             if pd.notnull(row) and row.startswith("Sample No."):
                 return index + 1
         return index
 
+    def _get_headers(self, row_number):
+        """returns the headers of a row, named and
+           deduplicated as done by pandas.read_csv"""
+        headers = [
+            header if pd.notnull(header) else "Unnamed: {}".format(index)
+            for index, header in enumerate(self.raw.iloc[row_number])
+        ]
+        return mangle_duplicates(headers)
+
+    def _get_dataframe(self, row_number, start_column, end_column):
+        """returns the table found below the header row
+           within the column range"""
+        df = self.raw.iloc[row_number + 1:, start_column:end_column]
+        df = df.reset_index(drop=True)
+        df.columns = self._get_headers(row_number)[start_column:end_column]
+        for column in df.columns:
+            try:
+                df[column] = pd.to_numeric(df[column])
+            except ValueError:
+                pass
+        return df
+
     def _get_columns_in_table(self, start_column, end_column):
         """returns a list with data column headers"""
         row_number = self._get_row_number_of_headers(start_column)
-        df = pd.read_csv(
-            self.csvfile,
-            skiprows=row_number,
-            usecols=range(start_column, end_column)
-        )
-        columns = [
-            column for column in df.columns
-            if (not column.startswith("Unnamed")
-                and not column.startswith("Samp")
-                and not column.startswith("Date")
-                and not column.startswith("Method")
-                and not column.startswith("Note"))]
-
+        headers = self._get_headers(row_number)
         return [
-            column for column in columns
-            if np.any([is_number(value) for value in df[column]])
+            headers[index] for index in range(start_column, end_column)
+            if (not headers[index].startswith("Unnamed")
+                and not headers[index].startswith("Samp")
+                and not headers[index].startswith("Date")
+                and not headers[index].startswith("Method")
+                and not headers[index].startswith("Note")
+                and np.any([
+                    pd.isnull(value) or is_number(value)
+                    for value in self.raw[index][row_number + 1:]
+                ]))
         ]
 
+    def _get_target_column(self):
+        """returns the header of the column holding the target,
+           e.g. 'R1 ' for the target 'R1'"""
+        table_locations = self._get_table_locations()
+        index = self._get_first_table_with_target(table_locations)
+        for column in table_locations[index]["products"]:
+            if column.startswith(self.parameter):
+                return column
+
     def _get_first_table_with_target(self, table_locations):
         """returns the index of the first table that contains
            data from the target, target data can be found in
            multiple tables"""
         for index in table_locations:
-            for column in self._get_columns_in_table(
-                    table_locations[index]["start"],
-                    table_locations[index]["end"]):
+            for column in table_locations[index]["products"]:
                 if column.startswith(self.parameter):
                     return index
         return -1
 
     def get_records(self):
-        """returns a list of records of the desired parameter"""
-        records = []
+        """returns the records of the desired parameter"""
         for column in self.df.columns:
             if column.startswith("Sample No."):
                 sample_no_header = column
                 break
+        start_dates = self.get_dates("start")
+        is_sample = (
+            (self.df[sample_no_header] > 0).values & ~np.isnat(start_dates))
+        nr_of_records = np.count_nonzero(is_sample)
+        return RecordTable(
+            start_datetime=start_dates[is_sample],
+            end_datetime=self.get_dates("end")[is_sample],
+            value=get_values(
+                self.df[self._get_target_column()][is_sample]),
+            uncertainty=np.full(nr_of_records, -999),
+            status=np.full(nr_of_records, -999),
+            status_flag=np.full(nr_of_records, -999),
+            nr_of_samples=np.full(nr_of_records, -999),
+        )
 
-        for index in range(len(self.df[self.parameter])):
-
-            if not self.df[sample_no_header][index] > 0:
-                continue
-            records.append(
-                Record(
-                    start_datetime=self.get_date(index, "start"),
-                    end_datetime=self.get_date(index, "end"),
-                    value=self.get_value(index),
-                    uncertainty=-999,
-                    status=-999,
-                    status_flag=-999,
-                    nr_of_samples=-999,
-                )
-            )
-        return records
-
-    def get_value(self, index):
-        """returns the value of the desired parameter of a record"""
-        value = float(self.df[self.parameter][index])
-        if np.isnan(value):
-            value = -999
-        return value
-
-    def get_date(self, row_index, start_or_end):
-        """returs the the date of a record"""
+    def get_dates(self, start_or_end):
+        """returns the start or end dates of all rows,
+           rows without a date are set to NaT"""
         offset = 0 if start_or_end == "start" else 2
         columns = self.df.columns.tolist()
         for column_index, column in enumerate(columns):
             if column.startswith("Sampling period"):
                 break
-        # column_index = columns.index("Sampling period")
-        return datetime.strptime(
-            '{}T{}'.format(
-                self.df[columns[column_index + offset]][row_index],
-                self.df[columns[column_index + 1 + offset]][row_index]
-            ),
-            '%Y/%m/%dT%H:%M'
+        else:
+            # e.g. summary tables have no sampling period
+            return np.full(len(self.df), np.datetime64("NaT"))
+        return get_datetimes(
+            self.df[columns[column_index + offset]],
+            self.df[columns[column_index + 1 + offset]]
         )
 
     def get_unit(self):
         """returns the unit of the measurements"""
-        unit = self.df[self.parameter][1]
+        unit = self.df[self._get_target_column()][1]
         return unit if pd.notnull(unit) else "?"
 
 
@@ -211,6 +244,10 @@ class EanetDryDataExtractor:
         self.parameter = parameter
         self.df = pd.read_csv(csvfile, skiprows=1)
 
+    def set_parameter(self, parameter):
+        """changes the target parameter, without reading the file again"""
+        self.parameter = parameter
+
     def parameter_in_dataset(self):
         '''returns true if csvfile contains
            a column of data for the target parameter'''
@@ -220,76 +257,58 @@ class EanetDryDataExtractor:
         )
 
     def get_records(self):
-        """returns a list of records of the desired parameter"""
-        records = []
+        """returns the records of the desired parameter"""
         if self.parameter not in self.df.columns:
             print("target not in products, available products:")
             print(self.get_products())
-            return records
-        for index in range(len(self.df[self.parameter])):
-            try:
-                start_date = self.get_start_date(index)
-                end_date = self.get_end_date(index)
-            except ValueError:
-                print(index)
-                print('unable to parse row in records')
-                continue
-            records.append(
-                Record(
-                    start_datetime=start_date,
-                    end_datetime=end_date,
-                    value=self.get_value(index),
-                    uncertainty=-999,
-                    status=-999,
-                    status_flag=-999,
-                    nr_of_samples=-999,
-                )
-            )
-        return records
+            return RecordTable.empty()
+        start_dates = self.get_start_dates()
+        end_dates = self.get_end_dates()
+        unparsed = np.isnat(start_dates)
+        if "Date.1" in self.df.columns:
+            unparsed |= np.isnat(end_dates)
+        for index in np.flatnonzero(unparsed):
+            print(index)
+            print('unable to parse row in records')
+        is_parsed = ~unparsed
+        nr_of_records = np.count_nonzero(is_parsed)
+        return RecordTable(
+            start_datetime=start_dates[is_parsed],
+            end_datetime=end_dates[is_parsed],
+            value=get_values(self.df[self.parameter][is_parsed]),
+            uncertainty=np.full(nr_of_records, -999),
+            status=np.full(nr_of_records, -999),
+            status_flag=np.full(nr_of_records, -999),
+            nr_of_samples=np.full(nr_of_records, -999),
+        )
 
-    def get_start_date(self, index):
-        """returns the start datetime of a record"""
+    def get_start_dates(self):
+        """returns the start datetimes of all rows,
+           unparsable rows are set to NaT"""
         # format varies between files, so we try to ways
-        try:
-            day = int(
-                self.df["Day"][index] if pd.notnull(self.df["Day"][index])
-                else 1
-            )
-            hour = int(
-                self.df["Hour"][index] if pd.notnull(self.df["Hour"][index])
-                else 0
+        if "Year" in self.df.columns:
+            start_dates = pd.to_datetime(
+                pd.DataFrame({
+                    "year": self.df["Year"],
+                    "month": self.df["Month"],
+                    "day": self.df["Day"].fillna(1),
+                }),
+                errors="coerce"
             )
-            start_date = datetime(
-                self.df["Year"][index],
-                self.df["Month"][index],
-                day
-            ) + timedelta(hours=hour)
             # timedelta is needed since hour=24 in some files
-        except KeyError:
-            time = (
-                self.df["Time"][index] if pd.notnull(self.df["Time"][index])
-                else "00:00"
-            )
-            start_date = datetime.strptime(
-                '{}T{}'.format(self.df["Date"][index], time),
-                '%Y/%m/%dT%H:%M'
-            )
-        return start_date
-
-    def get_end_date(self, index):
-        """returns the end datetime of a record"""
-        try:
-            time = (
-                self.df["Time.1"][index] if pd.notnull(self.df["Time.1"][index])
-                else "00:00"
-            )
-            end_date = datetime.strptime(
-                '{}T{}'.format(self.df["Date.1"][index], time),
-                '%Y/%m/%dT%H:%M'
-            )
-        except KeyError:
-            end_date = -999
-        return end_date
+            return (
+                start_dates +
+                pd.to_timedelta(self.df["Hour"].fillna(0), unit="h")
+            ).values
+        return get_datetimes(self.df["Date"], self.df["Time"].fillna("00:00"))
+
+    def get_end_dates(self):
+        """returns the end datetimes of all rows,
+           unparsable rows are set to NaT"""
+        if "Date.1" not in self.df.columns:
+            return np.full(len(self.df), np.datetime64("NaT"))
+        return get_datetimes(
+            self.df["Date.1"], self.df["Time.1"].fillna("00:00"))
 
     def get_products(self):
         '''reurns a list of parameters found within the csvfile'''
@@ -307,12 +326,46 @@ class EanetDryDataExtractor:
         unit = df[self.df.columns.tolist().index(self.parameter)][0]
         return unit if pd.notnull(unit) else "?"
 
-    def get_value(self, index):
-        """returns the value of the desired parameter of a record"""
-        value = float(self.df[self.parameter][index])
-        if np.isnan(value):
-            value = -999
-        return value
+
+def mangle_duplicates(headers):
+    """renames duplicated headers as 'name.1', 'name.2', ...
+       in the same way as pandas.read_csv"""
+    counts = {}
+    mangled = []
+    for base in headers:
+        header = base
+        count = counts.get(header, 0)
+        while count > 0:
+            counts[base] = count + 1
+            header = "{}.{}".format(base, count)
+            if header in headers:
+                count += 1
+            else:
+                count = counts.get(header, 0)
+        mangled.append(header)
+        counts[header] = count + 1
+    return mangled
+
+
+def get_datetimes(dates, times):
+    """parses dates (YYYY/MM/DD) and times (HH:MM) column-wise,
+       times of 24:00 roll over to the next day and unparsable
+       rows are set to NaT"""
+    days = pd.to_datetime(dates, format="%Y/%m/%d", errors="coerce")
+    hours_and_minutes = times.astype(str).str.extract(
+        r"^\s*(\d{1,2}):(\d{2})\s*$").astype(float)
+    minutes = hours_and_minutes[0] * 60 + hours_and_minutes[1]
+    datetimes = (
+        days + pd.to_timedelta(minutes.fillna(0), unit="m")).values
+    datetimes[minutes.isna().values] = np.datetime64("NaT")
+    return datetimes
+
+
+def get_values(values):
+    """returns the values as floats, missing values are set to -999"""
+    values = pd.to_numeric(values).values.astype(float)
+    values[np.isnan(values)] = -999
+    return values
 
 
 def is_number(s):
@@ -385,53 +438,115 @@ def get_login_payload():
     }
 
 
-def download_csvfile(datadir, dataset, station, year):
-    '''download file (if not already exists) and returns full filename'''
-
-    url_base = "https://monitoring.eanet.asia"
-
-    csvfile = os.path.join(
+def get_csvfile_name(datadir, dataset, station, year):
+    """returns the local filename of a csv file"""
+    return os.path.join(
         datadir,
         "{}_{}_{}.csv".format(station, year, dataset)
     )
 
-    if not os.path.exists(datadir):
-        os.makedirs(datadir)
 
-    if os.path.isfile(csvfile):
-        return csvfile
+url_base = "https://monitoring.eanet.asia"
+login_url = url_base + "/document/signin/index"
+
 
+def login(session):
+    """logs in a requests session on EANET"""
     login_payload = get_login_payload()
-    payload = get_payload(dataset, station, year)
+    p = session.post(login_url, data=login_payload)
+    if 'Set-Cookie' in p.headers and 'HttpOnly' in p.headers['Set-Cookie']:
+        print(
+            'not able to login on {},\n'.format(login_url) +
+            'is your credentials valid?'
+        )
+        exit(1)
+
+
+def is_expired(response):
+    """returns true if EANET redirected the request to the login page"""
+    return response.url.startswith(login_url)
 
-    with requests.Session() as session:
-        # login
-        login_url = url_base + "/document/signin/index"
-        p = session.post(login_url, data=login_payload)
-        if 'Set-Cookie' in p.headers and 'HttpOnly' in p.headers['Set-Cookie']:
-            print(
-                'not able to login on {},\n'.format(login_url) +
-                'is your credentials valid?'
-            )
-            exit(1)
 
-        # download data
-        data_url = url_base + "/document/menu/index"
-        r = session.post(data_url, data=payload)
+def get_session():
+    """returns the EANET session shared by all requests"""
+    return sessions.get_session("eanet", login, is_expired)
 
-        if "doctype html" in r.text:
+
+def download_csvfile(datadir, dataset, station, year):
+    '''download file (if not already exists) and returns full filename'''
+
+    csvfile = get_csvfile_name(datadir, dataset, station, year)
+
+    os.makedirs(datadir, exist_ok=True)
+
+    data_url = url_base + "/document/menu/index"
+
+    def get(headers):
+        payload = get_payload(dataset, station, year)
+        return get_session().post(data_url, data=payload, stream=True)
+
+    def save(r, filename):
+        chunks = r.iter_content(chunk_size=CHUNK_SIZE)
+        first_chunk = next(chunks, b"")
+        # missing data are answered by an html page, not by a status
+        if b"doctype html" in first_chunk[:1024].lower():
             print('requested data not found on {}'.format(data_url))
-            return None
+            return False
+        print_stats(save_chunks(
+            itertools.chain([first_chunk], chunks),
+            filename,
+            translation=bytes.maketrans(b'\xCA', b'u'),
+            delete=b'\x81\x83'
+        ))
+        return True
 
-    # save csvdata locally
-    with open(csvfile, 'wb') as f:
-        for chunk in r.iter_content():
-            chunk = chunk.replace(b'\x81', b'')
-            chunk = chunk.replace(b'\x83', b'')
-            chunk = chunk.replace(b'\xCA', b'u')
-            f.write(chunk)
+    # the data are requested by a form, so there are no validators
+    # to revalidate with, stored files are kept while intact
+    return cache.fetch(
+        cache.get_cache(datadir),
+        cache.get_key("eanet_hourly", dataset, station, year),
+        os.path.basename(csvfile),
+        get,
+        save,
+        revalidate=False,
+    )
 
-    return csvfile
+
+def download_csvfiles(datadir, dataset, stations, years):
+    """downloads the csv files of many stations and years
+       concurrently, intact files already stored locally are kept"""
+    tasks = [
+        DownloadTask(
+            name=os.path.basename(
+                get_csvfile_name(datadir, dataset, station, year)),
+            host="monitoring.eanet.asia",
+            function=download_csvfile,
+            args=(datadir, dataset, station, year),
+        )
+        for station in stations for year in years
+    ]
+    return download_all(tasks)
+
+
+def get_data_extractor(dataset, csvfile, parameter):
+    """returns a data extractor suitable for the dataset"""
+    if dataset == "wet_deposition":
+        return EanetWetDataExtractor(csvfile, parameter)
+    return EanetDryDataExtractor(csvfile, parameter)
+
+
+def extract_records(data_extractor):
+    """returns the records and unit of the target parameter
+       of a data extractor"""
+    records = RecordTable.empty()
+    unit = "?"
+    if data_extractor.parameter_in_dataset():
+        records = data_extractor.get_records()
+        try:
+            unit = data_extractor.get_unit()
+        except KeyError:
+            unit = "?"
+    return records, unit
 
 
 def get_data(dataset, site, parameter, year, datadir):
@@ -442,32 +557,77 @@ def get_data(dataset, site, parameter, year, datadir):
     """
     csvfile = download_csvfile(datadir, dataset, site, year)
 
-    records = []
+    records = RecordTable.empty()
     unit = "?"
 
     if csvfile is not None:
         print(dataset)
-        if dataset == "wet_deposition":
-            data_extractor = EanetWetDataExtractor(csvfile, parameter)
-        else:
-            data_extractor = EanetDryDataExtractor(csvfile, parameter)
+        data_extractor = get_data_extractor(dataset, csvfile, parameter)
 
         if data_extractor.parameter_in_dataset():
             print("available products:")
             print(data_extractor.get_products())
-            records = data_extractor.get_records()
-            try:
-                unit = data_extractor.get_unit()
-            except KeyError:
-                unit = "?"
+            records, unit = extract_records(data_extractor)
         else:
             print(
                 '{} not found in data.\n'.format(parameter) +
                 'available products:'
             )
             print(data_extractor.get_products())
-            records = []
 
+    return create_obsdata(dataset, site, parameter, unit, records)
+
+
+def get_data_all_products(dataset, site, year, datadir, parameters):
+    """returns a list of ObsData, one for each of the parameters
+       found in the EANET csv file of a site and year.
+
+       The file is downloaded (if needed) and read once
+       for all parameters, parsed products are cached
+       next to the csv file
+    """
+    csvfile = download_csvfile(datadir, dataset, site, year)
+    if csvfile is None:
+        return []
+    return read_data_all_products(dataset, site, csvfile, parameters)
+
+
+def read_data_all_products(dataset, site, csvfile, parameters):
+    """returns a list of ObsData, one for each of the parameters
+       found in a downloaded EANET csv file of a site"""
+    data_extractors = []
+
+    def parse(parameter):
+        if not data_extractors:
+            data_extractors.append(
+                get_data_extractor(dataset, csvfile, parameter))
+            print("available products:")
+            print(data_extractors[0].get_products())
+        data_extractor = data_extractors[0]
+        data_extractor.set_parameter(parameter)
+        records, unit = extract_records(data_extractor)
+        return records, {
+            "unit": unit,
+            "found": data_extractor.parameter_in_dataset(),
+        }
+
+    list_of_data = []
+    for parameter in parameters:
+        records, attributes = cache.load_records(
+            csvfile,
+            parameter,
+            PARSER_VERSION,
+            lambda: parse(parameter)
+        )
+        if not attributes["found"]:
+            continue
+        list_of_data.append(create_obsdata(
+            dataset, site, parameter, attributes["unit"], records))
+    return list_of_data
+
+
+def create_obsdata(dataset, site, parameter, unit, records):
+    """returns an instance of ObsData"""
     eanet_site = get_site_info(site)
 
     return ObsData(
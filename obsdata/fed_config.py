@@ -1,6 +1,7 @@
 import os
 import csv
 from collections import namedtuple
+from datetime import datetime
 
 
 DATADIR = os.path.join(
@@ -31,6 +32,11 @@ ParameterInfo = namedtuple(
 )
 
 
+RequestPlan = namedtuple(
+    "RequestPlan", ["site_codes", "start_date", "end_date"]
+)
+
+
 DatasetConfig = namedtuple(
     "DatasetConfig",
     ["name", "time_interval", "site_file", "parameter_file"]
@@ -110,6 +116,88 @@ def get_all_site_codes(dataset_id):
     return site_codes
 
 
+def read_site_date(date):
+    '''returns a datetime of a start or end date of the site
+       file (e.g. 03/02/88), or None if the date is missing
+    '''
+    try:
+        return datetime.strptime(date.strip(), "%m/%d/%y")
+    except ValueError:
+        return None
+
+
+def get_site_coverages(dataset_id):
+    '''returns a dictionary with a tuple (start, end) of the
+       dates with data of each site code of the site file,
+       start or end is None if unknown
+    '''
+    coverages = {}
+    with open(datasets[dataset_id].site_file) as csv_file:
+        csv_reader = csv.reader(csv_file, delimiter=',')
+        for line_count, row in enumerate(csv_reader):
+            if line_count == 0:
+                continue
+            start = read_site_date(row[9])
+            end = read_site_date(row[10])
+            if row[1] in coverages:
+                # a site may be listed more than once
+                first_start, first_end = coverages[row[1]]
+                start = None if None in (start, first_start) else min(
+                    start, first_start)
+                end = None if None in (end, first_end) else max(
+                    end, first_end)
+            coverages[row[1]] = (start, end)
+    return coverages
+
+
+def is_covered(coverage, start_date, end_date):
+    '''returns true if the coverage (start, end) of a site
+       overlaps the time window start_date to end_date'''
+    start, end = coverage
+    return (
+        (start is None or start <= end_date) and
+        (end is None or end >= start_date)
+    )
+
+
+def plan_requests(
+        dataset_id, site_codes, windows, sites_per_request):
+    '''returns a tuple (plans, nr_of_avoided) where plans is a list
+       of RequestPlan of the sites with data in each time window
+       (start_date, end_date), in batches of at most sites_per_request
+       sites, and nr_of_avoided is the number of requests saved
+       compared to requesting all sites in every window.
+
+       The time window of a request is narrowed to the coverage of
+       its sites, as given by the site file.
+    '''
+    coverages = get_site_coverages(dataset_id)
+    nr_of_batches = -(-len(site_codes) // sites_per_request)
+    plans = []
+    for start_date, end_date in windows:
+        covered = [
+            site_code for site_code in site_codes
+            if is_covered(
+                coverages.get(site_code, (None, None)), start_date, end_date)
+        ]
+        for index in range(0, len(covered), sites_per_request):
+            batch = covered[index: index + sites_per_request]
+            starts = [coverages.get(code, (None, None))[0] for code in batch]
+            ends = [coverages.get(code, (None, None))[1] for code in batch]
+            plans.append(RequestPlan(
+                site_codes=batch,
+                start_date=(
+                    start_date if None in starts
+                    else max(start_date, min(starts))
+                ),
+                end_date=(
+                    end_date if None in ends
+                    else min(end_date, max(ends))
+                ),
+            ))
+    return plans, nr_of_batches * len(windows) - len(plans)
+
+
 def get_parameter_info(dataset_id, parameter_code):
     '''returns an instance of ParameterInfo
        as defined by the parameter file
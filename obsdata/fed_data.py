@@ -1,15 +1,25 @@
 from bs4 import BeautifulSoup
-from datetime import datetime
+from contextlib import contextmanager
 import csv
+from datetime import timedelta
+import io
 import json
-import requests  # type: ignore
+import numpy as np
 import os.path
+import pandas as pd
+import re
+import requests  # type: ignore
+import time
 
-from obsdata.save_data import ObsData, Record
+from obsdata import download, sessions
+from obsdata.save_data import ObsData, RecordTable
 
 
 def set_request_data(
         dataset_id, site_id, parameter_id, time_interval, start_date, end_date):
+    '''returns the form data of a RawDataReport2 request, site_id and
+       parameter_id may be lists to request many sites and parameters
+       in one report (see parse_fed_data_many)'''
     return {
         "agidse": 3 if time_interval == 'Annual' else 1,
         "dt": "{0}>{1}".format(
@@ -76,147 +86,527 @@ def get_login_payload():
     }
 
 
+login_url = 'http://views.cira.colostate.edu/fed/Auth/Login.aspx'
+
+
+def login(session):
+    """logs in a requests session on FED"""
+    login_payload = get_login_payload()
+    session.get(login_url)
+    p = session.post(login_url, data=login_payload, allow_redirects=False)
+    if not 'Set-Cookie' in p.headers or \
+           '.FED_Authentication' not in p.headers['Set-Cookie']:
+        print(
+            'not able to login on {},\n'.format(login_url) +
+            'are your credentials valid?'
+        )
+        exit(1)
+
+
+def is_expired(response):
+    """returns true if FED redirected the request to the login page"""
+    return response.url.startswith(login_url)
+
+
+def get_session():
+    """returns the FED session shared by all requests"""
+    return sessions.get_session("fed", login, is_expired)
+
+
+@contextmanager
+def open_report(request_data, ori_dir=None):
+    '''returns a text stream of a raw data report retrieved from the
+       Federal Land Manager Environmental Database
+       http://views.cira.colostate.edu/fed/QueryWizard/
+
+       The report is read from the response while downloaded,
+       if ori_dir is given the raw bytes are saved there on the fly
+    '''
+    session = get_session()
+    request_url = "http://views.cira.colostate.edu/fed/Reports/RawDataReport2.aspx"  # noqa
+    r = session.post(request_url, data=request_data)
+    soup = BeautifulSoup(r.content, 'html.parser')
+    link = soup.find("a")
+    if link is None:
+        # e.g. the report timed out on the server
+        raise ReportError("no report in response to {}".format(
+            request_data["dt"]))
+    href = link.get('href')
+    url_base = "http://views.cira.colostate.edu"
+    url_txt = url_base + href
+    r_txt = session.get(url_txt, stream=True)
+    filename = None
+    if ori_dir:
+        filename = os.path.join(ori_dir, os.path.basename(href))
+    with download.open_response(r_txt, filename) as stream:
+        yield stream
+
+
 def get_data(request_data, ori_dir=None):
     '''returns an instance of FedData where data are
        retrived from the
        Federal Land Manager Environmental Database
        http://views.cira.colostate.edu/fed/QueryWizard/
     '''
-    login_payload = get_login_payload()
-    with requests.Session() as session:
-        login_url = 'http://views.cira.colostate.edu/fed/Auth/Login.aspx'
-        session.get(login_url)
-        p = session.post(login_url, data=login_payload, allow_redirects=False)
-        if not 'Set-Cookie' in p.headers or \
-               '.FED_Authentication' not in p.headers['Set-Cookie']:
-            print(
-                'not able to login on {},\n'.format(login_url) +
-                'are your credentials valid?'
-            )
-            exit(1)
-        request_url = "http://views.cira.colostate.edu/fed/Reports/RawDataReport2.aspx"  # noqa
-        r = session.post(request_url, data=request_data)
-        soup = BeautifulSoup(r.content, 'html.parser')
-        link = soup.find("a")
-        href = link.get('href')
-        url_base = "http://views.cira.colostate.edu"
-        url_txt = url_base + href
-        r_txt = session.get(url_txt)
-        if ori_dir:
-            open(os.path.join(ori_dir, os.path.basename(href)), 'wb').write(
-                r_txt.content)
-        return parse_fed_data(r_txt.text)
+    with open_report(request_data, ori_dir=ori_dir) as stream:
+        return parse_report(stream)
 
 
-def status_flag_to_number(status_flag):
-    return [
-        "H1",  # Historical data that have not been assessed or validated
-        "I0",  # Invalid value - unknown reason
-        "I1",  # Invalid value - known reason
-        "I2",  # noqa Invalid value (-999), though sample-level flag seems valid (SEM)
-        "M1",  # Missing value because no value is available
-        "M2",  # Missing value because invalidated by data originator
-        "M3",  # Missing value due to clogged filter
-        "NA",  # Not available from source data
-        "V0",  # Valid value
-        "V1",  # noqa Valid value but comprised wholly or partially of below detection limit data
-        "V2",  # Valid estimated value
-        "V3",  # Valid interpolated value
-        "V4",  # noqa Valid value despite failing to meet some QC or statistical criteria
-        "V5",  # Valid value but qualified because of possible contamination
-        "V6",  # noqa Valid value but qualified due to non-standard sampling conditions
-        "V7",  # noqa Valid value set equal to the detection limit (DL) since the value was below the DL
-        "VM",  # Valid modeled value
-        "VS",  # Valid substituted value
-    ].index(status_flag)
+def get_data_many(request_data, ori_dir=None):
+    '''returns a list of FedData, one for each site and parameter
+       of a request for many sites and parameters'''
+    with open_report(request_data, ori_dir=ori_dir) as stream:
+        return parse_report_many(stream)
 
 
-def parse_fed_data(text):
-    '''returns an instance of FedData
+# estimated records per site and day of the frequencies of datasets.csv
+RECORDS_PER_DAY = {
+    "Hourly": 24,
+    "Daily": 1,
+    "Weekly": 1 / 7,
+    "2 weeks": 1 / 14,
+    "Annual": 1 / 365,
+    "Annual,Seasonal": 5 / 365,
+}
+TARGET_RECORDS = 100000  # rows of the data section of a report
+TARGET_SECONDS = 60  # duration of a request
+LATENCY_SECONDS = 5  # duration of a request apart from the transfer
+MIN_DAYS = 1
+
+
+class WindowSizer:
+    """Chooses the number of days of the time window of a request.
+
+       The first windows are sized from the frequency of the dataset,
+       then from the records per site and day and the records per
+       second observed in the responses. The records per second are
+       estimated from the duration of a request less its latency, and
+       responses that are mostly latency are not used for them, so
+       small responses do not shrink the windows. A failed request
+       halves the largest window used from then on.
+    """
+
+    def __init__(
+            self,
+            frequency,
+            target_records=TARGET_RECORDS,
+            target_seconds=TARGET_SECONDS,
+            latency=LATENCY_SECONDS):
+        self.records_per_day = RECORDS_PER_DAY.get(frequency, 1)
+        self.records_per_second = None
+        self.target_records = target_records
+        self.target_seconds = target_seconds
+        self.latency = latency
+        self.max_days = None
+
+    def get_days(self, nr_of_sites):
+        """returns the number of days of a window of nr_of_sites"""
+        target = self.target_records
+        if self.records_per_second is not None:
+            target = min(
+                target,
+                self.records_per_second * max(
+                    self.target_seconds - self.latency, 0))
+        days = int(target / (self.records_per_day * max(nr_of_sites, 1)))
+        if self.max_days is not None:
+            days = min(days, self.max_days)
+        return max(MIN_DAYS, days)
+
+    def update(self, nr_of_sites, days, nr_of_records, seconds):
+        """updates the estimates from a response of nr_of_records
+           rows of a window of nr_of_sites and days"""
+        if nr_of_records == 0:
+            # e.g. a gap in the data, says nothing about the rate
+            return
+        self.records_per_day = 0.5 * self.records_per_day + 0.5 * (
+            nr_of_records / (max(nr_of_sites, 1) * days))
+        # a request is never faster than its latency
+        self.latency = min(self.latency, seconds)
+        transfer_seconds = seconds - self.latency
+        if transfer_seconds < self.latency:
+            # mostly latency, says little about the rate
+            return
+        records_per_second = nr_of_records / transfer_seconds
+        if self.records_per_second is None:
+            self.records_per_second = records_per_second
+        else:
+            self.records_per_second = (
+                0.5 * self.records_per_second + 0.5 * records_per_second)
+
+    def fail(self, days):
+        """limits the windows after a failed window of days"""
+        self.max_days = max(MIN_DAYS, days // 2)
+
+
+class ReportError(Exception):
+    pass
+
+
+def get_data_adaptive(
+        dataset_id,
+        site_ids,
+        parameter_ids,
+        time_interval,
+        start_date,
+        end_date,
+        sizer=None,
+        ori_dir=None,
+        get_data=get_data_many):
+    '''returns a list of FedData, one for each site and parameter,
+       of the time range start_date to end_date.
+
+       The range is requested in windows sized by sizer (a
+       WindowSizer, shared by requests of the same dataset), a window
+       that fails is split in half and retried. The records of all
+       windows are merged into one FedData per site and parameter.
     '''
+    if sizer is None:
+        sizer = WindowSizer(time_interval)
+    merged = {}
+    windows = []  # stack of windows to retry, earliest last
+    date_i = start_date
+    while windows or date_i <= end_date:
+        if windows:
+            window_start, window_end = windows.pop()
+        else:
+            days = min(
+                sizer.get_days(len(site_ids)), (end_date - date_i).days + 1)
+            window_start = date_i
+            window_end = date_i + timedelta(days=days - 1)
+            date_i = window_end + timedelta(days=1)
+        days = (window_end - window_start).days + 1
+        request_data = set_request_data(
+            dataset_id, site_ids, parameter_ids, time_interval,
+            window_start, window_end)
+        time_start = time.perf_counter()
+        try:
+            list_of_data = get_data(request_data, ori_dir=ori_dir)
+        except (requests.RequestException, ReportError) as exception:
+            if days <= MIN_DAYS:
+                raise
+            print("request {} to {} failed ({}), splitting it".format(
+                window_start, window_end, exception))
+            sizer.fail(days)
+            middle = window_start + timedelta(days=days // 2 - 1)
+            windows.append((middle + timedelta(days=1), window_end))
+            windows.append((window_start, middle))
+            continue
+        nr_of_records = sum(len(data.records) for data in list_of_data)
+        sizer.update(
+            len(site_ids),
+            days,
+            nr_of_records / max(len(set(parameter_ids)), 1),
+            time.perf_counter() - time_start
+        )
+        for data in list_of_data:
+            key = (data.station_code, data.parameter_code)
+            merged.setdefault(key, []).append(data)
+    return [
+        list_of_data[0]._replace(records=RecordTable.concatenate(
+            [data.records for data in list_of_data]))
+        for list_of_data in merged.values()
+    ]
+
+
+STATUS_FLAGS = [
+    "H1",  # Historical data that have not been assessed or validated
+    "I0",  # Invalid value - unknown reason
+    "I1",  # Invalid value - known reason
+    "I2",  # noqa Invalid value (-999), though sample-level flag seems valid (SEM)
+    "M1",  # Missing value because no value is available
+    "M2",  # Missing value because invalidated by data originator
+    "M3",  # Missing value due to clogged filter
+    "NA",  # Not available from source data
+    "V0",  # Valid value
+    "V1",  # noqa Valid value but comprised wholly or partially of below detection limit data
+    "V2",  # Valid estimated value
+    "V3",  # Valid interpolated value
+    "V4",  # noqa Valid value despite failing to meet some QC or statistical criteria
+    "V5",  # Valid value but qualified because of possible contamination
+    "V6",  # noqa Valid value but qualified due to non-standard sampling conditions
+    "V7",  # noqa Valid value set equal to the detection limit (DL) since the value was below the DL
+    "VM",  # Valid modeled value
+    "VS",  # Valid substituted value
+]
+
+
+def status_flag_to_number(status_flag):
+    return STATUS_FLAGS.index(status_flag)
+
+
+def status_flags_to_numbers(status_flags):
+    """vectorized version of status_flag_to_number"""
+    numbers = pd.Categorical(status_flags, categories=STATUS_FLAGS).codes
+    if (numbers == -1).any():
+        raise ValueError("{} is not a valid status flag".format(
+            np.asarray(status_flags)[numbers == -1][0]))
+    return numbers
 
-    def get_row_nr(rows, string):
-        start_row_nr = [
-            row_nr for row_nr, row in enumerate(rows) if row == string
-        ][0] + 2
-        end_row_nr = start_row_nr + [
-            index for index, row in enumerate(rows[start_row_nr::]) if row == ''
-        ][0]
-        return (start_row_nr, end_row_nr)
-
-    def get_data_dict(rows):
-        datarows = list(csv.reader(rows, delimiter=';'))
-        datadict = {}
-        for column_nr in range(len(datarows[0])):
-            datadict[datarows[0][column_nr]] = [
-                row[column_nr] for index, row in enumerate(datarows)
-                if index > 0
-            ]
-        return datadict
-
-    def get_records(rows):
-        records = []
-        for row_nr, row in enumerate(csv.reader(rows, delimiter=';')):
-            if row_nr == 0:
-                date_index = row.index('Date')
-                value_index = row.index('_Val')
-                unc_index = row.index('_Unc')
-                status_index = row.index('_StatusFlag')
-            else:
-                try:
-                    date_i = datetime.strptime(
-                        row[date_index], '%m/%d/%Y %H:%M:%S')
-                except ValueError:
-                    date_i = datetime.strptime(
-                        row[date_index], '%m/%d/%Y')
-
-                records.append(Record(
-                    start_datetime=date_i,
-                    end_datetime=-999,
-                    value=float(row[value_index]),
-                    uncertainty=float(row[unc_index]),
-                    status=status_flag_to_number(row[status_index]),
-                    status_flag=row[status_index],
-                    nr_of_samples=-999
-                ))
-        return records
-
-    rows = text.replace("\r", '').split("\n")
-
-    data = {}
-    for item in ["Datasets", "Sites", "Parameters", "Status Flags"]:
-        (start_row_nr, end_row_nr) = get_row_nr(rows, item)
-        data[item.lower()] = get_data_dict(
-            rows[start_row_nr: end_row_nr])
-
-    (start_row_nr, end_row_nr) = get_row_nr(rows, "Data")
-    records = get_records(rows[start_row_nr: end_row_nr])
 
+def get_datetimes(dates):
+    """returns datetimes of dates formatted as %m/%d/%Y or
+       %m/%d/%Y %H:%M:%S, invalid dates raise a ValueError"""
+    dates = pd.Series(dates, dtype=object)
+    try:
+        return pd.to_datetime(
+            dates, format="%m/%d/%Y", errors="raise").values
+    except ValueError:
+        pass
+    datetimes = pd.to_datetime(
+        dates, format="%m/%d/%Y %H:%M:%S", errors="coerce")
+    missing = datetimes.isnull()
+    if missing.any():
+        datetimes[missing] = pd.to_datetime(
+            dates[missing], format="%m/%d/%Y", errors="raise")
+    return datetimes.values
+
+
+# names of the data columns of a parameter, e.g. OCf:Value or OCf_Val
+DATA_COLUMNS = {
+    "value": ["Value", "Val"],
+    "uncertainty": ["Unc"],
+    "status_flag": ["StatusFlag"],
+}
+
+# sections of a report, the data section is the last section
+SECTIONS = ["Datasets", "Sites", "Parameters", "Status Flags", "Data"]
+METADATA_SECTIONS = SECTIONS[:-1]
+
+# rows of the data section parsed at a time
+CHUNK_ROWS = 100000
+
+
+def index_sections(text, names=SECTIONS):
+    '''returns a dictionary with the (start, end) positions in the
+       text of each section (header row and rows), the sections
+       are located in a single pass over the lines of the text'''
+    sections = {}
+    pattern = re.compile(
+        r"^({})\r?\n\r?\n".format("|".join(names)), re.MULTILINE)
+    for match in pattern.finditer(text):
+        name = match.group(1)
+        if name in sections:
+            continue
+        start = match.end()
+        end = re.compile(r"\n\r?\n").search(text, start)
+        sections[name] = (start, len(text) if end is None else end.start())
+        if len(sections) == len(names):
+            break
+    for name in names:
+        if name not in sections:
+            raise ValueError("section {} not found".format(name))
+    return sections
+
+
+def get_data_dict(rows):
+    datarows = list(csv.reader(rows, delimiter=';'))
+    datadict = {}
+    for column_nr in range(len(datarows[0])):
+        datadict[datarows[0][column_nr]] = [
+            row[column_nr] for index, row in enumerate(datarows)
+            if index > 0
+        ]
+    return datadict
+
+
+def is_used_column(header):
+    '''returns true for the columns of the data section
+       needed for the records'''
+    return header in ["SiteCode", "Date"] or any(
+        header.endswith(separator + name)
+        for separator in [":", "_"]
+        for names in DATA_COLUMNS.values()
+        for name in names
+    )
+
+
+def read_data_section(buffer, chunksize=CHUNK_ROWS):
+    '''returns an iterator over the data section (a file-like object
+       positioned at the header row) as dataframes of strings of at
+       most chunksize rows'''
+    return pd.read_csv(
+        buffer,
+        sep=";",
+        dtype=str,
+        usecols=is_used_column,
+        keep_default_na=False,  # NA is a status flag
+        skip_blank_lines=True,
+        chunksize=chunksize,
+    )
+
+
+def get_column(headers, parameter_code, column):
+    '''returns the name of a data column (value, uncertainty or
+       status_flag) of a parameter, the column is named after
+       the parameter code (e.g. OCf:Value) in reports of many
+       parameters and without code (e.g. :Value) otherwise'''
+    for prefix in [parameter_code, ""]:
+        for separator in [":", "_"]:
+            for name in DATA_COLUMNS[column]:
+                header = prefix + separator + name
+                if header in headers:
+                    return header
+    raise ValueError(
+        "no {} column of {} in {}".format(
+            column, parameter_code, list(headers)))
+
+
+def get_records(data, parameter_code=""):
+    '''returns the records of a parameter from the
+       data section (as returned by read_data_section)'''
+    headers = data.columns
+    status_flags = data[
+        get_column(headers, parameter_code, "status_flag")].to_numpy()
+    nr_of_records = len(data)
+    return RecordTable(
+        start_datetime=get_datetimes(data["Date"]),
+        end_datetime=np.full(nr_of_records, np.datetime64("NaT")),
+        value=data[
+            get_column(headers, parameter_code, "value")
+        ].to_numpy().astype("f8"),
+        uncertainty=data[
+            get_column(headers, parameter_code, "uncertainty")
+        ].to_numpy().astype("f8"),
+        status=status_flags_to_numbers(status_flags),
+        status_flag=status_flags,
+        nr_of_samples=np.full(nr_of_records, -999),
+    )
+
+
+def read_metadata(stream):
+    '''returns a dictionary of the metadata sections of a report,
+       the stream is left positioned at the header row of the
+       data section'''
+    lines = []
+    for line in iter(stream.readline, ""):
+        if line.rstrip("\r\n") == "Data":
+            break
+        lines.append(line)
+    else:
+        raise ValueError("section Data not found")
+    stream.readline()  # the blank line after the section title
+    text = "".join(lines)
+    sections = index_sections(text, names=METADATA_SECTIONS)
+    metadata = {}
+    for name in METADATA_SECTIONS:
+        start, end = sections[name]
+        metadata[name.lower()] = get_data_dict(
+            text[start:end].replace("\r", "").split("\n"))
+    return metadata
+
+
+def create_obsdata(metadata, site_nr, parameter_nr, records):
+    '''returns an instance of FedData of a site and
+       parameter of the metadata sections'''
     return ObsData(
         data_version="",  # FIXME
-        station_name=data["sites"]["Site"][0],
-        station_code=data["sites"]["Code"][0],
+        station_name=metadata["sites"]["Site"][site_nr],
+        station_code=metadata["sites"]["Code"][site_nr],
         station_category="global",
         observation_category=(
             "Air sampling observation at a stationary platform"
         ),
         country_territory="",  # empty should be ok
-        contributor=data["datasets"]["Dataset"][0].split(' ')[0].lower(),
-        latitude=data["sites"]["Latitude"][0],
-        longitude=data["sites"]["Longitude"][0],
-        altitude=data["sites"]["Elevation"][0],
+        contributor=metadata["datasets"]["Dataset"][0].split(' ')[0].lower(),
+        latitude=metadata["sites"]["Latitude"][site_nr],
+        longitude=metadata["sites"]["Longitude"][site_nr],
+        altitude=metadata["sites"]["Elevation"][site_nr],
         nr_of_sampling_heights="1",
         sampling_heights="",  # empty should be ok
         contact_point="nmhyslop@ucdavis.edu",
-        dataset=data["datasets"]["Dataset"][0],
-        parameter=data["parameters"]["Parameter"][0],
-        parameter_code=data["parameters"]["Code"][0],
-        time_interval=data["datasets"]["Frequency"][0].lower(),
-        measurement_unit=data["parameters"]["Units"][0].replace("Âµ", 'u'),
+        dataset=metadata["datasets"]["Dataset"][0],
+        parameter=metadata["parameters"]["Parameter"][parameter_nr],
+        parameter_code=metadata["parameters"]["Code"][parameter_nr],
+        time_interval=metadata["datasets"]["Frequency"][0].lower(),
+        measurement_unit=metadata["parameters"]["Units"][
+            parameter_nr].replace("Âµ", 'u'),
         measurement_method="",  # empty should be ok
         sampling_type="continuous",
         time_zone="UTC",
         measurement_scale="",  # empty should be ok
-        status_flags=data["status flags"],
+        status_flags=metadata["status flags"],
         records=records
     )
+
+
+def parse_report(stream, chunksize=CHUNK_ROWS):
+    '''returns an instance of FedData of a report stream,
+       the data section is parsed in chunks of rows
+    '''
+    metadata = read_metadata(stream)
+    parameter_code = metadata["parameters"]["Code"][0]
+    records = RecordTable.concatenate([
+        get_records(data, parameter_code=parameter_code)
+        for data in read_data_section(stream, chunksize=chunksize)
+    ])
+    return create_obsdata(metadata, 0, 0, records)
+
+
+def parse_report_many(stream, chunksize=CHUNK_ROWS):
+    '''returns a list of FedData, one for each site and parameter
+       of a report stream of many sites and parameters, the data
+       section is parsed in chunks of rows
+    '''
+    metadata = read_metadata(stream)
+    keys = get_site_parameter_nrs(metadata)
+    records = {key: [] for key in keys}
+    for data in read_data_section(stream, chunksize=chunksize):
+        for key, chunk_records in split_records(metadata, keys, data):
+            records[key].append(chunk_records)
+    return [
+        create_obsdata(
+            metadata, site_nr, parameter_nr,
+            RecordTable.concatenate(records[(site_nr, parameter_nr)])
+        )
+        for site_nr, parameter_nr in keys
+    ]
+
+
+def parse_fed_data(text):
+    '''returns an instance of FedData
+    '''
+    return parse_report(io.StringIO(text))
+
+
+def parse_fed_data_many(text):
+    '''returns a list of FedData, one for each site and parameter
+       of a report of many sites and parameters, the data rows
+       are split by site code and data columns by parameter code
+    '''
+    return parse_report_many(io.StringIO(text))
+
+
+def get_site_parameter_nrs(metadata):
+    '''returns a list of (site_nr, parameter_nr), one for each
+       site and parameter of the metadata'''
+    # a parameter may be listed more than once
+    parameter_codes = metadata["parameters"]["Code"]
+    parameter_nrs = [
+        parameter_codes.index(code)
+        for code in dict.fromkeys(parameter_codes)
+    ]
+    return [
+        (site_nr, parameter_nr)
+        for site_nr in range(len(metadata["sites"]["Code"]))
+        for parameter_nr in parameter_nrs
+    ]
+
+
+def split_records(metadata, keys, data):
+    '''returns a list of ((site_nr, parameter_nr), records) from
+       rows of the data section split by site code, sites
+       without rows are left out'''
+    site_codes = metadata["sites"]["Code"]
+    parameter_codes = metadata["parameters"]["Code"]
+    rows_of_sites = data.groupby("SiteCode", sort=False).indices
+    return [
+        (
+            (site_nr, parameter_nr),
+            get_records(
+                data.iloc[rows_of_sites[site_codes[site_nr]]],
+                parameter_code=parameter_codes[parameter_nr]
+            )
+        )
+        for site_nr, parameter_nr in keys
+        if site_codes[site_nr] in rows_of_sites
+    ]
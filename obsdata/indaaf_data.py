@@ -1,12 +1,14 @@
 from bs4 import BeautifulSoup
-from datetime import datetime
 from urllib3.exceptions import InsecureRequestWarning
 import json
+import numpy as np
 import os
 import pandas as pd
 import requests  # type: ignore
 
-from obsdata.save_data import ObsData, Record
+from obsdata import sessions
+from obsdata.download import print_stats, save_response
+from obsdata.save_data import ObsData, RecordTable
 
 
 url_base = "https://indaaf.sedoo.fr"
@@ -32,81 +34,93 @@ def get_login_payload():
     }
 
 
-def get_csv_file(
-        dataset_id, site_id, parameter_id, out_filename):
-    """retrieves a csv file form indaaf and returns True
-       or False on success or failure"""
+def login(session):
+    """logs in a requests session on INDAAF"""
     login_payload = get_login_payload()
 
     requests.packages.urllib3.disable_warnings(
         category=InsecureRequestWarning)
 
-    with requests.Session() as session:
-        p = session.post(
-            login_url,
-            data=login_payload,
-            verify=False
-        )
-        if "Create an account" in p.text:
-            print(
-                'not able to login on {},\n'.format(login_url) +
-                'is your credentials valid?'
-            )
-            exit(0)
-
-        url_download = url_base + "/download/{}/{}/{}".format(
-            dataset_id, site_id, parameter_id
+    p = session.post(
+        login_url,
+        data=login_payload,
+        verify=False
+    )
+    if "Create an account" in p.text:
+        print(
+            'not able to login on {},\n'.format(login_url) +
+            'is your credentials valid?'
         )
+        exit(0)
 
-        r = session.get(url_download, verify=True)
-        soup = BeautifulSoup(r.content, 'html.parser')
-        link = soup.find("a", id="dl_button_1")
-        try:
-            href = link.get('href')
-        except AttributeError:
-            print("Data not available.")
-            return False
-        url_download_csv = url_base + href
-        r = session.get(url_download_csv)
-        # save csvdata locally
-        with open(out_filename, 'wb') as f:
-            for chunk in r.iter_content():
-                chunk = chunk.replace(b'\x83', b'')
-                chunk = chunk.replace(b'\xCA', b'u')
-                f.write(chunk)
-        return True
+
+def is_expired(response):
+    """returns true if INDAAF responded with the login page,
+       the body is only read for html pages, so that e.g. streamed
+       csv downloads are not read into memory"""
+    if "html" not in response.headers.get("Content-Type", ""):
+        return False
+    return "Create an account" in response.text
+
+
+def get_session():
+    """returns the INDAAF session shared by all requests"""
+    return sessions.get_session("indaaf", login, is_expired)
+
+
+def get_csv_file(
+        dataset_id, site_id, parameter_id, out_filename):
+    """retrieves a csv file form indaaf and returns True
+       or False on success or failure"""
+    session = get_session()
+
+    url_download = url_base + "/download/{}/{}/{}".format(
+        dataset_id, site_id, parameter_id
+    )
+
+    r = session.get(url_download, verify=True)
+    soup = BeautifulSoup(r.content, 'html.parser')
+    link = soup.find("a", id="dl_button_1")
+    try:
+        href = link.get('href')
+    except AttributeError:
+        print("Data not available.")
+        return False
+    url_download_csv = url_base + href
+    r = session.get(url_download_csv, stream=True)
+    # save csvdata locally
+    print_stats(save_response(
+        r,
+        out_filename,
+        translation=bytes.maketrans(b'\xCA', b'u'),
+        delete=b'\x83'
+    ))
+    return True
 
 
 def get_site_info(site_id):
     """scrapes an indaaf web-page on site info"""
-    login_payload = get_login_payload()
-
     url_site = url_base + "/catalog/site/{}".format(site_id)
-    requests.packages.urllib3.disable_warnings(
-        category=InsecureRequestWarning)
 
-    with requests.Session() as session:
-        session.post(
-            login_url, data=login_payload, verify=False)
-        r = session.get(url_site)
-
-        soup = BeautifulSoup(r.content, 'html.parser')
-        table = soup.find_all("table")
-        data = []
-        for row in table[0].findAll("tr"):
-            try:
-                cols = [ele.text.strip() for ele in row]
-                data.append(cols)
-            except AttributeError:
-                pass
-        for row in table[1].findAll("tr"):
-            try:
-                cols = [ele.text.strip() for ele in row]
-                data.append(cols)
-            except AttributeError:
-                pass
-        headers = [row[0] for row in data]
-        values = [row[1] for row in data]
+    r = get_session().get(url_site)
+
+    soup = BeautifulSoup(r.content, 'html.parser')
+    table = soup.find_all("table")
+    data = []
+    for row in table[0].findAll("tr"):
+        try:
+            cols = [ele.text.strip() for ele in row]
+            data.append(cols)
+        except AttributeError:
+            pass
+    for row in table[1].findAll("tr"):
+        try:
+            cols = [ele.text.strip() for ele in row]
+            data.append(cols)
+        except AttributeError:
+            pass
+    headers = [row[0] for row in data]
+    values = [row[1] for row in data]
     return headers, values
 
 
@@ -135,26 +149,21 @@ def create_indaaf_sites_file():
 
 def get_parameter_info(parameter_id):
     """scrapes an indaaf web-page on parameter info"""
-    login_payload = get_login_payload()
-
     url_parameter = url_base + "/catalog/param/{}".format(
         parameter_id)
 
-    with requests.Session() as session:
-        session.post(
-            login_url, data=login_payload, verify=False)
-        r = session.get(url_parameter)
-        soup = BeautifulSoup(r.content, 'html.parser')
-        table = soup.find_all("table")
-        data = []
-        for row in table[0].findAll("tr"):
-            try:
-                cols = [ele.text.strip() for ele in row]
-                data.append(cols)
-            except AttributeError:
-                pass
-        headers = [row[0] for row in data]
-        values = [row[1] for row in data]
+    r = get_session().get(url_parameter)
+    soup = BeautifulSoup(r.content, 'html.parser')
+    table = soup.find_all("table")
+    data = []
+    for row in table[0].findAll("tr"):
+        try:
+            cols = [ele.text.strip() for ele in row]
+            data.append(cols)
+        except AttributeError:
+            pass
+    headers = [row[0] for row in data]
+    values = [row[1] for row in data]
     return headers, values
 
 
@@ -182,31 +191,34 @@ def create_indaaf_parameters_file():
     )
 
 
+def get_datetimes(dates):
+    """parses dates given either as YYYY-MM-DD or
+       YYYY-MM-DD HH:MM:SS"""
+    datetimes = pd.to_datetime(dates, format="%Y-%m-%d", errors="coerce")
+    with_time = datetimes.isna()
+    if with_time.any():
+        datetimes[with_time] = pd.to_datetime(
+            dates[with_time], format="%Y-%m-%d %H:%M:%S")
+    return datetimes.values
+
+
 def get_records(
         csv_file, parameter, site_info, parameter_info, dataset_info):
     """parse indaaf csv file and returns an instance of ObsData
     """
     df = pd.read_csv(csv_file, skiprows=19, delimiter=';')
-    records = []
     target_parameter = df.columns[1]
-    for _, row in df.iterrows():
-        try:
-            start_datetime = datetime.strptime(
-                    row["Date"], "%Y-%m-%d")
-        except ValueError:
-            start_datetime = datetime.strptime(
-                    row["Date"], "%Y-%m-%d %H:%M:%S")
-        records.append(
-            Record(
-                start_datetime=start_datetime,
-                end_datetime=-9999,
-                value=row[target_parameter],
-                uncertainty=-999,
-                status=-999,
-                status_flag=-999,
-                nr_of_samples=-999,
-            )
-        )
+    nr_of_records = len(df)
+    records = RecordTable(
+        start_datetime=get_datetimes(df["Date"]),
+        end_datetime=np.full(nr_of_records, np.datetime64("NaT")),
+        value=df[target_parameter].values,
+        uncertainty=np.full(nr_of_records, -999),
+        status=np.full(nr_of_records, -999),
+        status_flag=np.full(nr_of_records, -999),
+        nr_of_samples=np.full(nr_of_records, -999),
+        missing_end_datetime=-9999,
+    )
     return ObsData(
         data_version="?",
         station_name=site_info.site,
@@ -1,7 +1,14 @@
 from collections import namedtuple
-from netCDF4 import Dataset, date2num
+from datetime import datetime
+from netCDF4 import Dataset, stringtochar
+from urllib.parse import quote
+import json
 import os
 import numpy as np
+import pandas as pd
+import pyarrow as pa  # type: ignore
+import pyarrow.compute as pc  # type: ignore
+import pyarrow.parquet as pq  # type: ignore
 from dateutil.relativedelta import relativedelta  # type: ignore
 
 
@@ -50,22 +57,214 @@ Record = namedtuple(
 )
 
 
+RECORD_COLUMNS = Record._fields
+
+
 class NotImplementedError(Exception):
     pass
 
 
+class RecordTable:
+    """A columnar container of records.
+
+       Each field of Record is stored as a column (numpy arrays for
+       datetimes and numbers, a categorical for the status flag),
+       so that a long time series is held in a few arrays instead of
+       one Record per sample. Indexing with an integer and iterating
+       yields Record tuples, so code written for a list of records
+       keeps working.
+    """
+
+    def __init__(
+            self,
+            start_datetime,
+            end_datetime,
+            value,
+            uncertainty,
+            status,
+            status_flag,
+            nr_of_samples,
+            missing_end_datetime=-999):
+        self.start_datetime = np.asarray(
+            start_datetime, dtype="datetime64[s]")
+        self.end_datetime = np.asarray(end_datetime, dtype="datetime64[s]")
+        self.value = np.asarray(value, dtype="f8")
+        self.uncertainty = np.asarray(uncertainty, dtype="f8")
+        self.status = np.asarray(status, dtype="i8")
+        self.status_flag = (
+            status_flag if isinstance(status_flag, pd.Categorical)
+            else pd.Categorical(status_flag)
+        )
+        self.nr_of_samples = np.asarray(nr_of_samples, dtype="i8")
+        # value returned by the Record view when end datetime is not set
+        self.missing_end_datetime = missing_end_datetime
+        for column in RECORD_COLUMNS:
+            if not len(getattr(self, column)) == len(self.start_datetime):
+                raise ValueError(
+                    "column {} has unexpected length".format(column))
+
+    @classmethod
+    def from_records(cls, records):
+        """returns an instance of RecordTable from a list of Record"""
+        if isinstance(records, cls):
+            return records
+        missing_end_datetime = -999
+        end_datetimes = []
+        for record in records:
+            if isinstance(record.end_datetime, datetime):
+                end_datetimes.append(record.end_datetime)
+            else:
+                missing_end_datetime = record.end_datetime
+                end_datetimes.append(None)
+        return cls(
+            start_datetime=[record.start_datetime for record in records],
+            end_datetime=np.array(end_datetimes, dtype="datetime64[s]"),
+            value=[record.value for record in records],
+            uncertainty=[record.uncertainty for record in records],
+            status=[record.status for record in records],
+            status_flag=[record.status_flag for record in records],
+            nr_of_samples=[record.nr_of_samples for record in records],
+            missing_end_datetime=missing_end_datetime,
+        )
+
+    @classmethod
+    def empty(cls):
+        """returns a RecordTable without records"""
+        return cls.from_records([])
+
+    @classmethod
+    def concatenate(cls, tables):
+        """returns a RecordTable with the records of all tables"""
+        tables = [cls.from_records(table) for table in tables]
+        if len(tables) == 0:
+            return cls.empty()
+        return cls(
+            start_datetime=np.concatenate(
+                [table.start_datetime for table in tables]),
+            end_datetime=np.concatenate(
+                [table.end_datetime for table in tables]),
+            value=np.concatenate([table.value for table in tables]),
+            uncertainty=np.concatenate(
+                [table.uncertainty for table in tables]),
+            status=np.concatenate([table.status for table in tables]),
+            status_flag=np.concatenate([
+                np.asarray(table.status_flag, dtype=object)
+                for table in tables
+            ]),
+            nr_of_samples=np.concatenate(
+                [table.nr_of_samples for table in tables]),
+            missing_end_datetime=tables[0].missing_end_datetime,
+        )
+
+    def __len__(self):
+        return len(self.start_datetime)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self._get_record(index)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            if key < 0:
+                key += len(self)
+            if not 0 <= key < len(self):
+                raise IndexError("record index out of range")
+            return self._get_record(key)
+        return RecordTable(
+            start_datetime=self.start_datetime[key],
+            end_datetime=self.end_datetime[key],
+            value=self.value[key],
+            uncertainty=self.uncertainty[key],
+            status=self.status[key],
+            status_flag=self.status_flag[key],
+            nr_of_samples=self.nr_of_samples[key],
+            missing_end_datetime=self.missing_end_datetime,
+        )
+
+    def _get_record(self, index):
+        end_datetime = self.end_datetime[index]
+        return Record(
+            start_datetime=self.start_datetime[index].astype(datetime),
+            end_datetime=(
+                self.missing_end_datetime if np.isnat(end_datetime)
+                else end_datetime.astype(datetime)
+            ),
+            value=float(self.value[index]),
+            uncertainty=float(self.uncertainty[index]),
+            status=int(self.status[index]),
+            status_flag=self.status_flag[index],
+            nr_of_samples=int(self.nr_of_samples[index]),
+        )
+
+    def to_records(self):
+        """returns the records as a list of Record"""
+        return list(self)
+
+    def is_sorted(self):
+        """returns true if records are sorted on start datetime"""
+        return bool(
+            np.all(self.start_datetime[1:] >= self.start_datetime[:-1]))
+
+
 def date_filter_records(date_start, date_end, records):
-    """filter records on time"""
-    start_datetimes = np.array(
-        [record.start_datetime for record in records]
-    )
+    """filter records on time
+
+       For a RecordTable sorted on start datetime the records
+       are located by binary search and a view (no copy) of
+       the table is returned.
+    """
+    if isinstance(records, RecordTable):
+        date_start = np.datetime64(date_start, "s")
+        date_end = np.datetime64(date_end, "s")
+        if records.is_sorted():
+            first, last = np.searchsorted(
+                records.start_datetime, [date_start, date_end], side="left")
+            return records[first:last]
+        start_datetimes = records.start_datetime
+    else:
+        start_datetimes = np.array(
+            [record.start_datetime for record in records]
+        )
     indexes = np.nonzero(
         (start_datetimes >= date_start) &
         (start_datetimes < date_end)
     )[0]
+    if isinstance(records, RecordTable):
+        return records[indexes]
     return [records[index] for index in indexes]
 
 
+def split_records(records, period="year"):
+    """splits records into one RecordTable per year or month
+       in a single pass and returns a list of
+       (start of period, RecordTable) tuples,
+       periods without records are not included.
+
+       The returned tables are views of records
+       if records are sorted on start datetime.
+    """
+    units = {"year": "Y", "month": "M"}
+    if period not in units:
+        raise ValueError("period must be one of {}".format(list(units)))
+    records = RecordTable.from_records(records)
+    if not records.is_sorted():
+        records = records[np.argsort(records.start_datetime, kind="stable")]
+    periods = records.start_datetime.astype(
+        "datetime64[{}]".format(units[period]))
+    starts = np.concatenate((
+        [0], np.flatnonzero(periods[1:] != periods[:-1]) + 1
+    )).astype(int)
+    ends = np.append(starts[1:], len(records)).astype(int)
+    return [
+        (
+            periods[start].astype("datetime64[s]").astype(datetime),
+            records[start:end]
+        )
+        for start, end in zip(starts, ends)
+        if end > start
+    ]
+
+
 def get_output_filename(data, extension):
     '''returns a filename conating the follwing parts
 
@@ -241,46 +440,76 @@ def save_data_txt(out_dir, data):
         os.makedirs(out_dir)
 
     with open(os.path.join(out_dir, file_name), mode='wb') as outfile:
-        for row in file_header_rows:
-            print(row)
-            outfile.write("{}\n".format(row).encode("ascii"))
+        outfile.write(
+            "".join(
+                "{}\n".format(row) for row in file_header_rows
+            ).encode("ascii")
+        )
+        outfile.write(format_records_txt(data.records).encode("ascii"))
 
-        for record in data.records:
 
-            value = record.value if not record.value == -999 else -99999.999
+def format_datetimes_txt(datetimes):
+    """returns a list of datetimes formatted as 'YYYY-mm-dd HH:MM',
+       missing datetimes (NaT) are formatted as '9999-99-99 99:99'
+    """
+    return [
+        "9999-99-99 99:99" if datetime_str == "NaT"
+        else datetime_str.replace("T", " ")
+        for datetime_str in np.datetime_as_string(
+            datetimes, unit="m").tolist()
+    ]
 
-            unc = (
-                record.uncertainty if not record.uncertainty == -999
-                else -999.99
-            )
 
-            status_flag = record.status if not record.status == -999 else -9999
+def format_records_txt(records):
+    """returns the data-records of the 'World Data Centre' format
+       as a single string, the columns are formatted one at a time
+       instead of record by record
+    """
+    records = RecordTable.from_records(records)
+
+    value = np.where(records.value == -999, -99999.999, records.value)
+    unc = np.where(records.uncertainty == -999, -999.99, records.uncertainty)
+    status_flag = np.where(records.status == -999, -9999, records.status)
+    nr_of_samples = np.where(
+        records.nr_of_samples == -999, -9999, records.nr_of_samples)
+
+    columns = [
+        format_datetimes_txt(records.start_datetime),
+        format_datetimes_txt(records.end_datetime),
+        ["%10.3f" % x for x in value.tolist()],
+        ["%5d" % x for x in nr_of_samples.tolist()],
+        ["%7.2f" % x for x in unc.tolist()],
+        ["%5d" % x for x in status_flag.tolist()],
+        ["-9"] * len(records),
+        ["-99999999"] * len(records),
+    ]
+    return "".join("{}\n".format(row) for row in map(" ".join, zip(*columns)))
 
-            nr_of_samples = (
-                record.nr_of_samples if not record.nr_of_samples == -999
-                else -9999
-            )
 
-            try:
-                end_datetime = record.end_datetime.strftime("%Y-%m-%d %H:%M")
-            except AttributeError:
-                end_datetime = "9999-99-99 99:99"
-
-            outfile.write(
-                "{0} {1} {2} {3} {4} {5} {6} {7}\n".format(
-                    record.start_datetime.strftime("%Y-%m-%d %H:%M"),
-                    end_datetime,
-                    "{:10.3f}".format(value),
-                    "{:5}".format(nr_of_samples),
-                    "{:7.2f}".format(unc),
-                    "{:5}".format(status_flag),
-                    "-9",
-                    "-99999999",
-                ).encode("ascii")
-            )
+def datetimes_to_days_since(datetimes, reference="1900-01-01"):
+    """returns the number of days since reference for an array of
+       datetime64, computed in one pass over the array"""
+    return (
+        (datetimes - np.datetime64(reference, "s")) /
+        np.timedelta64(1, "D")
+    )
 
 
-def save_data_netcdf(out_dir, data):
+def save_data_netcdf(
+        out_dir,
+        data,
+        zlib=False,
+        complevel=4,
+        shuffle=True,
+        chunksize=None,
+        value_dtype="f8"):
+    """saves data in a netCDF4 file
+
+       zlib, complevel and shuffle control the compression of
+       the variables, chunksize the chunk size along time
+       (netCDF default chunking if None), and value_dtype
+       the storage type of value and uncertainty ("f8" or "f4")
+    """
 
     # TODO: fix format (talk to dave)
 
@@ -290,6 +519,8 @@ def save_data_netcdf(out_dir, data):
     if not os.path.exists(out_dir):
         os.makedirs(out_dir)
 
+    records = RecordTable.from_records(data.records)
+
     dataset = Dataset(output_file, "w", format="NETCDF4")
 
     # global attributes
@@ -301,42 +532,52 @@ def save_data_netcdf(out_dir, data):
 
     # dimensions
 
-    timedim = dataset.createDimension("time", len(data.records))
+    timedim = dataset.createDimension("time", len(records))
     if not data.status_flags == "?":
         chardim = dataset.createDimension('nchar', 2)
 
+    variable_options = {
+        "zlib": zlib,
+        "complevel": complevel,
+        "shuffle": shuffle,
+    }
+    if chunksize is not None and len(records) > 0:
+        variable_options["chunksizes"] = (min(chunksize, len(records)),)
+
     # time
 
-    time = dataset.createVariable("time", "f8", (timedim.name,))
+    time = dataset.createVariable(
+        "time", "f8", (timedim.name,), **variable_options)
     time.standard_name = "time"
     time.long_name = "time of measurement"
     time.units = "days since 1900-01-01 00:00:00 UTC"
     time.calendar = "gregorian"
-    time[:] = [
-        date2num(record.start_datetime, time.units, calendar=time.calendar)
-        for record in data.records
-    ]
+    time[:] = datetimes_to_days_since(records.start_datetime)
 
     parameter = dataset.createVariable(
-        data.parameter_code, "f8", (timedim.name,), fill_value=-9999.)
+        data.parameter_code, value_dtype, (timedim.name,),
+        fill_value=-9999., **variable_options)
     parameter.standard_name = data.parameter
-    parameter.missing_value = -999
+    parameter.missing_value = np.array(-999, dtype=value_dtype)
     parameter.units = data.measurement_unit
-    parameter[:] = [record.value for record in data.records]
+    parameter[:] = records.value
 
     # uncertainty
 
     parameter = dataset.createVariable(
-        "Unc", "f8", (timedim.name,), fill_value=-9999.)
+        "Unc", value_dtype, (timedim.name,),
+        fill_value=-9999., **variable_options)
     parameter.standard_name = "Uncertainty"
-    parameter.missing_value = -999
+    parameter.missing_value = np.array(-999, dtype=value_dtype)
     parameter.units = data.measurement_unit
-    parameter[:] = [record.uncertainty for record in data.records]
+    parameter[:] = records.uncertainty
 
     # status flag
     if not data.status_flags == "?":
+        if "chunksizes" in variable_options:
+            variable_options["chunksizes"] += (2,)
         parameter = dataset.createVariable(
-            "SF", "c", (timedim.name, chardim.name))
+            "SF", "c", (timedim.name, chardim.name), **variable_options)
         parameter.standard_name = "StatusFlag"
         description = ""
         for index in range(len(data.status_flags['Status Flag'])):
@@ -344,7 +585,345 @@ def save_data_netcdf(out_dir, data):
                 data.status_flags["Status Flag"][index],
                 data.status_flags["Description"][index],
             )
-        parameter[:] = [
-            record.status_flag for record in data.records]
+        parameter[:] = stringtochar(
+            np.asarray(records.status_flag, dtype="S2"))
 
     dataset.close()
+
+
+def save_data_netcdf_stations(
+        output_file,
+        list_of_data,
+        zlib=True,
+        complevel=4,
+        chunksize=1024):
+    """saves many instances of ObsData in a single netCDF4 file
+
+       Stations are stored along a 'station' dimension (with
+       station_code, station_name, latitude, longitude and altitude
+       variables) and all records share a 'time' dimension,
+       each parameter is stored in a (station, time) variable
+       together with its uncertainty and status.
+
+       If output_file already exists data are appended to it,
+       new stations, times and parameters are added and existing
+       values at the same station and time are overwritten.
+       The time axis is kept sorted, if new times are earlier than
+       existing ones the existing values are moved (rewriting
+       the variables of the file).
+    """
+    out_dir = os.path.dirname(output_file)
+    if out_dir and not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    if os.path.isfile(output_file):
+        dataset = Dataset(output_file, "a")
+    else:
+        dataset = Dataset(output_file, "w", format="NETCDF4")
+        create_station_file_structure(dataset, zlib, complevel, chunksize)
+
+    station_codes = list(dataset["station_code"][:])
+    times = days_since_to_seconds(dataset["time"][:])
+    shape = (len(station_codes), len(times))
+    last_written = {}
+
+    list_of_data = [
+        data._replace(records=RecordTable.from_records(data.records))
+        for data in list_of_data
+    ]
+    list_of_data = [data for data in list_of_data if len(data.records) > 0]
+    all_times = np.union1d(times, np.concatenate(
+        [times] + [get_seconds(data.records) for data in list_of_data]))
+    if not np.array_equal(all_times[:len(times)], times):
+        nr_of_stations = len(dict.fromkeys(
+            station_codes + [data.station_code for data in list_of_data]))
+        move_station_values(
+            dataset, times, all_times, len(station_codes), nr_of_stations)
+        corner = (nr_of_stations - 1, len(all_times) - 1)
+        for name, variable in dataset.variables.items():
+            if variable.dimensions == ("station", "time"):
+                last_written[name] = corner
+        dataset["time"][:] = all_times / 86400.
+    elif len(all_times) > len(times):
+        dataset["time"][len(times):len(all_times)] = (
+            all_times[len(times):] / 86400.)
+    times = pd.Index(all_times)
+
+    for data in list_of_data:
+        records = data.records
+
+        # station
+        if data.station_code in station_codes:
+            station_index = station_codes.index(data.station_code)
+        else:
+            station_index = len(station_codes)
+            station_codes.append(data.station_code)
+            dataset["station_code"][station_index] = data.station_code
+            dataset["station_name"][station_index] = data.station_name
+            dataset["latitude"][station_index] = float(data.latitude)
+            dataset["longitude"][station_index] = float(data.longitude)
+            dataset["altitude"][station_index] = float(data.altitude)
+
+        # time
+        time_indexes = times.get_indexer(get_seconds(records))
+
+        # parameter
+        for name, values in [
+                (data.parameter_code, records.value),
+                ("{}_unc".format(data.parameter_code), records.uncertainty),
+                ("{}_status".format(data.parameter_code), records.status)]:
+            if name not in dataset.variables:
+                create_station_parameter_variable(
+                    dataset, name, data, zlib, complevel, chunksize)
+            write_station_values(
+                dataset[name], station_index, time_indexes, values)
+            last_written[name] = max(
+                last_written.get(name, (-1, -1)),
+                (station_index, time_indexes.max())
+            )
+
+    # each variable is extended to the full (station, time) shape,
+    # reading outside the written part of a variable with unlimited
+    # dimensions is not reliable
+    if not shape == (len(station_codes), len(times)):
+        corner = (len(station_codes) - 1, len(times) - 1)
+        for name, variable in dataset.variables.items():
+            if not variable.dimensions == ("station", "time"):
+                continue
+            if not last_written.get(name) == corner:
+                variable[corner] = variable._FillValue
+
+    dataset.close()
+
+
+def get_seconds(records):
+    """returns the start times of records in whole seconds
+       since 1900-01-01"""
+    return (
+        records.start_datetime - np.datetime64("1900-01-01", "s")
+    ).astype("i8")
+
+
+def move_station_values(
+        dataset, times, new_times, old_nr_of_stations, nr_of_stations):
+    """moves the values of all (station, time) variables from the
+       time axis times to new_times (containing all of times), the
+       variables are written with the full (station, time) shape,
+       stations after old_nr_of_stations are filled with _FillValue"""
+    indexes = pd.Index(new_times).get_indexer(times)
+    for variable in dataset.variables.values():
+        if not variable.dimensions == ("station", "time"):
+            continue
+        # raw values, missing values are not masked, only stations
+        # of the file before the append (the station dimension is
+        # already extended by the variables moved before this one)
+        variable.set_auto_maskandscale(False)
+        current = variable[:old_nr_of_stations, :len(times)]
+        values = np.full(
+            (nr_of_stations, len(new_times)),
+            variable._FillValue,
+            dtype=variable.dtype
+        )
+        values[:current.shape[0], indexes] = current
+        variable[:nr_of_stations, :len(new_times)] = values
+        variable.set_auto_maskandscale(True)
+
+
+def get_stations_filename(out_dir, data):
+    """returns the filename of the consolidated station file
+       (see save_data_netcdf_stations) of data, there is one
+       file for each contributor, parameter and time interval"""
+    return os.path.join(out_dir, "{}.{}.{}.stations.nc".format(
+        data.contributor, data.parameter_code, data.time_interval
+    ).lower().replace(" ", "_"))
+
+
+def days_since_to_seconds(days):
+    """returns an array of whole seconds from days since reference"""
+    return np.round(np.asarray(days, dtype="f8") * 86400.).astype("i8")
+
+
+def create_station_file_structure(dataset, zlib, complevel, chunksize):
+    """creates dimensions and station variables of a
+       consolidated station file"""
+    stationdim = dataset.createDimension("station", None)
+    timedim = dataset.createDimension("time", None)
+
+    time = dataset.createVariable(
+        "time", "f8", (timedim.name,),
+        zlib=zlib, complevel=complevel, chunksizes=(chunksize,))
+    time.standard_name = "time"
+    time.long_name = "time of measurement"
+    time.units = "days since 1900-01-01 00:00:00 UTC"
+    time.calendar = "gregorian"
+
+    for name, long_name in [
+            ("station_code", "station code"),
+            ("station_name", "station name")]:
+        variable = dataset.createVariable(name, str, (stationdim.name,))
+        variable.long_name = long_name
+
+    for name, units in [
+            ("latitude", "degrees_north"),
+            ("longitude", "degrees_east"),
+            ("altitude", "m")]:
+        variable = dataset.createVariable(
+            name, "f8", (stationdim.name,), fill_value=-9999.)
+        variable.standard_name = name
+        variable.units = units
+
+
+def create_station_parameter_variable(
+        dataset, name, data, zlib, complevel, chunksize):
+    """creates a (station, time) variable for a parameter,
+       its uncertainty or its status"""
+    if name.endswith("_status"):
+        variable = dataset.createVariable(
+            name, "i4", ("station", "time"), fill_value=-9999,
+            zlib=zlib, complevel=complevel, chunksizes=(1, chunksize))
+        variable.long_name = "Status of {}".format(data.parameter)
+        return variable
+    variable = dataset.createVariable(
+        name, "f8", ("station", "time"), fill_value=-9999.,
+        zlib=zlib, complevel=complevel, chunksizes=(1, chunksize))
+    variable.standard_name = (
+        "Uncertainty" if name.endswith("_unc") else data.parameter)
+    variable.missing_value = -999.
+    variable.units = data.measurement_unit
+    variable.time_interval = data.time_interval
+    return variable
+
+
+def write_station_values(variable, station_index, time_indexes, values):
+    """writes values of a station at the given time indexes,
+       using a single slice covering all indexes"""
+    first = time_indexes.min()
+    last = time_indexes.max() + 1
+    if np.array_equal(time_indexes, np.arange(first, last)):
+        variable[station_index, first:last] = values
+        return
+    current = variable[station_index, first:last]
+    if not np.ma.isMaskedArray(current):
+        current = np.ma.masked_array(current)
+    current[time_indexes - first] = values
+    variable[station_index, first:last] = current
+
+
+def get_parquet_metadata(data):
+    """returns the header of data as parquet key/value metadata"""
+    metadata = {}
+    for field in ObsData._fields:
+        if field == "records":
+            continue
+        value = getattr(data, field)
+        metadata[field] = (
+            value if isinstance(value, str)
+            else json.dumps(value, default=str)
+        )
+    return metadata
+
+
+PARQUET_PARTITION_COLUMNS = [
+    "contributor", "station_code", "parameter_code", "year"]
+
+
+def get_parquet_partition(out_dir, data, year):
+    """returns the directory of the partition of data and year
+       of a parquet dataset written by save_data_parquet"""
+    values = [data.contributor, data.station_code, data.parameter_code, year]
+    return os.path.join(out_dir, *[
+        # partition values are uri encoded by pyarrow
+        "{}={}".format(column, quote(str(value), safe=""))
+        for column, value in zip(PARQUET_PARTITION_COLUMNS, values)
+    ])
+
+
+def read_parquet_partition(directory):
+    """returns a table of the records of the parquet files of a
+       partition directory (without the partition columns), or
+       None if there are no files"""
+    if not os.path.isdir(directory):
+        return None
+    tables = [
+        pq.read_table(os.path.join(directory, filename))
+        for filename in sorted(os.listdir(directory))
+        if filename.endswith(".parquet")
+    ]
+    if not tables:
+        return None
+    return pa.concat_tables(tables)
+
+
+def save_data_parquet(out_dir, data):
+    """saves data in a parquet dataset partitioned by
+       contributor/station_code/parameter_code/year
+
+       The header of data is stored as key/value metadata of the
+       parquet files. Records already saved in a partition are
+       merged with the records of data, where records of data
+       replace saved records of the same start_datetime, so saving
+       again does not duplicate records and saving another period
+       of the same year keeps the records saved before.
+    """
+    records = RecordTable.from_records(data.records)
+    if len(records) == 0:
+        return
+
+    nr_of_records = len(records)
+    years = records.start_datetime.astype("datetime64[Y]").astype(
+        "i8") + 1970
+    table = pa.table({
+        "start_datetime": pa.array(records.start_datetime),
+        "end_datetime": pa.array(
+            records.end_datetime, mask=np.isnat(records.end_datetime)),
+        "value": records.value,
+        "uncertainty": records.uncertainty,
+        "status": records.status,
+        "status_flag": pa.DictionaryArray.from_arrays(
+            records.status_flag.codes,
+            [str(category) for category in records.status_flag.categories],
+        ),
+        "nr_of_samples": records.nr_of_samples,
+        "contributor": np.full(nr_of_records, data.contributor),
+        "station_code": np.full(nr_of_records, data.station_code),
+        "parameter_code": np.full(nr_of_records, data.parameter_code),
+        "year": years,
+    })
+
+    # records saved before, not replaced by records of data
+    saved_tables = []
+    for year in np.unique(years):
+        saved = read_parquet_partition(
+            get_parquet_partition(out_dir, data, year))
+        if saved is None:
+            continue
+        saved = saved.filter(pc.invert(pc.is_in(
+            saved["start_datetime"],
+            value_set=table["start_datetime"].combine_chunks()
+        )))
+        nr_of_saved = saved.num_rows
+        for column in PARQUET_PARTITION_COLUMNS:
+            saved = saved.append_column(
+                table.schema.field(column),
+                pa.array(
+                    np.full(nr_of_saved, table[column][0].as_py()),
+                    type=table.schema.field(column).type
+                )
+            )
+        saved_tables.append(
+            saved.select(table.column_names).cast(table.schema))
+    if saved_tables:
+        table = pa.concat_tables([table] + saved_tables)
+        table = table.sort_by("start_datetime")
+    table = table.replace_schema_metadata(get_parquet_metadata(data))
+
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    pq.write_to_dataset(
+        table,
+        out_dir,
+        partition_cols=PARQUET_PARTITION_COLUMNS,
+        basename_template="data-{i}.parquet",
+        existing_data_behavior="delete_matching",
+    )
@@ -0,0 +1,76 @@
+"""
+   This module contains a manager of authenticated
+   sessions, one per data source, that are logged in
+   once and shared between threads
+"""
+import threading
+import requests  # type: ignore
+
+
+class AuthenticatedSession:
+    """A requests session that logs in on first use.
+
+       The login function is called with the underlying
+       requests.Session and is expected to exit or raise
+       on invalid credentials. A response for which is_expired
+       returns true triggers a new login followed by a single
+       retry of the request. The auth cookie and the keep-alive
+       connections are kept between requests, and the session
+       can be shared between worker threads.
+    """
+
+    def __init__(self, login, is_expired=None):
+        self.login = login
+        self.is_expired = is_expired
+        self.session = requests.Session()
+        self.nr_of_logins = 0
+        self._lock = threading.Lock()
+
+    def ensure_login(self, nr_of_logins=None):
+        """logs in if not logged in, or if nr_of_logins is given,
+           if no other thread has logged in since then"""
+        with self._lock:
+            if self.nr_of_logins == 0 or (
+                    nr_of_logins is not None and
+                    nr_of_logins == self.nr_of_logins):
+                self.login(self.session)
+                self.nr_of_logins += 1
+
+    def request(self, method, url, **kwargs):
+        self.ensure_login()
+        nr_of_logins = self.nr_of_logins
+        r = self.session.request(method, url, **kwargs)
+        if self.is_expired is not None and self.is_expired(r):
+            self.ensure_login(nr_of_logins)
+            r = self.session.request(method, url, **kwargs)
+        return r
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(source, login, is_expired=None):
+    """returns the shared session of a source (e.g. 'fed'),
+       the session is created on first call"""
+    with _sessions_lock:
+        if source not in _sessions:
+            _sessions[source] = AuthenticatedSession(login, is_expired)
+        return _sessions[source]
+
+
+def close_sessions():
+    """closes and forgets all shared sessions"""
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import tempfile
+import timeit
+import numpy as np
+from obsdata import save_data
+
+
+def get_obsdata(nr_of_years):
+    """returns an instance of ObsData with synthetic hourly records"""
+    nr_of_records = nr_of_years * 365 * 24
+    start_datetime = (
+        np.datetime64("2000-01-01T00:00:00") +
+        np.arange(nr_of_records).astype("timedelta64[h]")
+    )
+    value = np.round(np.random.uniform(0, 80, nr_of_records), 3)
+    value[::50] = -999
+    status = np.zeros(nr_of_records, dtype=int)
+    status[::50] = 4
+    records = save_data.RecordTable(
+        start_datetime=start_datetime,
+        end_datetime=start_datetime + np.timedelta64(1, "h"),
+        value=value,
+        uncertainty=np.full(nr_of_records, -999),
+        status=status,
+        status_flag=np.where(status == 4, "M1", "V0"),
+        nr_of_samples=np.full(nr_of_records, -999),
+    )
+    return save_data.ObsData(
+        data_version="?",
+        station_name="Benchmark",
+        station_code="BENCH1",
+        station_category="global",
+        observation_category=(
+            "Air sampling observation at a stationary platform"),
+        country_territory="?",
+        contributor="bench",
+        latitude=0.,
+        longitude=0.,
+        altitude=0.,
+        nr_of_sampling_heights=1,
+        sampling_heights="?",
+        contact_point="?",
+        dataset="benchmark",
+        parameter="O3",
+        parameter_code="O3",
+        time_interval="hourly",
+        measurement_unit="ppb",
+        measurement_method="?",
+        sampling_type="continuous",
+        time_zone="UTC",
+        measurement_scale="?",
+        status_flags="?",
+        records=records,
+    )
+
+
+def save_data_txt_row_by_row(out_dir, data):
+    """writes the data-records one record at a time, as
+       save_data.save_data_txt did before the records were
+       formatted column-wise (used as reference)"""
+    file_name = save_data.get_output_filename(data, "dat")
+    with open(os.path.join(out_dir, file_name), mode='wb') as outfile:
+        for record in data.records:
+            value = record.value if not record.value == -999 else -99999.999
+            unc = (
+                record.uncertainty if not record.uncertainty == -999
+                else -999.99
+            )
+            status_flag = record.status if not record.status == -999 else -9999
+            nr_of_samples = (
+                record.nr_of_samples if not record.nr_of_samples == -999
+                else -9999
+            )
+            try:
+                end_datetime = record.end_datetime.strftime("%Y-%m-%d %H:%M")
+            except AttributeError:
+                end_datetime = "9999-99-99 99:99"
+            outfile.write(
+                "{0} {1} {2} {3} {4} {5} {6} {7}\n".format(
+                    record.start_datetime.strftime("%Y-%m-%d %H:%M"),
+                    end_datetime,
+                    "{:10.3f}".format(value),
+                    "{:5}".format(nr_of_samples),
+                    "{:7.2f}".format(unc),
+                    "{:5}".format(status_flag),
+                    "-9",
+                    "-99999999",
+                ).encode("ascii")
+            )
+    return os.path.join(out_dir, file_name)
+
+
+def cli():
+
+    # compares the column-wise 'World Data Centre' writer with a
+    # record by record writer and checks that the data-records are
+    # identical
+
+    # ./benchmark_save_data_txt.py -y 10 -n 3
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-y',
+        '--years',
+        dest='years',
+        type=int,
+        default=1,
+        help='number of years of hourly data, default is 1',
+    )
+    parser.add_argument(
+        '-n',
+        '--repeat',
+        dest='repeat',
+        type=int,
+        default=3,
+        help='number of repetitions, the best time is reported',
+    )
+    args = parser.parse_args()
+
+    data = get_obsdata(args.years)
+    with tempfile.TemporaryDirectory() as out_dir:
+        reference_dir = os.path.join(out_dir, "reference")
+        os.makedirs(reference_dir)
+
+        time_reference = min(timeit.repeat(
+            lambda: save_data_txt_row_by_row(reference_dir, data),
+            number=1,
+            repeat=args.repeat
+        ))
+        time_columnar = min(timeit.repeat(
+            lambda: save_data.save_data_txt(out_dir, data),
+            number=1,
+            repeat=args.repeat
+        ))
+
+        file_name = save_data.get_output_filename(data, "dat")
+        with open(os.path.join(reference_dir, file_name), 'rb') as f:
+            reference = f.read()
+        with open(os.path.join(out_dir, file_name), 'rb') as f:
+            columnar = f.read()
+        header_lines = 32
+        identical = (
+            columnar.split(b"\n", header_lines)[header_lines] == reference
+        )
+
+    print("records:         {}".format(len(data.records)))
+    print("row by row:      {:.3f} s".format(time_reference))
+    print("column-wise:     {:.3f} s".format(time_columnar))
+    print("speedup:         {:.1f}".format(time_reference / time_columnar))
+    print("identical:       {}".format(identical))
+
+
+if __name__ == "__main__":
+    cli()
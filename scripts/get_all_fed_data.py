@@ -1,6 +1,5 @@
 #!/usr/bin/env python3
 from datetime import datetime
-from dateutil.relativedelta import relativedelta
 from obsdata import (
     fed_config,
     fed_data,
@@ -8,31 +7,62 @@ from obsdata import (
 )
 
 
+# sites packed into one report request
+SITES_PER_REQUEST = 50
+
+
 def get_and_save_data(
-        dataset, site, parameter, start_date, end_date, data_format, out_dir):
+        dataset, sites, parameters, start_date, end_date, split,
+        data_format, out_dir, sizer):
 
-    site_info = fed_config.get_site_info(dataset, site)
+    sites_info = {
+        site: fed_config.get_site_info(dataset, site) for site in sites
+    }
 
-    parameter_info = fed_config.get_parameter_info(dataset, parameter)
+    parameters_info = [
+        fed_config.get_parameter_info(dataset, parameter)
+        for parameter in parameters
+    ]
 
-    request_data = fed_data.set_request_data(
+    # reports for many sites and parameters, in time windows
+    # sized by sizer, merged into one FedData per site and parameter
+    list_of_data = fed_data.get_data_adaptive(
         dataset,
-        site_info.id,
-        parameter_info.id,
+        [site_info.id for site_info in sites_info.values()],
+        [parameter_info.id for parameter_info in parameters_info],
         fed_config.datasets[dataset].time_interval,
         start_date,
-        end_date
+        end_date,
+        sizer=sizer
     )
 
-    data = fed_data.get_data(request_data)
-    if len(data.records) == 0:
-        return
-    if not site_info.country == '\xa0':
-        data = data._replace(country_territory=site_info.country)
-    if data_format == "nc":
-        save_data.save_data_netcdf(out_dir, data)
-    elif data_format == "dat":
-        save_data.save_data_txt(out_dir, data)
+    for data in list_of_data:
+        if len(data.records) == 0:
+            continue
+        site_info = sites_info[data.station_code]
+        if not site_info.country == '\xa0':
+            data = data._replace(country_territory=site_info.country)
+        # a single file per site, or a file per split period (e.g. year)
+        if split is None:
+            split_data = [data]
+        else:
+            split_data = [
+                data._replace(records=records)
+                for _, records in save_data.split_records(
+                    data.records, split)
+            ]
+        for current_data in split_data:
+            if data_format == "nc":
+                save_data.save_data_netcdf(out_dir, current_data)
+            elif data_format == "nc-stations":
+                save_data.save_data_netcdf_stations(
+                    save_data.get_stations_filename(out_dir, current_data),
+                    [current_data]
+                )
+            elif data_format == "dat":
+                save_data.save_data_txt(out_dir, current_data)
+            elif data_format == "parquet":
+                save_data.save_data_parquet(out_dir, current_data)
 
 
 if __name__ == "__main__":
@@ -43,7 +73,7 @@ if __name__ == "__main__":
             "parameter": "OCf",
             "start_date": datetime(2010, 1, 1),
             "end_date": datetime(2015, 12, 31),
-            "timedelta_month": -1,
+            "split": None,
             "data_format": "dat",
             "out_dir": "/tmp",
         },
@@ -52,35 +82,38 @@ if __name__ == "__main__":
             "parameter": "O3",
             "start_date": datetime(2010, 1, 1),
             "end_date": datetime(2015, 12, 31),
-            "timedelta_month": 12,
+            "split": "year",
             "data_format": "dat",
             "out_dir": "/tmp",
         }
     ]
     for dataset in datasets_to_retrieve:
         site_codes = fed_config.get_all_site_codes(dataset["id"])
-        for site_code in site_codes:
-            date_i = dataset["start_date"]
-            while date_i < dataset["end_date"]:
-                if not dataset["timedelta_month"] == -1:
-                    date_j = (
-                        date_i +
-                        relativedelta(months=dataset["timedelta_month"]) -
-                        relativedelta(days=1)
-                    )
-                else:
-                    date_j = dataset["end_date"]
-                print(dataset["id"], site_code, date_i, date_j)
-                get_and_save_data(
-                     dataset["id"],
-                     site_code,
-                     dataset["parameter"],
-                     date_i,
-                     date_j,
-                     dataset["data_format"],
-                     dataset["out_dir"]
-                )
-                if not dataset["timedelta_month"] == -1:
-                    date_i += relativedelta(months=dataset["timedelta_month"])
-                else:
-                    break
+        plans, nr_of_avoided = fed_config.plan_requests(
+            dataset["id"],
+            site_codes,
+            [(dataset["start_date"], dataset["end_date"])],
+            SITES_PER_REQUEST
+        )
+        # window sizes are learned from all requests of the dataset
+        sizer = fed_data.WindowSizer(
+            fed_config.datasets[dataset["id"]].time_interval)
+        print(
+            "{}: {} requests, {} requests avoided (no site data)".format(
+                dataset["id"], len(plans), nr_of_avoided)
+        )
+        for plan in plans:
+            print(
+                dataset["id"], plan.site_codes[0], "..", plan.site_codes[-1],
+                plan.start_date, plan.end_date)
+            get_and_save_data(
+                 dataset["id"],
+                 plan.site_codes,
+                 [dataset["parameter"]],
+                 plan.start_date,
+                 plan.end_date,
+                 dataset["split"],
+                 dataset["data_format"],
+                 dataset["out_dir"],
+                 sizer
+            )
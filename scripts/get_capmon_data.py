@@ -8,33 +8,28 @@ from obsdata import (
 )
 
 
-def get_capmon_data(
-        dataset, parameter, site_info, date_start,
-        date_end, data_format, out_dir, csv_dir):
-
-    for year in range(date_start.year, date_end.year + 1):
-        capmon_data.download_csvfile(dataset, year, csv_dir)
-
-    data = capmon_data.merge_data_many_years(
-        dataset, parameter, site_info,
-        date_start.year, date_end.year, csv_dir)
-    if data == -1:
-        print("no data available.")
-        exit(0)
+def save_capmon_data(data, date_start, date_end, data_format, out_dir):
 
     if data.time_interval == "hourly":
-        for year in range(date_start.year, date_end.year + 1):
-            date_start = datetime(year, 1, 1)
-            date_end = datetime(year + 1, 1, 1)
-            filtered_records = save_data.date_filter_records(
-                date_start, date_end, data.records)
-            if len(filtered_records) == 0:
-                continue
-            current_data = data._replace(records=filtered_records)
+        filtered_records = save_data.date_filter_records(
+            datetime(date_start.year, 1, 1),
+            datetime(date_end.year + 1, 1, 1),
+            data.records
+        )
+        for _, yearly_records in save_data.split_records(
+                filtered_records, "year"):
+            current_data = data._replace(records=yearly_records)
             if data_format == "nc":
                 save_data.save_data_netcdf(out_dir, current_data)
+            elif data_format == "nc-stations":
+                save_data.save_data_netcdf_stations(
+                    save_data.get_stations_filename(out_dir, current_data),
+                    [current_data]
+                )
             elif data_format == "dat":
                 save_data.save_data_txt(out_dir, current_data)
+            elif data_format == "parquet":
+                save_data.save_data_parquet(out_dir, current_data)
     else:
         filtered_records = save_data.date_filter_records(
                 date_start, date_end, data.records)
@@ -43,8 +38,47 @@ def get_capmon_data(
         data = data._replace(records=filtered_records)
         if data_format == "nc":
             save_data.save_data_netcdf(out_dir, data)
+        elif data_format == "nc-stations":
+            save_data.save_data_netcdf_stations(
+                save_data.get_stations_filename(out_dir, data), [data])
         elif data_format == "dat":
             save_data.save_data_txt(out_dir, data)
+        elif data_format == "parquet":
+            save_data.save_data_parquet(out_dir, data)
+
+
+def get_capmon_data(
+        dataset, parameter, site_info, date_start,
+        date_end, data_format, out_dir, csv_dir):
+
+    capmon_data.download_csvfiles(
+        dataset, date_start.year, date_end.year, csv_dir)
+
+    data = capmon_data.merge_data_many_years(
+        dataset, parameter, site_info,
+        date_start.year, date_end.year, csv_dir)
+    if data == -1:
+        print("no data available.")
+        exit(0)
+
+    save_capmon_data(data, date_start, date_end, data_format, out_dir)
+
+
+def get_capmon_data_all_sites(
+        dataset, parameter, date_start,
+        date_end, data_format, out_dir, csv_dir):
+
+    capmon_data.download_csvfiles(
+        dataset, date_start.year, date_end.year, csv_dir)
+
+    list_of_data = capmon_data.merge_data_all_sites(
+        dataset, parameter, date_start.year, date_end.year, csv_dir)
+    if not list_of_data:
+        print("no data available.")
+        exit(0)
+
+    for data in list_of_data:
+        save_capmon_data(data, date_start, date_end, data_format, out_dir)
 
 
 def cli():
@@ -53,6 +87,7 @@ def cli():
 
     # noqa ./get_capmon_data.py CAPMoN_Precip_Chemistry CAPMCANS1KEJ "Cl-" 1986-01-01 1995-12-31 -e dat -q /tmp  -x /tmp
     # noqa ./get_capmon_data.py CAPMoN_Ozone CAPMCANS1KEJ O3 1986-01-01 1995-12-31 -e dat -q /tmp  -x /tmp
+    # noqa ./get_capmon_data.py CAPMoN_Ozone all O3 1986-01-01 1995-12-31 -e dat -q /tmp  -x /tmp
 
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -67,7 +102,8 @@ def cli():
         type=str,
         help=(
             "capmon site code, e.g. CAPMCANS1KEJ "
-            "for 'Kejimkujik National Park'"
+            "for 'Kejimkujik National Park', or 'all' "
+            "for all sites"
         )
     )
     parser.add_argument(
@@ -94,7 +130,11 @@ def cli():
         dest='data_format',
         type=str,
         default='dat',
-        help='data format for saving file (nc or dat), default is dat',
+        help=(
+            'data format for saving file (nc, nc-stations, dat or '
+            'parquet), nc-stations appends to a single netCDF file of '
+            'all stations, default is dat'
+        ),
     )
     parser.add_argument(
         '-q',
@@ -124,6 +164,18 @@ def cli():
     capmon_config.validate_dataset(args.dataset_id)
     capmon_config.validate_parameter(
         args.dataset_id, args.parameter_code)
+    if args.site_code == "all":
+        get_capmon_data_all_sites(
+            args.dataset_id,
+            args.parameter_code,
+            start_date,
+            end_date,
+            args.data_format,
+            args.out_dir,
+            args.csv_dir
+        )
+        return
+
     site_info = capmon_config.get_site_info(
         args.dataset_id, args.site_code)
 
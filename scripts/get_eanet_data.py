@@ -1,7 +1,6 @@
 #!/usr/bin/env python3
 import argparse
 from datetime import datetime
-import pandas as pd
 from obsdata import (
     eanet_config,
     eanet_data,
@@ -17,47 +16,28 @@ def get_eanet_monthly_data(
     xlsfiles = eanet_data.get_xlsfiles(
         xls_dir, dataset, start_date.year, end_date.year)
 
-    # for these sites we have needed meta data
-    site_codes = eanet_config.get_all_site_codes()
-    list_of_eanet_sites = [
-        getattr(eanet_config.get_site_info(site_code), 'site')
-        for site_code in site_codes
-    ]
-
-    list_of_sheets = [
-        pd.read_excel(xlsfile, sheet_name=parameter)
-        for xlsfile in xlsfiles
-    ]
-
-    # sheets = pd.read_excel(xlsfile, sheet_name=None).keys()
-    list_of_sites_all_sheets = eanet_data.get_all_sites(
-        list_of_sheets)
-
     if site == 'all':
-        list_of_sites = list_of_sites_all_sheets
+        # all sites are extracted from each sheet in one pass
+        list_of_data = eanet_data.merge_data_all_sites(
+            xlsfiles, dataset, parameter)
     else:
-        list_of_sites = [list_of_eanet_sites[site_codes.index(site)]]
-
-    for site in list_of_sites:
-
-        if site not in list_of_eanet_sites:
-            # if we not have meta data for this site
-            continue
-        eanet_site = eanet_config.get_site_info(
-            site_codes[list_of_eanet_sites.index(site)]
-        )
-
-        data = eanet_data.merge_data(
-            list_of_sheets, eanet_site, dataset, parameter)
+        list_of_data = [eanet_data.merge_data_from_files(
+            xlsfiles, eanet_config.get_site_info(site), dataset, parameter)]
 
+    for data in list_of_data:
         if data_format == "nc":
             save_data.save_data_netcdf(out_dir, data)
+        elif data_format == "nc-stations":
+            save_data.save_data_netcdf_stations(
+                save_data.get_stations_filename(out_dir, data), [data])
         elif data_format == "dat":
             save_data.save_data_txt(out_dir, data)
+        elif data_format == "parquet":
+            save_data.save_data_parquet(out_dir, data)
 
 
 def get_eanet_hourly_data(
-        dataset_id, site, parameter, start_date, end_date,
+        dataset_id, site, parameters, start_date, end_date,
         data_format, out_dir, csv_dir):
 
     dataset = eanet_config.DATASETS[[
@@ -69,25 +49,44 @@ def get_eanet_hourly_data(
     else:
         sites = [site]
 
-    for site_i in sites:
-        for year in range(start_date.year, end_date.year + 1):
+    years = range(start_date.year, end_date.year + 1)
+    results = eanet_hourly_data.download_csvfiles(
+        csv_dir, dataset, sites, years)
 
-            print(
-                "\n\n processing dataset:{} ".format(dataset) +
-                "site:{} ".format(site_i) +
-                "parameter:{} ".format(parameter) +
-                "year:{} \n\n".format(year)
-            )
+    # each file (site and year) is read once for all parameters
+    for result in results:
+        _, _, site_i, year = result.task.args
+        csvfile = result.result
+        if result.error is not None or csvfile is None:
+            print("{} {} is not available, skipped".format(site_i, year))
+            continue
+
+        print(
+            "\n\n processing dataset:{} ".format(dataset) +
+            "site:{} ".format(site_i) +
+            "parameters:{} ".format(parameters) +
+            "year:{} \n\n".format(year)
+        )
 
-            obs_data = eanet_hourly_data.get_data(
-                dataset, site_i, parameter, year, csv_dir)
+        list_of_obs_data = eanet_hourly_data.read_data_all_products(
+            dataset, site_i, csvfile, parameters)
 
-            if len(obs_data.records) > 0:
+        for obs_data in list_of_obs_data:
 
-                if data_format == "nc":
-                    save_data.save_data_netcdf(out_dir, obs_data)
-                elif data_format == "dat":
-                    save_data.save_data_txt(out_dir, obs_data)
+            if len(obs_data.records) == 0:
+                continue
+
+            if data_format == "nc":
+                save_data.save_data_netcdf(out_dir, obs_data)
+            elif data_format == "nc-stations":
+                save_data.save_data_netcdf_stations(
+                    save_data.get_stations_filename(out_dir, obs_data),
+                    [obs_data]
+                )
+            elif data_format == "dat":
+                save_data.save_data_txt(out_dir, obs_data)
+            elif data_format == "parquet":
+                save_data.save_data_parquet(out_dir, obs_data)
 
 
 def cli():
@@ -142,7 +141,11 @@ def cli():
         dest='data_format',
         type=str,
         default='dat',
-        help='data format for saving file (nc or dat), default is dat',
+        help=(
+            'data format for saving file (nc, nc-stations, dat or '
+            'parquet), nc-stations appends to a single netCDF file of '
+            'all stations, default is dat'
+        ),
     )
     parser.add_argument(
         '-q',
@@ -191,8 +194,8 @@ def cli():
     else:
         parameters = [args.parameter_code]
 
-    for parameter in parameters:
-        if args.dataset_id == "1":
+    if args.dataset_id == "1":
+        for parameter in parameters:
             get_eanet_monthly_data(
                 "Dry Monthly",
                 args.site_code,
@@ -203,17 +206,17 @@ def cli():
                 args.out_dir,
                 args.xls_dir
             )
-        else:
-            get_eanet_hourly_data(
-                args.dataset_id,
-                args.site_code,
-                parameter,
-                start_date,
-                end_date,
-                args.data_format,
-                args.out_dir,
-                args.xls_dir
-            )
+    else:
+        get_eanet_hourly_data(
+            args.dataset_id,
+            args.site_code,
+            parameters,
+            start_date,
+            end_date,
+            args.data_format,
+            args.out_dir,
+            args.xls_dir
+        )
 
 
 if __name__ == "__main__":
@@ -31,8 +31,13 @@ def get_and_save_data(
     data = data._replace(country_territory=site_info.country)
     if data_format == "nc":
         save_data.save_data_netcdf(out_dir, data)
+    elif data_format == "nc-stations":
+        save_data.save_data_netcdf_stations(
+            save_data.get_stations_filename(out_dir, data), [data])
     elif data_format == "dat":
         save_data.save_data_txt(out_dir, data)
+    elif data_format == "parquet":
+        save_data.save_data_parquet(out_dir, data)
 
 
 def cli():
@@ -82,7 +87,11 @@ def cli():
         dest='data_format',
         type=str,
         default='dat',
-        help='data format for saving file (nc or dat), default is dat',
+        help=(
+            'data format for saving file (nc, nc-stations, dat or '
+            'parquet), nc-stations appends to a single netCDF file of '
+            'all stations, default is dat'
+        ),
     )
     parser.add_argument(
         '-q',
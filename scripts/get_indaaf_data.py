@@ -1,7 +1,6 @@
 #!/usr/bin/env python3
 import os
 import argparse
-from datetime import datetime
 from obsdata import (
     indaaf_config,
     indaaf_data,
@@ -37,25 +36,31 @@ def get_indaaf_data(
             dataset_info
         )
         if dataset_info["time_interval"] == "hourly":
-            year_start = data.records[0].start_datetime.year
-            year_end = data.records[-1].start_datetime.year + 1
-            for year in range(year_start, year_end):
-                date_start = datetime(year, 1, 1)
-                date_end = datetime(year + 1, 1, 1)
-                filtered_records = save_data.date_filter_records(
-                    date_start, date_end, data.records)
-                if len(filtered_records) == 0:
-                    continue
-                current_data = data._replace(records=filtered_records)
+            for _, yearly_records in save_data.split_records(
+                    data.records, "year"):
+                current_data = data._replace(records=yearly_records)
                 if data_format == "nc":
                     save_data.save_data_netcdf(out_dir, current_data)
+                elif data_format == "nc-stations":
+                    save_data.save_data_netcdf_stations(
+                        save_data.get_stations_filename(
+                            out_dir, current_data),
+                        [current_data]
+                    )
                 elif data_format == "dat":
                     save_data.save_data_txt(out_dir, current_data)
+                elif data_format == "parquet":
+                    save_data.save_data_parquet(out_dir, current_data)
         else:
             if data_format == "nc":
                 save_data.save_data_netcdf(out_dir, data)
+            elif data_format == "nc-stations":
+                save_data.save_data_netcdf_stations(
+                    save_data.get_stations_filename(out_dir, data), [data])
             elif data_format == "dat":
                 save_data.save_data_txt(out_dir, data)
+            elif data_format == "parquet":
+                save_data.save_data_parquet(out_dir, data)
 
 
 def cli():
@@ -93,7 +98,11 @@ def cli():
         dest='data_format',
         type=str,
         default='dat',
-        help='data format for saving file (nc or dat), default is dat',
+        help=(
+            'data format for saving file (nc, nc-stations, dat or '
+            'parquet), nc-stations appends to a single netCDF file of '
+            'all stations, default is dat'
+        ),
     )
     parser.add_argument(
         '-q',
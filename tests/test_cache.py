@@ -0,0 +1,257 @@
+from datetime import datetime
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from obsdata import cache
+from obsdata.save_data import RecordTable
+
+
+class FakeResponse:
+
+    def __init__(self, status_code, content=b"", headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+
+class FakeServer:
+    """records the conditional headers of each request"""
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = []
+
+    def get(self, headers):
+        self.requests.append(headers)
+        return self.responses.pop(0)
+
+
+def save(response, filename):
+    if response.status_code != 200:
+        return False
+    with open(filename, "wb") as f:
+        f.write(response.content)
+    return True
+
+
+def test_fetch_downloads_and_records_manifest(tmp_path):
+    file_cache = cache.RawFileCache(str(tmp_path))
+    server = FakeServer([
+        FakeResponse(200, b"data", {"ETag": '"v1"'}),
+    ])
+    key = cache.get_key("capmon", "CAPMoN_Ozone", "all", 1990)
+    path = cache.fetch(file_cache, key, "ozone.csv", server.get, save)
+    assert path == str(tmp_path / "ozone.csv")
+    assert server.requests == [{}]
+    entry = cache.RawFileCache(str(tmp_path)).manifest[key]
+    assert entry["size"] == 4
+    assert entry["sha256"] == cache.get_checksum(path)
+    assert entry["etag"] == '"v1"'
+
+
+@pytest.mark.parametrize('age, response, expect_requests, expect_content', (
+    (0, None, [], b"data"),
+    (
+        cache.MAX_AGE + 1,
+        FakeResponse(304),
+        [{"If-None-Match": '"v1"'}],
+        b"data",
+    ),
+    (
+        cache.MAX_AGE + 1,
+        FakeResponse(200, b"new data", {"ETag": '"v2"'}),
+        [{"If-None-Match": '"v1"'}],
+        b"new data",
+    ),
+))
+def test_fetch_revalidates_stale_files(
+        tmp_path, age, response, expect_requests, expect_content):
+    file_cache = cache.RawFileCache(str(tmp_path))
+    cache.fetch(
+        file_cache, "a", "a.csv",
+        FakeServer([FakeResponse(200, b"data", {"ETag": '"v1"'})]).get,
+        save
+    )
+    file_cache.manifest["a"]["validated"] -= age
+    server = FakeServer([response])
+    path = cache.fetch(file_cache, "a", "a.csv", server.get, save)
+    assert server.requests == expect_requests
+    with open(path, "rb") as f:
+        assert f.read() == expect_content
+    assert cache.fetch(file_cache, "a", "a.csv", None, save) == path
+
+
+def test_fetch_downloads_corrupt_files_again(tmp_path):
+    file_cache = cache.RawFileCache(str(tmp_path))
+    server = FakeServer([
+        FakeResponse(200, b"data"),
+        FakeResponse(200, b"data"),
+    ])
+    path = cache.fetch(file_cache, "a", "a.csv", server.get, save)
+    with open(path, "wb") as f:
+        f.write(b"dat")
+    assert not file_cache.is_valid("a")
+    cache.fetch(file_cache, "a", "a.csv", server.get, save)
+    assert server.requests == [{}, {}]
+    assert file_cache.is_valid("a")
+
+
+def test_fetch_removes_corrupt_files_not_available(tmp_path):
+    file_cache = cache.RawFileCache(str(tmp_path))
+    server = FakeServer([FakeResponse(200, b"data"), FakeResponse(404)])
+    path = cache.fetch(file_cache, "a", "a.csv", server.get, save)
+    with open(path, "wb") as f:
+        f.write(b"dat")
+    assert cache.fetch(file_cache, "a", "a.csv", server.get, save) is None
+    assert not os.path.isfile(path)
+    assert "a" not in file_cache.manifest
+
+
+@pytest.mark.parametrize('response, expect_content', (
+    (FakeResponse(200, b"data"), b"data"),
+    (FakeResponse(404), None),
+))
+def test_fetch_downloads_files_without_manifest_again(
+        tmp_path, response, expect_content):
+    # e.g. a truncated file stored before the cache had a manifest
+    (tmp_path / "a.csv").write_bytes(b"dat")
+    file_cache = cache.RawFileCache(str(tmp_path))
+    server = FakeServer([response])
+    path = cache.fetch(
+        file_cache, "a", "a.csv", server.get, save, revalidate=False)
+    assert server.requests == [{}]
+    if expect_content is None:
+        assert path is None
+        assert not (tmp_path / "a.csv").exists()
+    else:
+        assert (tmp_path / "a.csv").read_bytes() == expect_content
+        assert file_cache.is_verified("a")
+        assert cache.fetch(file_cache, "a", "a.csv", None, save) == path
+
+
+def test_fetch_unavailable_file(tmp_path):
+    file_cache = cache.RawFileCache(str(tmp_path))
+    server = FakeServer([FakeResponse(404)])
+    assert cache.fetch(file_cache, "a", "a.csv", server.get, save) is None
+    assert "a" not in file_cache.manifest
+
+
+def test_evict_least_recently_used(tmp_path):
+    file_cache = cache.RawFileCache(str(tmp_path), max_size=10)
+    for key in ["a", "b"]:
+        cache.fetch(
+            file_cache, key, key + ".csv",
+            FakeServer([FakeResponse(200, b"12345")]).get, save)
+    # the end of a run
+    file_cache.release()
+    cache.fetch(file_cache, "a", "a.csv", None, save)
+    cache.fetch(
+        file_cache, "c", "c.csv",
+        FakeServer([FakeResponse(200, b"12345")]).get, save)
+    assert sorted(file_cache.manifest) == ["a", "c"]
+    assert not os.path.isfile(str(tmp_path / "b.csv"))
+    assert file_cache.get_size() == 10
+
+
+def test_evict_parsed_data_with_raw_files(tmp_path):
+    file_cache = cache.RawFileCache(str(tmp_path), max_size=20)
+    for key in ["a", "b"]:
+        cache.fetch(
+            file_cache, key, key + ".csv",
+            FakeServer([FakeResponse(200, b"12345")]).get, save)
+    file_cache.release()
+    parsed_file = tmp_path / cache.PARSED_DIR / "a.csv.O3.v1.0123.npz"
+    parsed_file.parent.mkdir()
+    parsed_file.write_bytes(b"12345678")
+    assert file_cache.get_size() == 18
+    cache.fetch(
+        file_cache, "c", "c.csv",
+        FakeServer([FakeResponse(200, b"12345")]).get, save)
+    assert sorted(file_cache.manifest) == ["b", "c"]
+    assert not parsed_file.exists()
+    assert file_cache.get_size() == 10
+
+
+def test_evict_keeps_files_of_the_current_run(tmp_path):
+    file_cache = cache.RawFileCache(str(tmp_path), max_size=10)
+    for key in ["a", "b", "c"]:
+        cache.fetch(
+            file_cache, key, key + ".csv",
+            FakeServer([FakeResponse(200, b"12345")]).get, save)
+    assert sorted(file_cache.manifest) == ["a", "b", "c"]
+    file_cache.release()
+    assert sorted(file_cache.manifest) == ["b", "c"]
+    assert file_cache.get_size() == 10
+
+
+def test_is_valid_hashes_only_modified_files(tmp_path):
+    file_cache = cache.RawFileCache(str(tmp_path))
+    cache.fetch(
+        file_cache, "a", "a.csv",
+        FakeServer([FakeResponse(200, b"12345")]).get, save)
+    path = str(tmp_path / "a.csv")
+    stat = os.stat(path)
+    with open(path, "wb") as f:
+        f.write(b"54321")
+    # same size and modification time, the checksum is trusted
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert file_cache.is_valid("a")
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert not file_cache.is_valid("a")
+
+
+@pytest.mark.parametrize('size,expect', (
+    ("1000", 1000),
+    ("500M", 500000000),
+    ("1.5g", 1500000000),
+))
+def test_parse_size(size, expect):
+    assert cache.parse_size(size) == expect
+
+
+def test_get_cache_max_size(tmp_path):
+    assert cache.get_cache(str(tmp_path), max_size=100).max_size == 100
+    assert cache.get_cache(str(tmp_path)) is cache.get_cache(
+        str(tmp_path), max_size=100)
+
+
+def test_load_records_invalidates_on_change(tmp_path):
+    raw_file = tmp_path / "raw.csv"
+    raw_file.write_text("1,2")
+    records = RecordTable(
+        start_datetime=[datetime(2000, 1, 1), datetime(2000, 1, 2)],
+        end_datetime=np.array([None, None], dtype="datetime64[s]"),
+        value=[1.5, -999],
+        uncertainty=[-999, -999],
+        status=[0, 4],
+        status_flag=["V0", "M1"],
+        nr_of_samples=[-999, -999],
+    )
+    parsed = []
+
+    def parse():
+        parsed.append(1)
+        return records, {"unit": "ppb", "sites": ["a", "b"]}
+
+    for version in [1, 1, 2, 2]:
+        loaded, attributes = cache.load_records(
+            str(raw_file), "O3", version, parse)
+        assert list(loaded) == list(records)
+        assert attributes["unit"] == "ppb"
+        assert list(attributes["sites"]) == ["a", "b"]
+    assert len(parsed) == 2
+    raw_file.write_text("1,3")
+    cache.load_records(str(raw_file), "O3", 2, parse)
+    assert len(parsed) == 3
+    assert len(list((tmp_path / cache.PARSED_DIR).iterdir())) == 1
+
+
+def test_load_dataframe(tmp_path):
+    raw_file = tmp_path / "raw.csv"
+    raw_file.write_text("a,b\nx,1.5\n,2\n")
+    data = cache.load_dataframe(
+        str(raw_file), "table", 1,
+        lambda: pd.read_csv(str(raw_file), dtype={"a": str}))
+    cached_data = cache.load_dataframe(str(raw_file), "table", 1, None)
+    pd.testing.assert_frame_equal(cached_data, data)
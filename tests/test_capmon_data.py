@@ -1,5 +1,6 @@
 import os
 import pytest
+import shutil
 import pandas as pd
 import datetime
 from obsdata import capmon_data, capmon_config, save_data
@@ -10,66 +11,10 @@ capmon_file = os.path.join(
     "AtmosphericPrecipitationChemistry-MajorIons-CAPMoN-AllSites-1989.csv"  # noqa
 )
 
-
-@pytest.fixture
-def capmon_file_rows():
-    with open(capmon_file, "rb") as the_file:
-        return the_file.readlines()
-
-
-@pytest.mark.parametrize('table_name,expect', (
-    ('Data validity flags', 32),
-    ('Site information', 49),
-    ('CAPMoN_Precip_Chemistry', 91),
-))
-def test_get_table_row_start(
-        capmon_file_rows, table_name, expect):
-    row_start = capmon_data.get_table_row_start(
-        table_name, capmon_file_rows)
-    assert row_start == expect
-
-
-@pytest.mark.parametrize('table_name,expect', (
-    ('Data validity flags', (40, 47)),
-    ('Site information', (59, 89)),
-    ('CAPMoN_Precip_Chemistry', (116, 10058)),
-))
-def test_get_table_rows_data(
-        capmon_file_rows, table_name, expect):
-    row_start = capmon_data.get_table_row_start(
-        table_name, capmon_file_rows)
-    table_rows = capmon_data.get_table_rows_data(
-        capmon_file_rows, row_start)
-    assert table_rows == expect
-
-
-@pytest.mark.parametrize('row_start,row_end,id,expect', (
-    (
-        32, 47, b"TABLE COLUMN NAME--SHORT FORM", [
-            'DataValidityFlag',
-            'DataValidityFlagDescription',
-            'DataValidityFlagEnhDesc'
-        ]
-    ),
-    (
-        91, 10058, b"TABLE COLUMN NAME--CHEMICAL FORMULA", [
-            '', '', '', '', '', '', '', '', '', '', '',
-            'pH', 'pH', 'H+', 'H+', 'SO42-', 'SO42-', 'SO42-',
-            'nss-SO42-', 'nss-SO42-', 'nss-SO42-',
-            'NO3-', 'NO3-', 'NO3-', 'Cl-', 'Cl-', 'Cl-',
-            'NH4+', 'NH4+', 'NH4+', 'Na+', 'Na+', 'Na+',
-            'Ca2+', 'Ca2+', 'Ca2+', 'Mg2+', 'Mg2+', 'Mg2+',
-            'K+', 'K+', 'K+', '', '', '', '', '', '', '',
-            '', '', '', '', '', ''
-        ]
-    ),
-))
-def test_get_data_from_row(
-        capmon_file_rows, row_start, row_end, id, expect):
-    data = capmon_data.get_data_from_row(
-        capmon_file_rows, row_start, row_end, id)
-    print(data)
-    assert data == expect
+ozone_file = os.path.join(
+    os.path.dirname(__file__),
+    "AtmosphericGases-GroundLevelOzone-CAPMoN-AllSites-1990.csv"
+)
 
 
 @pytest.mark.parametrize('parameter,expect', (
@@ -136,6 +81,82 @@ def test_get_data_from_csvfile():
     ])
 
 
+def test_index_tables():
+    tables = capmon_data.index_tables(ozone_file)
+    assert list(tables.keys()) == [
+        'Data validity flags', 'Site information', 'CAPMoN_Ozone']
+    table = tables['CAPMoN_Ozone']
+    assert table.headers == [
+        'SiteID', 'DateStartUTC', 'TimeStartUTC', 'DateEndUTC',
+        'TimeEndUTC', 'O3_ppb', 'O3_ppb_Flag'
+    ]
+    assert table.chemical_formulas == ['', '', '', '', '', 'O3', 'O3']
+    assert table.units[5] == 'ppb (parts per billion)'
+    with open(ozone_file, "rb") as the_file:
+        the_file.seek(table.data_start)
+        block = the_file.read(table.data_end - table.data_start)
+    assert block.startswith(b",CAPMCANS1KEJ,1990-01-01,00:00:00")
+    assert block.endswith(b"\r\n")
+    assert block.count(b"\n") == 72
+
+
+def test_get_table_index_is_cached():
+    assert (
+        capmon_data.get_table_index(ozone_file)
+        is capmon_data.get_table_index(ozone_file)
+    )
+
+
+@pytest.mark.parametrize('table_name,expect', (
+    ('Data validity flags', 3),
+    ('Site information', 3),
+    ('CAPMoN_Ozone', 72),
+))
+def test_iter_table_rows(table_name, expect):
+    table = capmon_data.get_table(ozone_file, table_name)
+    rows = list(capmon_data.iter_table_rows(ozone_file, table))
+    assert len(rows) == expect
+    assert all(row.startswith(b",") for row in rows)
+
+
+@pytest.mark.parametrize('nr_of_rows', (1, 7, 72))
+def test_read_table_in_blocks(nr_of_rows):
+    table = capmon_data.get_table(ozone_file, 'CAPMoN_Ozone')
+    data = capmon_data.read_table(ozone_file, table, nr_of_rows)
+    pd.testing.assert_frame_equal(
+        data, capmon_data.read_table(ozone_file, table))
+    assert len(data) == 72
+
+
+def test_get_data_from_csvfile_ozone():
+    data = capmon_data.get_data_from_csvfile(ozone_file, 'CAPMoN_Ozone')
+    assert len(data) == 72
+    assert data.iloc[5].to_dict() == {
+        'SiteID': 'CAPMCANS1KEJ',
+        'DateStartUTC': '1990-01-01',
+        'TimeStartUTC': '05:00:00',
+        'DateEndUTC': '1990-01-01',
+        'TimeEndUTC': '06:00:00',
+        'O3_ppb': -999.0,
+        'O3_ppb_Flag': 'M1',
+    }
+    assert data['O3_ppb'].dtype == float
+    assert data['O3_ppb'].sum() == pytest.approx(-1364.8)
+    flags = capmon_data.get_data_from_csvfile(
+        ozone_file, 'Data validity flags')
+    assert list(flags['DataValidityFlagDescription']) == [
+        'Valid value',
+        'Valid value - below detection limit',
+        'Missing value - no value available',
+    ]
+    sites = capmon_data.get_data_from_csvfile(ozone_file, 'Site information')
+    assert list(sites['SiteName']) == [
+        'Kejimkujik National Park', 'Algoma', 'Montmorency']
+    assert capmon_data.get_header(ozone_file, 'CAPMoN_Ozone', 'O3') == 'O3_ppb'
+    assert capmon_data.get_units(
+        ozone_file, 'CAPMoN_Ozone', 'O3') == 'ppb (parts per billion)'
+
+
 def test_get_records():
     dataset = "CAPMoN_Precip_Chemistry"
     site_code = "CAPMCAAB1EST"
@@ -247,3 +268,80 @@ def test_merge_data_many_years():
     assert data.time_zone == 'UTC'
     assert data.measurement_scale == '?'
     assert data.status_flags == '?'
+
+
+@pytest.mark.parametrize('nr_of_runs', (1, 2))
+def test_merge_data_all_sites(tmp_path, nr_of_runs):
+    shutil.copy(ozone_file, str(tmp_path))
+    for _ in range(nr_of_runs):
+        # the second run reads the parsed cache
+        list_of_data = capmon_data.merge_data_all_sites(
+            "CAPMoN_Ozone",
+            "O3",
+            1990,
+            1990,
+            str(tmp_path)
+        )
+    assert [data.station_code for data in list_of_data] == [
+        'CAPMCANS1KEJ', 'CAPMCAON1ALG', 'CAPMCAPQ1MTM']
+    assert [len(data.records) for data in list_of_data] == [24, 24, 24]
+    data = list_of_data[1]
+    assert data.station_name == 'Algoma'
+    assert data.measurement_unit == 'ppb (parts per billion)'
+    assert data.time_interval == 'hourly'
+    assert (
+        data.records[5] ==
+        save_data.Record(
+            start_datetime=datetime.datetime(1990, 1, 1, 5, 0),
+            end_datetime=datetime.datetime(1990, 1, 1, 6, 0),
+            value=-999.0,
+            uncertainty=-999,
+            status=4,
+            status_flag='M1',
+            nr_of_samples=-999
+        )
+    )
+    single_site = capmon_data.merge_data_many_years(
+        "CAPMoN_Ozone",
+        "O3",
+        capmon_config.get_site_info("CAPMoN_Ozone", 'CAPMCAON1ALG'),
+        1989,
+        1990,
+        str(tmp_path)
+    )
+    assert list(single_site.records) == list(data.records)
+
+
+@pytest.mark.parametrize('site_code,expect', (
+    (None, 72),
+    ('CAPMCAON1ALG', 24),
+    ('CAPMCAXXXXXX', 0),
+))
+def test_read_data_many_years_site(tmp_path, site_code, expect):
+    shutil.copy(ozone_file, str(tmp_path))
+    data, header, units = capmon_data.read_data_many_years(
+        "CAPMoN_Ozone", "O3", 1990, 1990, str(tmp_path), site_code)
+    assert len(data) == expect
+    assert header == 'O3_ppb'
+    if site_code is not None:
+        assert set(data.SiteID) <= {site_code}
+
+
+def test_merge_data_all_sites_no_files():
+    assert capmon_data.merge_data_all_sites(
+        "CAPMoN_Ozone", "O3", 1960, 1961, os.path.dirname(__file__)) == []
+
+
+@pytest.mark.parametrize('status_flags,expect', (
+    (['V0', 'M1', 'V7', 'V0'], [0, 4, 3, 0]),
+    (['M2', 'V1', 'V2'], [5, 1, 2]),
+    ([], []),
+))
+def test_status_flags_to_numbers(status_flags, expect):
+    assert list(
+        capmon_data.status_flags_to_numbers(status_flags)) == expect
+
+
+def test_status_flags_to_numbers_unvalid_flag():
+    with pytest.raises(ValueError):
+        capmon_data.status_flags_to_numbers(['V0', 'X9'])
@@ -0,0 +1,137 @@
+import io
+import threading
+import time
+import pytest
+import requests
+from obsdata import download
+
+
+class FakeResponse:
+
+    def __init__(self, chunks, fail_after=None):
+        self.chunks = chunks
+        self.fail_after = fail_after
+
+    def iter_content(self, chunk_size=1):
+        for index, chunk in enumerate(self.chunks):
+            if index == self.fail_after:
+                raise requests.ConnectionError("connection reset")
+            yield chunk
+
+
+@pytest.mark.parametrize('translation, delete, expect', (
+    (None, b"", b"Sa\xcao Pa\x81\x83ulo"),
+    (bytes.maketrans(b"\xca", b"u"), b"\x81\x83", b"Sauo Paulo"),
+))
+def test_save_response(tmp_path, translation, delete, expect):
+    filename = str(tmp_path / "data.csv")
+    stats = download.save_response(
+        FakeResponse([b"Sa\xca", b"o Pa\x81", b"\x83ulo"]),
+        filename,
+        translation=translation,
+        delete=delete,
+    )
+    with open(filename, "rb") as f:
+        assert f.read() == expect
+    assert stats.filename == filename
+    assert stats.nr_of_bytes == len(expect)
+    assert download.get_throughput(stats) > 0
+    assert [path.name for path in tmp_path.iterdir()] == ["data.csv"]
+
+
+def test_save_response_interrupted(tmp_path):
+    filename = str(tmp_path / "data.csv")
+    with pytest.raises(requests.ConnectionError):
+        download.save_response(
+            FakeResponse([b"abc", b"def"], fail_after=1), filename)
+    assert list(tmp_path.iterdir()) == []
+
+
+def get_response(body):
+    response = requests.Response()
+    response.raw = io.BytesIO(body)
+    response.encoding = "utf-8"
+    return response
+
+
+@pytest.mark.parametrize('nr_of_chars', (0, 5, 100))
+def test_open_response_saves_rest_of_body(tmp_path, nr_of_chars):
+    body = b"line 1\n" * 1000
+    filename = str(tmp_path / "report.txt")
+    with download.open_response(
+            get_response(body), filename, chunk_size=64) as stream:
+        assert stream.read(nr_of_chars) == body.decode()[:nr_of_chars]
+    with open(filename, "rb") as f:
+        assert f.read() == body
+    assert [path.name for path in tmp_path.iterdir()] == ["report.txt"]
+
+
+def test_open_response_interrupted(tmp_path):
+    filename = str(tmp_path / "report.txt")
+    with pytest.raises(ValueError):
+        with download.open_response(get_response(b"abc"), filename):
+            raise ValueError("not a report")
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_download_all_retries_network_errors():
+    attempts = []
+
+    def flaky():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise requests.ConnectionError("connection reset")
+        return "ok"
+
+    results = download.download_all(
+        [download.DownloadTask("flaky", "example.com", flaky, ())],
+        backoff=0,
+        progress=False
+    )
+    assert results[0] == download.DownloadResult(
+        results[0].task, "ok", None, 3)
+
+
+@pytest.mark.parametrize('exception, expect_attempts', (
+    (requests.ConnectionError("connection reset"), 3),
+    (SystemExit(1), 1),
+))
+def test_download_all_gives_up(exception, expect_attempts):
+
+    def failing():
+        raise exception
+
+    results = download.download_all(
+        [download.DownloadTask("failing", "example.com", failing, ())],
+        retries=2,
+        backoff=0,
+        progress=False
+    )
+    assert results[0].result is None
+    assert results[0].error is exception
+    assert results[0].attempts == expect_attempts
+
+
+def test_download_all_limits_concurrency_per_host():
+    lock = threading.Lock()
+    running = {"a.com": 0, "b.com": 0}
+    max_running = {"a.com": 0, "b.com": 0}
+
+    def fetch(host):
+        with lock:
+            running[host] += 1
+            max_running[host] = max(max_running[host], running[host])
+        time.sleep(0.01)
+        with lock:
+            running[host] -= 1
+        return host
+
+    tasks = [
+        download.DownloadTask(str(index), host, fetch, (host,))
+        for index in range(12) for host in ["a.com", "b.com"]
+    ]
+    results = download.download_all(
+        tasks, max_workers=8, max_per_host=2, progress=False)
+    assert [result.result for result in results] == [
+        task.host for task in tasks]
+    assert max_running == {"a.com": 2, "b.com": 2}
@@ -1,16 +1,20 @@
 import pytest
 import os
+import shutil
 from datetime import datetime
 import pandas as pd
-from obsdata.eanet_data import EanetSheetExtractor
+from obsdata import cache, eanet_config, eanet_data
+from obsdata.eanet_data import (
+    EanetSheetExtractor, get_all_sites_from_files, merge_data,
+    merge_data_all_sites, merge_data_from_files,
+)
+
+
+xlsfile = os.path.join(os.path.dirname(__file__), "Dry2005Monthly.xls")
 
 
 @pytest.fixture
 def sheet():
-    xlsfile = os.path.join(
-        os.path.dirname(__file__),
-        "Dry2005Monthly.xls"
-    )
     return pd.read_excel(xlsfile, sheet_name='O3')
 
 
@@ -40,6 +44,15 @@ def test_sheet_extractor_get_all_sites(sheet):
     assert len(sites) == 17
 
 
+def test_sheet_extractor_get_all_records(sheet):
+    record_extractor = EanetSheetExtractor(sheet)
+    sites, records = record_extractor.get_all_records()
+    assert len(records) == len(sites) == 17 * 12
+    for site in record_extractor.get_sites().values():
+        _, site_records = record_extractor.get_records(site)
+        assert list(records[sites == site["site"]]) == list(site_records)
+
+
 @pytest.mark.parametrize('index,expect', (
     (0, {"site": "Rishiri", "row_start": 3, "row_end": 6, "column": 1}),
     (16, {"site": "Chiang Mai", "row_start": 67, "row_end": 70, "column": 1}),
@@ -69,3 +82,55 @@ def test_sheet_extractor_get_records(sheet, index, parameter, expect):
     else:
         assert getattr(records[index], parameter) == pytest.approx(
             expect, rel=1e-5)
+
+
+def test_merge_data_from_files(tmp_path, sheet):
+    shutil.copy(xlsfile, str(tmp_path))
+    xlsfiles = [str(tmp_path / os.path.basename(xlsfile))]
+    assert len(get_all_sites_from_files(xlsfiles, "O3")) == 17
+    eanet_site = eanet_config.get_site_info("JPA001")
+    expect = merge_data([sheet], eanet_site, "Dry Monthly", "O3")
+    for _ in range(2):
+        # the second call reads the parsed cache
+        data = merge_data_from_files(
+            xlsfiles, eanet_site, "Dry Monthly", "O3")
+        assert data.measurement_unit == expect.measurement_unit == "ppb"
+        assert len(data.records) == 12
+        assert list(data.records) == list(expect.records)
+
+
+def test_load_workbook_opens_file_once(tmp_path):
+    shutil.copy(xlsfile, str(tmp_path))
+    copy_of_xlsfile = str(tmp_path / os.path.basename(xlsfile))
+    misses = eanet_data._load_workbook.cache_info().misses
+    for parameter in ["O3", "SO2", "NH4+"]:
+        records, _ = eanet_data.parse_sheet(copy_of_xlsfile, parameter)
+        assert len(records) > 0
+    assert eanet_data._load_workbook.cache_info().misses == misses + 1
+    with pytest.raises(ValueError):
+        eanet_data.get_sheet(copy_of_xlsfile, "not a sheet")
+
+
+def test_merge_data_all_sites(tmp_path):
+    shutil.copy(xlsfile, str(tmp_path))
+    xlsfiles = [str(tmp_path / os.path.basename(xlsfile))]
+    list_of_data = merge_data_all_sites(xlsfiles, "Dry Monthly", "O3")
+    assert len(list_of_data) > 0
+    for data in list_of_data:
+        eanet_site = eanet_config.get_site_info(data.station_code)
+        expect = merge_data_from_files(
+            xlsfiles, eanet_site, "Dry Monthly", "O3")
+        assert len(data.records) == 12
+        assert list(data.records) == list(expect.records)
+
+
+def test_get_xlsfiles_skips_unavailable_years(tmp_path):
+    cached_file = eanet_data.get_xls_filename(
+        str(tmp_path), "Dry Monthly", 1998)
+    shutil.copy(xlsfile, cached_file)
+    cache.get_cache(str(tmp_path)).add(
+        cache.get_key("eanet", "Dry Monthly", "all", 1998),
+        os.path.basename(cached_file))
+    xlsfiles = eanet_data.get_xlsfiles(
+        str(tmp_path), "Dry Monthly", 1998, 1999)
+    assert xlsfiles == [cached_file]
@@ -1,8 +1,12 @@
 import pytest
 import os
+import shutil
 from datetime import datetime
+import numpy as np
+import pandas as pd
 from obsdata.eanet_hourly_data import (
-    EanetWetDataExtractor, EanetDryDataExtractor,
+    EanetWetDataExtractor, EanetDryDataExtractor, mangle_duplicates,
+    get_datetimes, read_data_all_products,
 )
 
 
@@ -80,3 +84,105 @@ def test_wet_data_extractor_get_records(target, index, parameter, expect):
     else:
         assert getattr(records[index], parameter) == pytest.approx(
             expect, rel=1e-5)
+
+
+def test_wet_data_extractor_table_locations():
+    data_extractor = EanetWetDataExtractor(wet_deposition_file, "pH")
+    table_locations = data_extractor._get_table_locations()
+    assert [
+        (table["start"], table["end"], table["header_row"])
+        for table in table_locations.values()
+    ] == [
+        (1, 28, 9), (29, 60, 9), (61, 93, 9),
+        (94, 108, 9), (109, 125, 9), (126, 154, 9)
+    ]
+    assert table_locations[0]["products"] == ['SO42-', 'NO3-', 'Cl-', 'F-']
+    assert table_locations[3]["products"][:3] == [
+        'SO42-.1', 'nss-SO42-', 'NO3-.1']
+    assert data_extractor._get_first_table_with_target(table_locations) == 2
+
+
+@pytest.mark.parametrize('headers, expect', (
+    (["a", "b", "c"], ["a", "b", "c"]),
+    (["a", "a", "b", "a"], ["a", "a.1", "b", "a.2"]),
+    (["a", "a.1", "a"], ["a", "a.1", "a.2"]),
+))
+def test_mangle_duplicates(headers, expect):
+    assert mangle_duplicates(headers) == expect
+
+
+@pytest.mark.parametrize('date, time, expect', (
+    ("2006/1/3", "9:00", datetime(2006, 1, 3, 9, 0)),
+    ("2006/12/31", "24:00", datetime(2007, 1, 1, 0, 0)),
+    ("2006/12/31", "00:30", datetime(2006, 12, 31, 0, 30)),
+    ("2006/12/31", np.nan, None),
+    (np.nan, "9:00", None),
+))
+def test_get_datetimes(date, time, expect):
+    datetimes = get_datetimes(pd.Series([date]), pd.Series([time]))
+    if expect is None:
+        assert np.isnat(datetimes[0])
+    else:
+        assert datetimes[0] == np.datetime64(expect)
+
+
+def test_dry_data_extractor_year_month_day_hour(tmp_path):
+    csvfile = tmp_path / "dry_deposition_auto.csv"
+    csvfile.write_text(
+        ",,,,,,ppb\n"
+        "Country,Site,Year,Month,Day,Hour,O3\n"
+        "Japan,Rishiri,2007,1,1,1,30.5\n"
+        "Japan,Rishiri,2007,1,1,24,31.0\n"
+        "Japan,Rishiri,2007,2,,,\n"
+        "Japan,Rishiri,,,,,32.0\n"
+    )
+    data_extractor = EanetDryDataExtractor(str(csvfile), "O3")
+    records = data_extractor.get_records()
+    assert len(records) == 3
+    assert [record.start_datetime for record in records] == [
+        datetime(2007, 1, 1, 1, 0),
+        datetime(2007, 1, 2, 0, 0),
+        datetime(2007, 2, 1, 0, 0),
+    ]
+    assert [record.value for record in records] == [30.5, 31.0, -999]
+    assert data_extractor.get_unit() == "ppb"
+
+
+@pytest.mark.parametrize('dataset, site, year, parameters, expect', (
+    (
+        "wet_deposition", "CNA004", 2006,
+        ["SO42-", "H2O", "pH", "R1", "nss-SO42-"],
+        [("SO42-", 365, "umol/l"), ("pH", 365, "?"), ("R1", 365, "?"),
+         ("nss-SO42-", 0, "umol/l")]
+    ),
+    (
+        "dry_deposition_passive_sampler", "IDA001", 2007,
+        ["SO2", "O3", "NO2"],
+        [("SO2", 61, "ppb"), ("NO2", 61, "ppb")]
+    ),
+))
+def test_read_data_all_products(
+        tmp_path, dataset, site, year, parameters, expect):
+    filename = "{}_{}_{}.csv".format(site, year, dataset)
+    shutil.copy(
+        os.path.join(os.path.dirname(__file__), filename),
+        str(tmp_path / filename)
+    )
+    for _ in range(2):
+        # the second call reads the parsed cache
+        list_of_data = read_data_all_products(
+            dataset, site, str(tmp_path / filename), parameters)
+        assert [
+            (data.parameter, len(data.records), data.measurement_unit)
+            for data in list_of_data
+        ] == expect
+
+
+def test_wet_data_extractor_set_parameter():
+    data_extractor = EanetWetDataExtractor(wet_deposition_file, "SO42-")
+    data_extractor.set_parameter("NO3-")
+    records = data_extractor.get_records()
+    assert records[2].value == pytest.approx(553.3, rel=1e-5)
+    data_extractor.set_parameter("pH")
+    assert data_extractor.get_records()[2].start_datetime == datetime(
+        2006, 1, 3, 9, 0)
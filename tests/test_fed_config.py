@@ -1,3 +1,4 @@
+from datetime import datetime
 import pytest
 
 
@@ -5,6 +6,9 @@ from obsdata.fed_config import (
     get_site_info,
     get_all_site_codes,
     get_parameter_info,
+    get_site_coverages,
+    plan_requests,
+    read_site_date,
     validate_input,
     InputError
 )
@@ -50,3 +54,47 @@ def test_get_all_site_codes():
         site_codes[0] == 'ACAD1' and
         site_codes[-1] == 'ZION1'
     )
+
+
+@pytest.mark.parametrize('date,expect', (
+    ('03/02/88', datetime(1988, 3, 2)),
+    ('06/28/10', datetime(2010, 6, 28)),
+    (' ', None),
+))
+def test_read_site_date(date, expect):
+    assert read_site_date(date) == expect
+
+
+def test_get_site_coverages():
+    coverages = get_site_coverages("10001")
+    assert coverages["ADPI1"] == (datetime(2001, 4, 4), datetime(2010, 6, 28))
+
+
+@pytest.mark.parametrize('windows,expect_plans,expect_avoided', (
+    (
+        [(datetime(2009, 1, 1), datetime(2009, 12, 31))],
+        [
+            (['ACAD1'], datetime(2009, 1, 1), datetime(2009, 12, 31)),
+            (['ADPI1'], datetime(2009, 1, 1), datetime(2009, 12, 31)),
+        ],
+        0,
+    ),
+    (
+        [
+            (datetime(2010, 1, 1), datetime(2010, 12, 31)),
+            (datetime(2011, 1, 1), datetime(2011, 12, 31)),
+        ],
+        [
+            (['ACAD1'], datetime(2010, 1, 1), datetime(2010, 12, 31)),
+            (['ADPI1'], datetime(2010, 1, 1), datetime(2010, 6, 28)),
+            (['ACAD1'], datetime(2011, 1, 1), datetime(2011, 12, 31)),
+        ],
+        1,
+    ),
+    ([(datetime(2019, 1, 1), datetime(2019, 12, 31))], [], 2),
+))
+def test_plan_requests(windows, expect_plans, expect_avoided):
+    plans, nr_of_avoided = plan_requests(
+        "10001", ["ACAD1", "ADPI1"], windows, 1)
+    assert [tuple(plan) for plan in plans] == expect_plans
+    assert nr_of_avoided == expect_avoided
@@ -1,11 +1,22 @@
 from datetime import date, datetime
+import io
 import os
+import numpy as np
 import pytest
+import requests
 
 
+from obsdata.download import ResponseStream
 from obsdata.fed_data import (
+    WindowSizer,
+    get_data_adaptive,
+    get_datetimes,
+    index_sections,
     set_request_data,
-    parse_fed_data
+    parse_fed_data,
+    parse_fed_data_many,
+    parse_report_many,
+    status_flags_to_numbers,
 )
 
 
@@ -72,3 +83,203 @@ def test_parse_metadata(fed_data, para, expect):
 def test_parse_data(fed_data, parameter, row, expect):
     data = parse_fed_data(fed_data)
     assert getattr(data.records[row], parameter) == expect
+
+
+@pytest.fixture
+def fed_data_many():
+    return "\r\n".join([
+        "Datasets",
+        "",
+        "Dataset;Code;StartDate;EndDate;Frequency;NumRecords",
+        "IMPROVE Aerosol;IMPFSPED;3/2/1988;11/28/2018;Daily;28902878",
+        "",
+        "Sites",
+        "",
+        "Site;Code;Dataset;State;County;Latitude;Longitude;Elevation",
+        "Badlands NP;BADL1;IMPFSPED;SD;46071;43.74350;-101.94120;736",
+        "Wind Cave;WICA1;IMPFSPED;SD;46033;43.55760;-103.48390;1300",
+        "",
+        "Parameters",
+        "",
+        "DatasetID;Parameter;Code;AQSCode;Units;Description",
+        "10001;Carbon, Organic Total (Fine);OCf;88320;Âµg/m^3 LC;OC",
+        "10001;Sulfate (Fine);SO4f;88403;Âµg/m^3;SO4",
+        "",
+        "Status Flags",
+        "",
+        "Status Flag;Description",
+        "V0;Valid value",
+        "M1;Missing value because no value is available",
+        "",
+        "Data",
+        "",
+        "Dataset;SiteCode;POC;Date;OCf:Value;OCf:Unc;OCf:StatusFlag;"
+        "SO4f:Value;SO4f:Unc;SO4f:StatusFlag",
+        "IMPFSPED;BADL1;1;01/01/2017;0.3;0.08;V0;0.5;0.01;V0",
+        "IMPFSPED;WICA1;1;01/01/2017;0.2;0.07;V0;-999;-999;M1",
+        "IMPFSPED;BADL1;1;01/04/2017;0.4;0.09;V0;0.6;0.02;V0",
+        "",
+    ])
+
+
+def test_set_request_data_many_sites():
+    request_data = set_request_data(
+        10001, [1, 2], [114, 115], "Daily", date(2017, 1, 1),
+        date(2017, 1, 31))
+    assert request_data["siidse"] == [1, 2]
+    assert request_data["paidse"] == [114, 115]
+
+
+def test_parse_fed_data_many(fed_data_many):
+    list_of_data = parse_fed_data_many(fed_data_many)
+    assert [
+        (data.station_code, data.parameter_code, data.measurement_unit)
+        for data in list_of_data
+    ] == [
+        ("BADL1", "OCf", "ug/m^3 LC"),
+        ("BADL1", "SO4f", "ug/m^3"),
+        ("WICA1", "OCf", "ug/m^3 LC"),
+        ("WICA1", "SO4f", "ug/m^3"),
+    ]
+    assert [
+        [record.value for record in data.records] for data in list_of_data
+    ] == [[0.3, 0.4], [0.5, 0.6], [0.2], [-999]]
+    assert list_of_data[3].records[0].status == 4
+    assert list_of_data[2].station_name == "Wind Cave"
+    assert list_of_data[2].altitude == "1300"
+
+
+@pytest.mark.parametrize('chunksize', (1, 2, 100))
+def test_parse_report_many_in_chunks(tmp_path, fed_data_many, chunksize):
+    raw = fed_data_many.encode("utf-8")
+    with open(str(tmp_path / "report.txt"), "wb") as tee:
+        stream = io.TextIOWrapper(
+            io.BufferedReader(ResponseStream(
+                [raw[start:start + 16] for start in range(0, len(raw), 16)],
+                tee
+            )),
+            encoding="utf-8"
+        )
+        list_of_data = parse_report_many(stream, chunksize=chunksize)
+    assert (tmp_path / "report.txt").read_bytes() == raw
+    assert [
+        list(data.records) for data in list_of_data
+    ] == [
+        list(data.records) for data in parse_fed_data_many(fed_data_many)
+    ]
+
+
+def test_parse_fed_data_many_single(fed_data):
+    list_of_data = parse_fed_data_many(fed_data)
+    data = parse_fed_data(fed_data)
+    assert len(list_of_data) == 1
+    assert list(list_of_data[0].records) == list(data.records)
+
+
+@pytest.mark.parametrize('dates,expect', (
+    (
+        ["01/04/2017", "12/31/1999 23:59:59"],
+        [datetime(2017, 1, 4), datetime(1999, 12, 31, 23, 59, 59)]
+    ),
+    (["1/4/2017", "02/29/2016"], [datetime(2017, 1, 4), datetime(2016, 2, 29)]),
+    ([], []),
+))
+def test_get_datetimes(dates, expect):
+    assert list(
+        get_datetimes(dates).astype("datetime64[s]").astype(datetime)
+    ) == expect
+
+
+@pytest.mark.parametrize('dates', (
+    ["02/30/2016"],
+    ["01/01/2017 24:00:00"],
+    ["01/01/2017 00:00:00+01"],
+    ["01/04/2017", "01/01/2017 00:00:00.5"],
+))
+def test_get_datetimes_invalid(dates):
+    with pytest.raises(ValueError):
+        get_datetimes(dates)
+
+
+def test_status_flags_to_numbers():
+    assert list(status_flags_to_numbers(["V0", "NA", "M1"])) == [8, 7, 4]
+    with pytest.raises(ValueError):
+        status_flags_to_numbers(["V0", "X9"])
+
+
+def test_index_sections(fed_data):
+    sections = index_sections(fed_data)
+    start, end = sections["Sites"]
+    assert fed_data[start:end].split("\n")[1].startswith("Badlands NP;BADL1")
+    start, end = sections["Data"]
+    assert len(fed_data[start:end].strip().split("\n")) == 12
+
+
+@pytest.mark.parametrize('frequency,nr_of_sites,expect', (
+    ("Hourly", 50, 83),
+    ("Daily", 50, 2000),
+    ("Weekly", 1, 700000),
+    ("Hourly", 100000, 1),
+))
+def test_window_sizer_get_days(frequency, nr_of_sites, expect):
+    assert WindowSizer(frequency).get_days(nr_of_sites) == expect
+
+
+def test_window_sizer_learns_from_responses():
+    sizer = WindowSizer("Daily", target_records=1000, target_seconds=10)
+    sizer.update(10, 100, 100, 1.0)
+    assert sizer.records_per_day == pytest.approx(0.55)
+    assert sizer.get_days(10) == 181
+    sizer.fail(150)
+    assert sizer.get_days(10) == 75
+
+
+def test_window_sizer_subtracts_latency():
+    sizer = WindowSizer(
+        "Daily", target_records=1000, target_seconds=10, latency=2)
+    # a small response is mostly latency and does not shrink windows
+    sizer.update(10, 10, 10, 2.5)
+    assert sizer.records_per_second is None
+    assert sizer.get_days(10) == 181
+    sizer.update(10, 100, 1000, 12)
+    assert sizer.records_per_second == pytest.approx(100)
+    assert sizer.get_days(10) == 103
+    # a faster request lowers the latency
+    sizer.update(10, 100, 1000, 1.0)
+    assert sizer.latency == 1.0
+
+
+def test_get_data_adaptive_splits_failed_windows(fed_data_many):
+    requested = []
+
+    def get_data(request_data, ori_dir=None):
+        start, end = [
+            np.datetime64(date.replace("/", "-"))
+            for date in request_data["dt"].split(">")
+        ]
+        requested.append((str(start), str(end)))
+        if end - start > np.timedelta64(1, "D"):
+            raise requests.ConnectionError("timeout")
+        list_of_data = parse_fed_data_many(fed_data_many)
+        return [
+            data._replace(records=data.records[
+                (data.records.start_datetime >= start) &
+                (data.records.start_datetime <= end)
+            ])
+            for data in list_of_data
+        ]
+
+    list_of_data = get_data_adaptive(
+        10001, [1, 2], [141, 142], "Daily",
+        datetime(2017, 1, 1), datetime(2017, 1, 8),
+        sizer=WindowSizer("Daily", target_records=8),
+        get_data=get_data
+    )
+    assert requested[:3] == [
+        ("2017-01-01", "2017-01-04"),
+        ("2017-01-01", "2017-01-02"),
+        ("2017-01-03", "2017-01-04"),
+    ]
+    assert [
+        [record.value for record in data.records] for data in list_of_data
+    ] == [[0.3, 0.4], [0.5, 0.6], [0.2], [-999]]
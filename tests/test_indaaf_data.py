@@ -1,5 +1,8 @@
+import io
 import pytest
+import pandas as pd
 import os
+import requests
 import datetime
 from obsdata import indaaf_data, indaaf_config, save_data
 
@@ -84,3 +87,40 @@ def test_get_records(o3_data):
         status_flag=-999,
         nr_of_samples=-999
     )
+
+
+@pytest.mark.parametrize('dates,expect', (
+    (
+        ['2005-01-01', '2005-02-01'],
+        [datetime.datetime(2005, 1, 1), datetime.datetime(2005, 2, 1)]
+    ),
+    (
+        ['2005-01-01 00:00:00', '2005-01-01 01:30:00'],
+        [datetime.datetime(2005, 1, 1), datetime.datetime(2005, 1, 1, 1, 30)]
+    ),
+    (
+        ['2005-01-01', '2005-01-01 01:30:00'],
+        [datetime.datetime(2005, 1, 1), datetime.datetime(2005, 1, 1, 1, 30)]
+    ),
+))
+def test_get_datetimes(dates, expect):
+    datetimes = indaaf_data.get_datetimes(pd.Series(dates))
+    assert list(datetimes) == list(pd.to_datetime(expect).values)
+
+
+class UnreadableBody(io.RawIOBase):
+
+    def read(self, size=-1):
+        raise AssertionError("body read")
+
+
+@pytest.mark.parametrize('content_type,body,expect', (
+    ("text/html; charset=UTF-8", b"<a>Create an account</a>", True),
+    ("text/html; charset=UTF-8", b"<a id='dl_button_1'></a>", False),
+    ("text/csv", None, False),
+))
+def test_is_expired(content_type, body, expect):
+    response = requests.Response()
+    response.headers["Content-Type"] = content_type
+    response.raw = UnreadableBody() if body is None else io.BytesIO(body)
+    assert indaaf_data.is_expired(response) == expect
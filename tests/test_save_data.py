@@ -3,10 +3,22 @@ import os
 import pytest
 import numpy as np
 from netCDF4 import Dataset, num2date
+import pyarrow.parquet as pq  # type: ignore
 
 from obsdata.save_data import (
+    ObsData,
+    Record,
+    RecordTable,
+    date_filter_records,
+    datetimes_to_days_since,
+    format_records_txt,
     save_data_txt,
-    save_data_netcdf
+    save_data_netcdf,
+    save_data_netcdf_stations,
+    get_stations_filename,
+    get_parquet_partition,
+    save_data_parquet,
+    split_records
 )
 from obsdata.fed_data import parse_fed_data
 
@@ -91,3 +103,297 @@ def test_save_netcdf_datetime(netcdf_dataset):
         for time in netcdf_dataset["time"]
     ]
     assert np.all(dates == expected_dates)
+
+
+@pytest.fixture
+def records():
+    return [
+        Record(
+            start_datetime=datetime(2017, 1, day),
+            end_datetime=-999,
+            value=float(day),
+            uncertainty=-999,
+            status=8,
+            status_flag="V0",
+            nr_of_samples=-999,
+        )
+        for day in range(1, 11)
+    ]
+
+
+def test_record_table_from_records(records):
+    record_table = RecordTable.from_records(records)
+    assert len(record_table) == 10
+    assert record_table[0] == records[0]
+    assert record_table[-1] == records[-1]
+    assert list(record_table) == records
+
+
+def test_record_table_columns(records):
+    record_table = RecordTable.from_records(records)
+    assert record_table.start_datetime.dtype == np.dtype("datetime64[s]")
+    assert np.all(np.isnat(record_table.end_datetime))
+    assert np.all(record_table.value == np.arange(1, 11))
+    assert list(record_table.status_flag.categories) == ["V0"]
+
+
+def test_record_table_slice(records):
+    record_table = RecordTable.from_records(records)[2:4]
+    assert isinstance(record_table, RecordTable)
+    assert record_table.to_records() == records[2:4]
+
+
+def test_record_table_concatenate(records):
+    record_table = RecordTable.concatenate([
+        RecordTable.from_records(records[:5]),
+        RecordTable.from_records(records[5:]),
+    ])
+    assert record_table.to_records() == records
+
+
+@pytest.mark.parametrize('date_start,date_end,expect', (
+    (datetime(2017, 1, 1), datetime(2017, 1, 3), 2),
+    (datetime(2017, 1, 5), datetime(2017, 2, 1), 6),
+    (datetime(2017, 2, 1), datetime(2017, 3, 1), 0),
+))
+def test_date_filter_record_table(records, date_start, date_end, expect):
+    filtered_records = date_filter_records(
+        date_start, date_end, RecordTable.from_records(records))
+    assert len(filtered_records) == expect
+
+
+def test_format_records_txt():
+    records = [
+        Record(
+            start_datetime=datetime(2017, 1, 1, 13, 0),
+            end_datetime=datetime(2017, 1, 1, 14, 0),
+            value=12.3456,
+            uncertainty=0.125,
+            status=8,
+            status_flag="V0",
+            nr_of_samples=3,
+        ),
+        Record(
+            start_datetime=datetime(2017, 1, 1, 14, 0),
+            end_datetime=-999,
+            value=-999,
+            uncertainty=-999,
+            status=-999,
+            status_flag=-999,
+            nr_of_samples=-999,
+        ),
+    ]
+    assert format_records_txt(records) == (
+        "2017-01-01 13:00 2017-01-01 14:00     12.346     3    0.12"
+        "     8 -9 -99999999\n"
+        "2017-01-01 14:00 9999-99-99 99:99 -99999.999 -9999 -999.99"
+        " -9999 -9 -99999999\n"
+    )
+
+
+@pytest.fixture
+def hourly_data():
+    nr_of_records = 1000
+    start_datetime = (
+        np.datetime64("2010-01-01T00:00:00") +
+        np.arange(nr_of_records).astype("timedelta64[h]")
+    )
+    records = RecordTable(
+        start_datetime=start_datetime,
+        end_datetime=start_datetime + np.timedelta64(1, "h"),
+        value=np.linspace(0, 100, nr_of_records),
+        uncertainty=np.full(nr_of_records, -999),
+        status=np.zeros(nr_of_records),
+        status_flag=np.full(nr_of_records, "V0"),
+        nr_of_samples=np.full(nr_of_records, -999),
+    )
+    return ObsData(
+        data_version="?",
+        station_name="Test",
+        station_code="TEST1",
+        station_category="global",
+        observation_category=(
+            "Air sampling observation at a stationary platform"),
+        country_territory="?",
+        contributor="test",
+        latitude=1.,
+        longitude=2.,
+        altitude=3.,
+        nr_of_sampling_heights=1,
+        sampling_heights="?",
+        contact_point="?",
+        dataset="test",
+        parameter="O3",
+        parameter_code="O3",
+        time_interval="hourly",
+        measurement_unit="ppb",
+        measurement_method="?",
+        sampling_type="continuous",
+        time_zone="UTC",
+        measurement_scale="?",
+        status_flags="?",
+        records=records,
+    )
+
+
+def test_datetimes_to_days_since():
+    datetimes = np.array(
+        ["1900-01-01T00:00", "2017-01-04T12:00"], dtype="datetime64[s]")
+    assert np.all(
+        datetimes_to_days_since(datetimes) == [0., 42737.5])
+
+
+def test_save_netcdf_compressed(hourly_data, tmp_dir):
+    save_data_netcdf(
+        tmp_dir, hourly_data, zlib=True, chunksize=240, value_dtype="f4")
+    with Dataset(tmp_dir.join("test1.test.as.cs.o3.nl.hr2010.nc")) as ds:
+        assert ds["O3"].dtype == np.dtype("f4")
+        assert ds["O3"].filters()["zlib"]
+        assert ds["O3"].chunking() == [240]
+        assert np.allclose(ds["O3"][:], hourly_data.records.value)
+        dates = num2date(
+            ds["time"][:], ds["time"].units, ds["time"].calendar)
+        assert dates[1] == datetime(2010, 1, 1, 1)
+
+
+def test_save_netcdf_stations(hourly_data, tmp_dir):
+    output_file = str(tmp_dir.join("stations.nc"))
+    records = hourly_data.records
+    save_data_netcdf_stations(output_file, [
+        hourly_data._replace(records=records[:500]),
+        hourly_data._replace(station_code="TEST2", parameter_code="NO2"),
+    ])
+    # append to the existing file
+    save_data_netcdf_stations(output_file, [
+        hourly_data._replace(records=records[500:]),
+        hourly_data._replace(station_code="TEST3", records=records[::2]),
+    ])
+    with Dataset(output_file) as ds:
+        assert list(ds["station_code"][:]) == ["TEST1", "TEST2", "TEST3"]
+        assert len(ds["time"]) == 1000
+        assert np.allclose(ds["O3"][0, :], records.value)
+        assert np.all(ds["O3"][1, :].mask)
+        assert np.allclose(ds["NO2"][1, :], records.value)
+        assert np.all(ds["NO2"][2, :].mask)
+        assert np.allclose(ds["O3"][2, ::2], records.value[::2])
+        assert np.all(ds["O3"][2, 1::2].mask)
+
+
+def test_save_netcdf_stations_keeps_time_sorted(hourly_data, tmp_dir):
+    output_file = str(tmp_dir.join("stations.nc"))
+    records = hourly_data.records
+    save_data_netcdf_stations(output_file, [
+        hourly_data._replace(records=records[500:]),
+        hourly_data._replace(station_code="TEST2", records=records[1::2]),
+    ])
+    # earlier and interleaved times of a new station and parameter
+    save_data_netcdf_stations(output_file, [
+        hourly_data._replace(
+            station_code="TEST3", parameter_code="NO2",
+            records=records[::2]),
+        hourly_data._replace(records=records[:500]),
+    ])
+    with Dataset(output_file) as ds:
+        times = ds["time"][:]
+        assert len(times) == 1000
+        assert np.all(np.diff(times) > 0)
+        assert np.allclose(ds["O3"][0, :], records.value)
+        assert np.allclose(ds["O3"][1, 1::2], records.value[1::2])
+        assert np.all(ds["O3"][1, ::2].mask)
+        assert np.all(ds["O3"][2, :].mask)
+        # missing values are kept
+        assert np.all(ds["O3_unc"][1, 1::2].mask)
+        assert np.all(ds["O3_unc"][1, 1::2].data == -999)
+        assert np.allclose(ds["NO2"][2, ::2], records.value[::2])
+        assert np.all(ds["NO2"][:2, :].mask)
+
+
+def test_save_netcdf_stations_new_station_earlier_times(
+        hourly_data, tmp_dir):
+    output_file = str(tmp_dir.join("stations.nc"))
+    records = hourly_data.records
+    save_data_netcdf_stations(output_file, [
+        hourly_data._replace(records=records[500:]),
+    ])
+    # a new station with earlier times
+    save_data_netcdf_stations(output_file, [
+        hourly_data._replace(station_code="TEST2", records=records[:500]),
+    ])
+    with Dataset(output_file) as ds:
+        assert np.allclose(ds["O3"][0, 500:], records.value[500:])
+        assert np.all(ds["O3"][0, :500].mask)
+        assert np.allclose(ds["O3"][1, :500], records.value[:500])
+        assert np.all(ds["O3"][1, 500:].mask)
+        assert np.all(ds["O3_unc"][1, 500:].mask)
+        assert np.all(ds["O3_status"][1, 500:].mask)
+        assert np.all(ds["O3_status"][1, :500] == records.status[:500])
+
+
+def test_get_stations_filename(hourly_data):
+    assert get_stations_filename("/tmp", hourly_data) == (
+        "/tmp/test.o3.{}.stations.nc".format(hourly_data.time_interval))
+
+
+def test_save_parquet(hourly_data, tmp_dir):
+    save_data_parquet(str(tmp_dir), hourly_data)
+    # saving the same data again replaces the files
+    save_data_parquet(str(tmp_dir), hourly_data)
+    partition = tmp_dir.join(
+        "contributor=test", "station_code=TEST1", "parameter_code=O3",
+        "year=2010")
+    assert len(partition.listdir()) == 1
+    table = pq.read_table(str(tmp_dir))
+    assert table.num_rows == 1000
+    assert np.allclose(
+        table.column("value").to_numpy(), hourly_data.records.value)
+    metadata = pq.read_schema(str(partition.listdir()[0])).metadata
+    assert metadata[b"station_name"] == b"Test"
+    assert metadata[b"measurement_unit"] == b"ppb"
+
+
+def test_save_parquet_keeps_other_periods(hourly_data, tmp_dir):
+    records = hourly_data.records
+    save_data_parquet(
+        str(tmp_dir), hourly_data._replace(records=records[:600]))
+    # another, overlapping period of the same year
+    save_data_parquet(
+        str(tmp_dir), hourly_data._replace(records=records[400:]))
+    partition = tmp_dir.join(
+        "contributor=test", "station_code=TEST1", "parameter_code=O3",
+        "year=2010")
+    assert len(partition.listdir()) == 1
+    table = pq.read_table(str(tmp_dir))
+    assert table.num_rows == 1000
+    assert np.allclose(table.column("value").to_numpy(), records.value)
+    assert list(table.column("start_datetime").to_numpy()) == list(
+        records.start_datetime)
+
+
+def test_get_parquet_partition(hourly_data):
+    assert get_parquet_partition(
+        "/tmp", hourly_data._replace(contributor="a b/c"), 2010
+    ) == (
+        "/tmp/contributor=a%20b%2Fc/station_code=TEST1/"
+        "parameter_code=O3/year=2010"
+    )
+
+
+def test_date_filter_record_table_view(hourly_data):
+    records = hourly_data.records
+    filtered_records = date_filter_records(
+        datetime(2010, 1, 2), datetime(2010, 1, 3), records)
+    assert len(filtered_records) == 24
+    assert filtered_records[0].start_datetime == datetime(2010, 1, 2)
+    assert np.shares_memory(filtered_records.value, records.value)
+
+
+@pytest.mark.parametrize('period,expect', (
+    ("year", [(datetime(2010, 1, 1), 1000)]),
+    ("month", [(datetime(2010, 1, 1), 744), (datetime(2010, 2, 1), 256)]),
+))
+def test_split_records(hourly_data, period, expect):
+    periods = split_records(hourly_data.records, period)
+    assert [
+        (period_start, len(records))
+        for period_start, records in periods
+    ] == expect
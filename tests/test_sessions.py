@@ -0,0 +1,66 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from obsdata import sessions
+
+
+Response = namedtuple("Response", ["url"])
+
+
+class FakeSession:
+    """records requests, the first nr_of_expired responses
+       are redirects to the login page"""
+
+    def __init__(self, nr_of_expired=0):
+        self.nr_of_expired = nr_of_expired
+        self.requests = []
+
+    def request(self, method, url, **kwargs):
+        self.requests.append((method, url))
+        if self.nr_of_expired > 0:
+            self.nr_of_expired -= 1
+            return Response("http://example.com/login")
+        return Response(url)
+
+    def close(self):
+        pass
+
+
+def is_expired(response):
+    return response.url == "http://example.com/login"
+
+
+def test_authenticated_session_logs_in_once():
+    logins = []
+    session = sessions.AuthenticatedSession(logins.append, is_expired)
+    session.session = FakeSession()
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        responses = list(executor.map(
+            lambda index: session.get(
+                "http://example.com/{}".format(index)),
+            range(50)
+        ))
+    assert len(logins) == 1
+    assert responses[7].url == "http://example.com/7"
+    assert len(session.session.requests) == 50
+
+
+def test_authenticated_session_logs_in_again_when_expired():
+    logins = []
+    session = sessions.AuthenticatedSession(logins.append, is_expired)
+    session.session = FakeSession(nr_of_expired=1)
+    r = session.post("http://example.com/data")
+    assert r.url == "http://example.com/data"
+    assert len(logins) == 2
+    assert session.session.requests == [
+        ("POST", "http://example.com/data"),
+        ("POST", "http://example.com/data"),
+    ]
+
+
+def test_get_session_is_shared_per_source():
+    session = sessions.get_session("test", lambda session: None)
+    assert sessions.get_session("test", lambda session: None) is session
+    assert sessions.get_session("other", lambda session: None) is not session
+    sessions.close_sessions()
+    assert sessions.get_session("test", lambda session: None) is not session
+    sessions.close_sessions()